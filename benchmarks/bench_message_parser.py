@@ -0,0 +1,108 @@
+"""
+Micro-benchmark of email message parsing: the original header scans and body decoding
+against email_processor.service.message_parser, on a synthetic corpus of large multipart messages.
+Run with: python3 benchmarks/bench_message_parser.py [--messages N] [--body-size BYTES]
+"""
+import argparse
+import base64
+import email.utils
+import random
+import re
+import string
+import time
+from typing import Any, Callable, Dict, List, Optional
+from email_processor.service.constants import MAX_BODY_LENGTH
+from email_processor.service.message_parser import extract_body, parse_date, parse_headers
+
+
+def legacy_process_email_body(message: Dict[str, Any]) -> str:
+    """Body decoding as originally shipped: top-level text/plain parts only."""
+    if 'parts' in message['payload']:
+        message_body = []
+        for part in message['payload']['parts']:
+            if part['mimeType'] == 'text/plain':
+                decoded_body = base64.urlsafe_b64decode(
+                    part['body']['data'] + '===').decode('utf-8', errors='ignore')
+                message_body.append(re.sub(r'\s+', ' ', decoded_body))
+        return ", ".join(message_body)
+    else:
+        return message['snippet']
+
+
+def legacy_parse(message: Dict[str, Any]) -> tuple:
+    """Header extraction as originally shipped: one scan of the headers per field."""
+    from_address = ", ".join(
+        [header['value'] for header in message['payload']['headers'] if header['name'] == 'From'])
+    subject = ", ".join(
+        [header['value'] for header in message['payload']['headers'] if header['name'] == 'Subject'])
+    received_date = email.utils.parsedate_to_datetime(
+        [header['value'] for header in message['payload']['headers'] if header['name'] == 'Date'][0])
+    return from_address, subject, received_date, legacy_process_email_body(message)
+
+
+def parse(message: Dict[str, Any], max_length: Optional[int]) -> tuple:
+    """Header extraction and body decoding with the message parser."""
+    headers = parse_headers(message['payload']['headers'])
+    return (headers.get('From', ''), headers.get('Subject', ''), parse_date(headers.get('Date')),
+            extract_body(message, max_length=max_length))
+
+
+def build_corpus(count: int, body_size: int, seed: int = 0) -> List[Dict[str, Any]]:
+    """Build messages with many headers and large text parts, top-level and nested."""
+    generator = random.Random(seed)
+    words = [''.join(generator.choices(string.ascii_letters, k=generator.randint(2, 10))) for _ in range(500)]
+
+    def encoded_text(size: int) -> str:
+        text, length = [], 0
+        while length < size:
+            word = generator.choice(words) + generator.choice([' ', ' ', '  ', '\r\n', '\t'])
+            text.append(word)
+            length += len(word)
+        return base64.urlsafe_b64encode(''.join(text).encode('utf-8')).decode('ascii')
+
+    messages = []
+    for index in range(count):
+        headers = [{'name': f'X-Header-{i}', 'value': 'x' * 40} for i in range(30)] + [
+            {'name': 'From', 'value': f'Sender {index} <sender{index}@example.com>'},
+            {'name': 'Subject', 'value': f'Subject {index}'},
+            {'name': 'Date', 'value': 'Fri, 08 Mar 2024 10:00:00 +0000'},
+        ]
+        messages.append({'id': str(index), 'snippet': 'snippet', 'payload': {
+            'mimeType': 'multipart/mixed', 'headers': headers, 'parts': [
+                {'mimeType': 'text/plain', 'body': {'data': encoded_text(body_size)}},
+                {'mimeType': 'multipart/alternative', 'parts': [
+                    {'mimeType': 'text/plain', 'body': {'data': encoded_text(body_size // 4)}},
+                    {'mimeType': 'text/html', 'body': {'data': encoded_text(body_size // 4)}},
+                ]},
+                {'mimeType': 'application/pdf', 'filename': 'a.pdf', 'body': {'attachmentId': 'A'}},
+            ]}})
+    return messages
+
+
+def best_time(function: Callable[[], Any], repeat: int) -> float:
+    """Best wall time of the function over repeat runs, in seconds."""
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--messages', type=int, default=200)
+    parser.add_argument('--body-size', type=int, default=512 * 1024)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    messages = build_corpus(args.messages, args.body_size)
+    legacy = best_time(lambda: [legacy_parse(message) for message in messages], args.repeat)
+    print(f"{args.messages} messages, {args.body_size} bytes top-level text part each, plus nested parts")
+    print(f"legacy parser:                  {legacy:8.3f}s")
+    for label, max_length in [('message parser, no body cap', None), ('message parser, default cap', MAX_BODY_LENGTH)]:
+        elapsed = best_time(lambda: [parse(message, max_length) for message in messages], args.repeat)
+        print(f"{label + ':':31} {elapsed:8.3f}s  ({legacy / elapsed:.2f}x)")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,332 @@
+"""
+Local fake of the Gmail API for offline benchmarks.
+FakeGmailService mimics the googleapiclient resource tree used by email_processor:
+users.getProfile, messages.list/get/batchModify, labels.list/create, history.list and batch HTTP requests.
+It serves a synthetic mailbox generated on demand from message indexes, so mailboxes of millions
+of messages cost no memory until they are modified, and injects latency and errors per round trip.
+"""
+import base64
+import bisect
+import random
+import threading
+import time
+from collections import defaultdict
+from datetime import datetime, timedelta
+from typing import Any, Callable, Dict, Iterable, List, Optional
+import httplib2
+from googleapiclient.errors import HttpError
+
+SYSTEM_LABELS = ['INBOX', 'UNREAD', 'IMPORTANT', 'SENT', 'SPAM', 'TRASH', 'STARRED']
+SENDERS = [
+    'Billing <billing@shop.example.com>',
+    'News <news@example.com>',
+    'Alice <alice@example.org>',
+    'Bob <bob@example.net>',
+    'noreply@notifications.example.io',
+]
+SUBJECT_WORDS = ['Invoice', 'Weekly', 'digest', 'Meeting', 'notes', 'Your', 'order', 'Reminder', 'Report', 'Update']
+BODY_WORDS = ['amount', 'due', 'please', 'find', 'attached', 'thanks', 'regards', 'meeting', 'tomorrow', 'report']
+FIRST_DATE = datetime(2023, 1, 1)
+# Methods email_processor retries on transient errors, the only ones failing by default
+RETRIED_METHODS = ['messages.get', 'messages.batchModify']
+
+
+def new_http_error(status: int, reason: bytes) -> HttpError:
+    """Create the HttpError googleapiclient raises for the given status."""
+    return HttpError(httplib2.Response({'status': status}), reason)
+
+
+class FakeMailbox:
+    """
+    Class to represent a synthetic mailbox of messages derived from their index.
+    Only label changes and messages added after creation are stored.
+    """
+    def __init__(self, size: int, body_size: int = 2048, seed: int = 0, user_labels: Optional[List[str]] = None):
+        """Initialize the mailbox with size messages, newest last."""
+        self.size = size
+        self.body_size = body_size
+        self.seed = seed
+        self.labels = {name: name for name in SYSTEM_LABELS}
+        for index, name in enumerate(user_labels or []):
+            self.labels[name] = f'Label_{index + 1}'
+        self.label_overrides = {}
+        self.history, self.history_ids = [], []
+        self.history_id = size
+        # History older than the mailbox creation has expired
+        self.first_history_id = size
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def message_id(index: int) -> str:
+        return f'{index + 1:016x}'
+
+    @staticmethod
+    def message_index(message_id: str) -> int:
+        return int(message_id, 16) - 1
+
+    def has_message(self, message_id: str) -> bool:
+        try:
+            return 0 <= self.message_index(message_id) < self.size
+        except ValueError:
+            return False
+
+    def get_label_ids(self, index: int) -> List[str]:
+        message_id = self.message_id(index)
+        if message_id in self.label_overrides:
+            return sorted(self.label_overrides[message_id])
+        return ['INBOX', 'UNREAD'] if index % 3 else ['INBOX']
+
+    def get_message(self, message_id: str, message_format: str = 'full',
+                    metadata_headers: Optional[List[str]] = None) -> Dict[str, Any]:
+        """Build the message resource, the same every time for a given message ID."""
+        index = self.message_index(message_id)
+        generator = random.Random(self.seed * 1_000_003 + index)
+        received_date = FIRST_DATE + timedelta(minutes=index)
+        headers = [
+            {'name': 'From', 'value': generator.choice(SENDERS)},
+            {'name': 'To', 'value': 'bench@example.com'},
+            {'name': 'Subject', 'value': ' '.join(generator.choices(SUBJECT_WORDS, k=4))},
+            {'name': 'Date', 'value': received_date.strftime('%a, %d %b %Y %H:%M:%S +0000')},
+        ] + [{'name': f'X-Header-{i}', 'value': 'x' * 32} for i in range(10)]
+        if message_format == 'metadata' and metadata_headers:
+            headers = [header for header in headers if header['name'] in metadata_headers]
+        message = {
+            'id': message_id,
+            'threadId': message_id,
+            'labelIds': self.get_label_ids(index),
+            'snippet': ' '.join(generator.choices(BODY_WORDS, k=10)),
+            'historyId': str(index + 1),
+            'payload': {'mimeType': 'multipart/alternative', 'headers': headers},
+        }
+        if message_format == 'full':
+            text = ' '.join(generator.choices(BODY_WORDS, k=max(1, self.body_size // 7)))
+            data = base64.urlsafe_b64encode(text.encode('utf-8')).decode('ascii')
+            message['payload']['parts'] = [
+                {'mimeType': 'text/plain', 'body': {'size': len(text), 'data': data}},
+                {'mimeType': 'text/html', 'body': {'size': len(text), 'data': data}},
+            ]
+        return message
+
+    def list_messages(self, page_token: Optional[str], max_results: int) -> Dict[str, Any]:
+        """List message IDs, newest first."""
+        start = int(page_token) if page_token else 0
+        end = min(self.size, start + max_results)
+        response = {
+            'messages': [
+                {'id': self.message_id(self.size - 1 - offset), 'threadId': self.message_id(self.size - 1 - offset)}
+                for offset in range(start, end)
+            ],
+            'resultSizeEstimate': self.size,
+        }
+        if end < self.size:
+            response['nextPageToken'] = str(end)
+        return response
+
+    def add_messages(self, count: int) -> List[str]:
+        """Deliver new messages, recording them in the history."""
+        with self.lock:
+            message_ids = []
+            for _ in range(count):
+                message_id = self.message_id(self.size)
+                self.size += 1
+                self._record({'messagesAdded': [
+                    {'message': {'id': message_id, 'labelIds': self.get_label_ids(self.size - 1)}}]})
+                message_ids.append(message_id)
+            return message_ids
+
+    def _record(self, record: Dict[str, Any]) -> None:
+        self.history_id += 1
+        record['id'] = str(self.history_id)
+        self.history.append(record)
+        self.history_ids.append(self.history_id)
+
+    def modify(self, message_ids: List[str], add_label_ids: List[str], remove_label_ids: List[str]) -> None:
+        """Add and remove labels, recording the changes in the history."""
+        with self.lock:
+            for message_id in message_ids:
+                if not self.has_message(message_id):
+                    continue
+                current = set(self.get_label_ids(self.message_index(message_id)))
+                updated = (current | set(add_label_ids)) - set(remove_label_ids)
+                self.label_overrides[message_id] = updated
+                record, message = {}, {'id': message_id, 'labelIds': sorted(updated)}
+                if updated - current:
+                    record['labelsAdded'] = [{'message': message, 'labelIds': sorted(updated - current)}]
+                if current - updated:
+                    record['labelsRemoved'] = [{'message': message, 'labelIds': sorted(current - updated)}]
+                self._record(record)
+
+    def list_history(self, start_history_id: str, page_token: Optional[str], max_results: int) -> Dict[str, Any]:
+        """List the history records after the start history ID."""
+        with self.lock:
+            start = int(page_token) if page_token else bisect.bisect_right(self.history_ids, int(start_history_id))
+            records = self.history[start:start + max_results]
+            response = {'history': records, 'historyId': str(self.history_id)}
+            if start + max_results < len(self.history):
+                response['nextPageToken'] = str(start + max_results)
+        return response
+
+
+class FakeRequest:
+    """Class to represent a single API request, executed alone or in a batch."""
+    def __init__(self, service: 'FakeGmailService', method: str, handler: Callable[[], Any]):
+        self.service = service
+        self.method = method
+        self.handler = handler
+
+    def execute(self, http: Any = None, num_retries: int = 0) -> Any:
+        return self.service.round_trip(self.method, [self])[0]
+
+
+class FakeBatchRequest:
+    """Class to represent a batch HTTP request, calling back with each response or error."""
+    def __init__(self, service: 'FakeGmailService', callback: Callable[[str, Any, Optional[Exception]], None]):
+        self.service = service
+        self.callback = callback
+        self.requests = []
+
+    def add(self, request: FakeRequest, callback: Optional[Callable] = None, request_id: Optional[str] = None) -> None:
+        self.requests.append((request_id or str(len(self.requests)), request, callback or self.callback))
+
+    def execute(self, http: Any = None) -> None:
+        if len(self.requests) > self.service.max_batch_size:
+            raise new_http_error(400, b'Too many requests in batch')
+        results = self.service.round_trip('batch', [request for _, request, _ in self.requests])
+        for (request_id, _, callback), result in zip(self.requests, results):
+            if isinstance(result, HttpError):
+                callback(request_id, None, result)
+            else:
+                callback(request_id, result, None)
+
+
+class FakeResource:
+    """Class to represent a resource collection, calling methods by name."""
+    def __init__(self, methods: Dict[str, Callable[..., Any]]):
+        self.methods = methods
+
+    def __getattr__(self, name: str) -> Callable[..., Any]:
+        try:
+            return self.__dict__['methods'][name]
+        except KeyError:
+            raise AttributeError(name)
+
+
+class FakeGmailService:
+    """
+    Class to fake the Gmail API service of a mailbox.
+    Every round trip, a single request or a whole batch, waits latency_seconds,
+    and every request of error_methods fails with a retryable error with probability error_rate.
+    Round trips are counted and timed by method.
+    """
+    def __init__(
+        self,
+        mailbox: FakeMailbox,
+        latency_seconds: float = 0.0,
+        error_rate: float = 0.0,
+        seed: int = 0,
+        email_address: str = 'bench@example.com',
+        max_batch_size: int = 100,
+        error_methods: Iterable[str] = RETRIED_METHODS
+    ):
+        self.mailbox = mailbox
+        self.latency_seconds = latency_seconds
+        self.error_rate = error_rate
+        self.email_address = email_address
+        self.max_batch_size = max_batch_size
+        self.error_methods = set(error_methods)
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.call_counts = defaultdict(int)
+        self.request_counts = defaultdict(int)
+        self.error_counts = defaultdict(int)
+        self.latencies = defaultdict(list)
+
+    def round_trip(self, method: str, requests: List[FakeRequest]) -> List[Any]:
+        """Serve the requests of one round trip, as responses or HttpError instances for batches."""
+        start = time.perf_counter()
+        if self.latency_seconds:
+            time.sleep(self.latency_seconds)
+        results = []
+        for request in requests:
+            with self.lock:
+                failed = request.method in self.error_methods and self.random.random() < self.error_rate
+                self.request_counts[request.method] += 1
+                if failed:
+                    self.error_counts[request.method] += 1
+            if failed:
+                results.append(new_http_error(*self.random.choice([(429, b'rateLimitExceeded'), (503, b'Backend Error')])))
+                continue
+            try:
+                results.append(request.handler())
+            except HttpError as e:
+                results.append(e)
+        with self.lock:
+            self.call_counts[method] += 1
+            self.latencies[method].append(time.perf_counter() - start)
+        if method != 'batch' and isinstance(results[0], HttpError):
+            raise results[0]
+        return results
+
+    def new_batch_http_request(self, callback: Optional[Callable] = None) -> FakeBatchRequest:
+        return FakeBatchRequest(self, callback)
+
+    def users(self) -> FakeResource:
+        return FakeResource({
+            'getProfile': self._get_profile,
+            'messages': lambda: FakeResource({
+                'list': self._list_messages,
+                'get': self._get_message,
+                'batchModify': self._batch_modify,
+            }),
+            'labels': lambda: FakeResource({'list': self._list_labels, 'create': self._create_label}),
+            'history': lambda: FakeResource({'list': self._list_history}),
+            'watch': lambda **kwargs: FakeRequest(self, 'users.watch', lambda: {
+                'historyId': str(self.mailbox.history_id), 'expiration': '0'}),
+            'stop': lambda **kwargs: FakeRequest(self, 'users.stop', lambda: {}),
+        })
+
+    def _get_profile(self, userId: str) -> FakeRequest:
+        return FakeRequest(self, 'users.getProfile', lambda: {
+            'emailAddress': self.email_address,
+            'messagesTotal': self.mailbox.size,
+            'historyId': str(self.mailbox.history_id),
+        })
+
+    def _list_messages(self, userId: str, pageToken: Optional[str] = None, maxResults: int = 100,
+                       includeSpamTrash: bool = False, q: Optional[str] = None) -> FakeRequest:
+        return FakeRequest(self, 'messages.list', lambda: self.mailbox.list_messages(pageToken, min(maxResults, 500)))
+
+    def _get_message(self, userId: str, id: str, format: str = 'full',
+                     metadataHeaders: Optional[List[str]] = None) -> FakeRequest:
+        def handler() -> Dict[str, Any]:
+            if not self.mailbox.has_message(id):
+                raise new_http_error(404, b'Requested entity was not found.')
+            return self.mailbox.get_message(id, format, metadataHeaders)
+        return FakeRequest(self, 'messages.get', handler)
+
+    def _batch_modify(self, userId: str, body: Dict[str, Any]) -> FakeRequest:
+        def handler() -> Dict[str, Any]:
+            if len(body['ids']) > 1000:
+                raise new_http_error(400, b'Too many ids')
+            self.mailbox.modify(body['ids'], body.get('addLabelIds', []), body.get('removeLabelIds', []))
+            return {}
+        return FakeRequest(self, 'messages.batchModify', handler)
+
+    def _list_labels(self, userId: str) -> FakeRequest:
+        return FakeRequest(self, 'labels.list', lambda: {
+            'labels': [{'id': label_id, 'name': name} for name, label_id in self.mailbox.labels.items()]})
+
+    def _create_label(self, userId: str, body: Dict[str, Any]) -> FakeRequest:
+        def handler() -> Dict[str, Any]:
+            label_id = f'Label_{len(self.mailbox.labels) + 1}'
+            self.mailbox.labels[body['name']] = label_id
+            return {'id': label_id, 'name': body['name']}
+        return FakeRequest(self, 'labels.create', handler)
+
+    def _list_history(self, userId: str, startHistoryId: str, pageToken: Optional[str] = None,
+                      maxResults: int = 100, historyTypes: Optional[List[str]] = None) -> FakeRequest:
+        def handler() -> Dict[str, Any]:
+            if int(startHistoryId) < self.mailbox.first_history_id:
+                raise new_http_error(404, b'Requested entity was not found.')
+            return self.mailbox.list_history(startHistoryId, pageToken, min(maxResults, 500))
+        return FakeRequest(self, 'history.list', handler)
@@ -0,0 +1,286 @@
+"""
+End-to-end benchmarks of email_processor against the local fake Gmail API.
+Each scenario runs in its own process: a full fetch of a synthetic mailbox, the rules over every
+stored email, then an incremental fetch and process of newly delivered messages.
+Results are appended to a JSON lines file, tagged with the git commit, so runs of different
+versions can be compared.
+Run with:
+    python3 benchmarks/run_benchmarks.py run [SCENARIO ...] [--messages N] [--latency-ms MS] [--error-rate RATE]
+    python3 benchmarks/run_benchmarks.py compare [--threshold 0.1]
+"""
+import argparse
+import json
+import logging
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+from typing import Any, Callable, Dict, List, Optional, Tuple
+from unittest.mock import patch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.fake_gmail import FakeGmailService, FakeMailbox  # noqa: E402
+
+RESULTS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results', 'results.jsonl')
+SCENARIOS = {
+    'baseline-10k': {'messages': 10_000, 'new_messages': 500, 'latency_ms': 0, 'error_rate': 0.0},
+    'latency-10k': {'messages': 10_000, 'new_messages': 500, 'latency_ms': 20, 'error_rate': 0.01},
+    'large-100k': {'messages': 100_000, 'new_messages': 1_000, 'latency_ms': 0, 'error_rate': 0.0},
+    'huge-1m': {'messages': 1_000_000, 'new_messages': 5_000, 'latency_ms': 0, 'error_rate': 0.0},
+}
+DEFAULT_SCENARIOS = ['baseline-10k', 'latency-10k']
+DEFAULT_PARAMETERS = {
+    'body_size': 2048,
+    # Far above the Gmail per-user quota, so the client is measured rather than the quota
+    'quota_units_per_second': 1_000_000,
+    'retry_base_delay_seconds': 0.05,
+    'seed': 0,
+}
+BENCHMARK_RULES = [
+    {
+        'name': 'Invoices', 'priority': 1, 'collection_predicate': 'All',
+        'conditions': [
+            {'field': 'subject', 'predicate': 'contains', 'value': 'Invoice'},
+            {'field': 'from_domain', 'predicate': 'equals', 'value': 'shop.example.com'},
+        ],
+        'actions': {'move_to_folder': 'Invoices', 'mark_as_read': True},
+    },
+    {
+        'name': 'Newsletters', 'priority': 2, 'collection_predicate': 'Any',
+        'conditions': [
+            {'field': 'from_address', 'predicate': 'contains', 'value': 'news@'},
+            {'field': 'subject', 'predicate': 'contains', 'value': 'digest'},
+        ],
+        'actions': {'mark_as_read': True},
+    },
+    {
+        'name': 'Reminders', 'priority': 3, 'collection_predicate': 'All',
+        'conditions': [
+            {'field': 'subject', 'predicate': 'contains', 'value': 'Reminder'},
+            {'field': 'body', 'predicate': 'contains', 'value': 'amount due'},
+        ],
+        'actions': {'mark_as_read': False},
+    },
+]
+# Metrics where a larger value is an improvement
+HIGHER_IS_BETTER = ('messages_per_second',)
+
+
+def percentile(values: List[float], fraction: float) -> Optional[float]:
+    """Nearest-rank percentile of the values, None when there are none."""
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, round(fraction * len(ordered)) - 1))]
+
+
+def take_api_stats(service: FakeGmailService) -> Dict[str, Dict[str, Any]]:
+    """Summarize the round trips served by the fake since the last call, then reset its counters."""
+    with service.lock:
+        stats = {
+            method: {
+                'calls': service.call_counts[method],
+                'p50_ms': round(percentile(latencies, 0.5) * 1000, 3),
+                'p99_ms': round(percentile(latencies, 0.99) * 1000, 3),
+            }
+            for method, latencies in service.latencies.items()
+        }
+        for method, count in service.request_counts.items():
+            stats.setdefault(method, {})['requests'] = count
+            stats[method]['errors'] = service.error_counts[method]
+        service.call_counts.clear()
+        service.request_counts.clear()
+        service.error_counts.clear()
+        service.latencies.clear()
+    return stats
+
+
+def timed(function: Callable[[], Any]) -> Tuple[Any, float]:
+    """Call the function, returning its result and wall time in seconds."""
+    start = time.perf_counter()
+    result = function()
+    return result, time.perf_counter() - start
+
+
+def run_scenario(parameters: Dict[str, Any]) -> Dict[str, Any]:
+    """Run one scenario in this process and return its metrics."""
+    import email_processor.service.constants as constants
+    from email_processor.models import emails
+    from email_processor.models.rules import Rule
+    from email_processor.service import process_rules
+    from email_processor.service.fetch_emails import fetch_emails
+
+    logging.basicConfig(level=logging.WARNING)
+    constants.MAX_EMAILS_TO_FETCH = parameters['messages'] + parameters['new_messages']
+    constants.GMAIL_QUOTA_UNITS_PER_SECOND = parameters['quota_units_per_second']
+    constants.RETRY_BASE_DELAY_SECONDS = parameters['retry_base_delay_seconds']
+
+    mailbox = FakeMailbox(parameters['messages'], parameters['body_size'], parameters['seed'], ['Invoices'])
+    service = FakeGmailService(
+        mailbox, parameters['latency_ms'] / 1000, parameters['error_rate'], parameters['seed'])
+    rules = Rule.list_from_json(BENCHMARK_RULES)
+    phases = {}
+
+    def record(phase: str, count: int, seconds: float) -> None:
+        phases[phase] = {
+            'messages': count,
+            'seconds': round(seconds, 3),
+            'messages_per_second': round(count / seconds, 1) if seconds else None,
+            'api': take_api_stats(service),
+        }
+
+    with tempfile.TemporaryDirectory() as directory, \
+            emails.use_database(f"sqlite:///{os.path.join(directory, 'benchmark.db')}"), \
+            patch.object(process_rules, 'get_rules', return_value=rules):
+        emails.create_database()
+
+        fetched_count, seconds = timed(lambda: fetch_emails(service))
+        record('full_fetch', fetched_count, seconds)
+
+        _, seconds = timed(lambda: process_rules.process_emails_for_rule_actions(service))
+        record('process_rules', fetched_count, seconds)
+
+        mailbox.add_messages(parameters['new_messages'])
+        new_count, seconds = timed(lambda: process_rules.fetch_and_process_emails(service))
+        record('incremental', new_count, seconds)
+
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    peak_rss_mb = peak_rss / (1024 * 1024 if sys.platform == 'darwin' else 1024)
+    return {'phases': phases, 'peak_rss_mb': round(peak_rss_mb, 1)}
+
+
+def get_git_revision() -> Dict[str, Any]:
+    """Get the commit of the working tree and whether it has uncommitted changes."""
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    try:
+        commit = subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=root, capture_output=True, text=True, check=True
+        ).stdout.strip()
+        dirty = bool(subprocess.run(
+            ['git', 'status', '--porcelain', '--untracked-files=no'], cwd=root, capture_output=True, text=True
+        ).stdout.strip())
+        return {'commit': commit, 'dirty': dirty}
+    except (OSError, subprocess.CalledProcessError):
+        return {'commit': 'unknown', 'dirty': None}
+
+
+def run(args: argparse.Namespace) -> None:
+    """Run the scenarios, each in a fresh process so peak RSS is its own, and store the results."""
+    overrides = {
+        key: value for key, value in vars(args).items()
+        if key in ['messages', 'new_messages', 'latency_ms', 'error_rate', 'body_size'] and value is not None
+    }
+    revision = get_git_revision()
+    os.makedirs(os.path.dirname(args.results), exist_ok=True)
+    for name in args.scenarios or DEFAULT_SCENARIOS:
+        if name not in SCENARIOS:
+            raise SystemExit(f"Unknown scenario '{name}', expected one of {', '.join(SCENARIOS)}")
+        parameters = {**DEFAULT_PARAMETERS, **SCENARIOS[name], **overrides}
+        print(f"Running {name}: {parameters}", flush=True)
+        completed = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), '_scenario', json.dumps(parameters)],
+            capture_output=True, text=True)
+        if completed.returncode != 0:
+            print(completed.stderr, file=sys.stderr)
+            raise SystemExit(f"Scenario {name} failed")
+        result = {
+            'scenario': name,
+            'timestamp': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+            **revision,
+            'python': platform.python_version(),
+            'parameters': parameters,
+            **json.loads(completed.stdout.strip().splitlines()[-1]),
+        }
+        with open(args.results, 'a') as results_file:
+            results_file.write(json.dumps(result) + '\n')
+        print_result(result)
+
+
+def print_result(result: Dict[str, Any]) -> None:
+    """Print the metrics of one run."""
+    print(f"  peak RSS: {result['peak_rss_mb']} MB")
+    for phase, metrics in result['phases'].items():
+        print(f"  {phase}: {metrics['messages']} messages in {metrics['seconds']}s "
+              f"({metrics['messages_per_second']} messages/s)")
+        for method, api in sorted(metrics['api'].items()):
+            details = []
+            if 'calls' in api:
+                details.append(f"{api['calls']} round trips, p50 {api['p50_ms']} ms, p99 {api['p99_ms']} ms")
+            if 'requests' in api:
+                details.append(f"{api['requests']} requests, {api['errors']} errors")
+            print(f"    {method}: {', '.join(details)}")
+
+
+def flatten_metrics(result: Dict[str, Any]) -> Dict[str, float]:
+    """Flatten the comparable metrics of a run into dotted names."""
+    metrics = {'peak_rss_mb': result['peak_rss_mb']}
+    for phase, phase_metrics in result['phases'].items():
+        for name in ['seconds', 'messages_per_second']:
+            metrics[f'{phase}.{name}'] = phase_metrics[name]
+        for method, api in phase_metrics['api'].items():
+            metrics[f'{phase}.{method}.calls'] = api.get('calls')
+            metrics[f'{phase}.{method}.requests'] = api.get('requests')
+    return metrics
+
+
+def compare(args: argparse.Namespace) -> None:
+    """Compare the last run of each scenario with the run before it, flagging regressions."""
+    with open(args.results) as results_file:
+        results = [json.loads(line) for line in results_file if line.strip()]
+    regressions = 0
+    for name in dict.fromkeys(result['scenario'] for result in results):
+        runs = [result for result in results if result['scenario'] == name]
+        if len(runs) < 2:
+            print(f"{name}: a single run, nothing to compare")
+            continue
+        previous, latest = runs[-2], runs[-1]
+        print(f"{name}: {previous['commit']} ({previous['timestamp']}) -> {latest['commit']} ({latest['timestamp']})")
+        if previous['parameters'] != latest['parameters']:
+            print("  parameters differ, results are not comparable")
+            continue
+        previous_metrics, latest_metrics = flatten_metrics(previous), flatten_metrics(latest)
+        for metric, latest_value in latest_metrics.items():
+            previous_value = previous_metrics.get(metric)
+            if not previous_value or latest_value is None:
+                continue
+            change = (latest_value - previous_value) / previous_value
+            worse = -change if metric.endswith(HIGHER_IS_BETTER) else change
+            flag = '  REGRESSION' if worse > args.threshold else ''
+            regressions += bool(flag)
+            print(f"  {metric}: {previous_value} -> {latest_value} ({change:+.1%}){flag}")
+    if regressions:
+        raise SystemExit(f"{regressions} metrics regressed by more than {args.threshold:.0%}")
+
+
+def main() -> None:
+    if len(sys.argv) == 3 and sys.argv[1] == '_scenario':
+        print(json.dumps(run_scenario(json.loads(sys.argv[2]))))
+        return
+
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    run_parser = subparsers.add_parser('run', help='run scenarios and store their results')
+    run_parser.add_argument('scenarios', nargs='*', help=f"scenarios among {', '.join(SCENARIOS)}")
+    run_parser.add_argument('--messages', type=int, help='messages in the mailbox')
+    run_parser.add_argument('--new-messages', type=int, help='messages delivered before the incremental sync')
+    run_parser.add_argument('--latency-ms', type=float, help='latency of every API round trip')
+    run_parser.add_argument('--error-rate', type=float, help='probability of a retryable error per request the client retries')
+    run_parser.add_argument('--body-size', type=int, help='characters of each message body')
+    run_parser.add_argument('--results', default=RESULTS_PATH, help='JSON lines file the results are appended to')
+    run_parser.set_defaults(handler=run)
+    compare_parser = subparsers.add_parser('compare', help='compare the last two runs of each scenario')
+    compare_parser.add_argument('--threshold', type=float, default=0.1, help='relative change flagged as regression')
+    compare_parser.add_argument('--results', default=RESULTS_PATH, help='JSON lines file of the results')
+    compare_parser.set_defaults(handler=compare)
+    args = parser.parse_args()
+    args.handler(args)
+
+
+if __name__ == '__main__':
+    main()
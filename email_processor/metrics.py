@@ -0,0 +1,318 @@
+import bisect
+import cProfile
+import json
+import logging
+import os
+import pstats
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+METRICS_PREFIX = 'email_processor_'
+# Histogram buckets of durations in seconds and of batch sizes
+LATENCY_BUCKETS = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30]
+SIZE_BUCKETS = [1, 5, 10, 25, 50, 100, 250, 500, 1000]
+# Path of the JSON summary of each run, and of the Prometheus text file, none written when not set
+METRICS_SUMMARY_PATH = os.getenv("EMAIL_PROCESSOR_METRICS_FILE")
+METRICS_PROMETHEUS_PATH = os.getenv("EMAIL_PROCESSOR_PROMETHEUS_FILE")
+# Path of the cProfile stats of each run, 'True' for the default path, no profiling when not set
+PROFILE_PATH = os.getenv("EMAIL_PROCESSOR_PROFILE")
+if PROFILE_PATH == "True":
+    PROFILE_PATH = "email_processor.prof"
+elif PROFILE_PATH in ("", "False"):
+    PROFILE_PATH = None
+
+# Before Python 3.12 a profiler only sees the thread it is enabled in, so each thread gets its own.
+# From 3.12 on only one profiler can be active at a time, and only the calling thread is profiled.
+PROFILE_EACH_THREAD = sys.version_info < (3, 12)
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+class Histogram:
+    """Class to represent the distribution of observed values, counted in cumulative buckets."""
+    def __init__(self, buckets: List[float]):
+        """Initialize an empty histogram."""
+        self.buckets = buckets
+        self.bucket_counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value: float) -> None:
+        """Add a value to the histogram."""
+        self.bucket_counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def quantile(self, q: float) -> float:
+        """
+        Estimate a quantile of the observed values, interpolated within its bucket like Prometheus does.
+        Parameters:
+            q: float - quantile between 0 and 1
+        """
+        if not self.count:
+            return 0.0
+        rank, seen = q * self.count, 0
+        for index, bucket_count in enumerate(self.bucket_counts):
+            if bucket_count and seen + bucket_count >= rank:
+                lower = self.buckets[index - 1] if index else 0.0
+                upper = self.buckets[index] if index < len(self.buckets) else self.max
+                return min(self.max, lower + (upper - lower) * (rank - seen) / bucket_count)
+            seen += bucket_count
+        return self.max
+
+
+class MetricsRegistry:
+    """
+    Class to collect the counters and histograms of a process, shared between threads.
+    Metrics are identified by a name and label values, e.g. the Gmail API method of a request.
+    """
+    def __init__(self):
+        """Initialize an empty registry."""
+        self.counters: Dict[str, Dict[Labels, float]] = {}
+        self.histograms: Dict[str, Dict[Labels, Histogram]] = {}
+        self.lock = threading.Lock()
+
+    def increment(self, name: str, amount: Optional[float]=1, **labels: Any) -> None:
+        """
+        Add the amount to a counter.
+        Parameters:
+            name: str - counter name
+            amount: float - amount to add
+            labels: Any - label values of the counter
+        """
+        key = label_key(labels)
+        with self.lock:
+            series = self.counters.setdefault(name, {})
+            series[key] = series.get(key, 0) + amount
+
+    def observe(self, name: str, value: float, buckets: Optional[List[float]]=LATENCY_BUCKETS, **labels: Any) -> None:
+        """
+        Add a value to a histogram.
+        Parameters:
+            name: str - histogram name
+            value: float - observed value
+            buckets: List[float] - upper bounds of the histogram buckets, used when it is created
+            labels: Any - label values of the histogram
+        """
+        key = label_key(labels)
+        with self.lock:
+            series = self.histograms.setdefault(name, {})
+            if key not in series:
+                series[key] = Histogram(buckets)
+            series[key].observe(value)
+
+    @contextmanager
+    def timer(self, name: str, **labels: Any) -> Iterator[None]:
+        """
+        Observe the duration of the block in seconds, whether it raises or not.
+        Parameters:
+            name: str - histogram name
+            labels: Any - label values of the histogram
+        """
+        started_at = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started_at, **labels)
+
+    def reset(self) -> None:
+        """Drop every metric collected so far."""
+        with self.lock:
+            self.counters.clear()
+            self.histograms.clear()
+
+    def to_prometheus(self) -> str:
+        """Export the metrics in the Prometheus text exposition format."""
+        lines = []
+        with self.lock:
+            for name, series in sorted(self.counters.items()):
+                lines.append(f'# TYPE {METRICS_PREFIX}{name} counter')
+                for key, value in sorted(series.items()):
+                    lines.append(f'{METRICS_PREFIX}{name}{format_labels(key)} {value:g}')
+            for name, series in sorted(self.histograms.items()):
+                lines.append(f'# TYPE {METRICS_PREFIX}{name} histogram')
+                for key, histogram in sorted(series.items()):
+                    cumulative = 0
+                    for bound, bucket_count in zip(histogram.buckets + ['+Inf'], histogram.bucket_counts):
+                        cumulative += bucket_count
+                        bucket_key = key + (('le', bound if isinstance(bound, str) else f'{bound:g}'),)
+                        lines.append(f'{METRICS_PREFIX}{name}_bucket{format_labels(bucket_key)} {cumulative}')
+                    lines.append(f'{METRICS_PREFIX}{name}_sum{format_labels(key)} {histogram.sum:g}')
+                    lines.append(f'{METRICS_PREFIX}{name}_count{format_labels(key)} {histogram.count}')
+        return '\n'.join(lines) + '\n'
+
+    def summary(self) -> Dict[str, Any]:
+        """Export the metrics as a JSON serializable summary, with the count, sum and quantiles of histograms."""
+        with self.lock:
+            return {
+                'counters': {
+                    name: [{'labels': dict(key), 'value': value} for key, value in sorted(series.items())]
+                    for name, series in sorted(self.counters.items())
+                },
+                'histograms': {
+                    name: [
+                        {
+                            'labels': dict(key),
+                            'count': histogram.count,
+                            'sum': round(histogram.sum, 6),
+                            'p50': round(histogram.quantile(0.5), 6),
+                            'p99': round(histogram.quantile(0.99), 6),
+                            'max': round(histogram.max, 6),
+                        }
+                        for key, histogram in sorted(series.items())
+                    ]
+                    for name, series in sorted(self.histograms.items())
+                },
+            }
+
+    def write_reports(
+        self,
+        summary_path: Optional[str]=None,
+        prometheus_path: Optional[str]=None,
+        run_info: Optional[Dict[str, Any]]=None
+    ) -> None:
+        """
+        Write the JSON summary and the Prometheus text file of the metrics, when their path is set.
+        Files are replaced atomically, so a scraper never reads a partial file.
+        Parameters:
+            summary_path: str - path of the JSON summary
+            prometheus_path: str - path of the Prometheus text file
+            run_info: Dict[str, Any] - fields added to the JSON summary, e.g. the run duration
+        """
+        if summary_path:
+            write_file_atomically(summary_path, json.dumps({**(run_info or {}), **self.summary()}, indent=2))
+        if prometheus_path:
+            write_file_atomically(prometheus_path, self.to_prometheus())
+
+
+def label_key(labels: Dict[str, Any]) -> Labels:
+    """
+    Get the key of a metric series from its label values, the same whatever their order.
+    Parameters:
+        labels: Dict[str, Any] - label values of the series
+    """
+    return tuple(sorted((label, str(label_value)) for label, label_value in labels.items()))
+
+
+def format_labels(key: Labels) -> str:
+    """
+    Format label values the way Prometheus expects them, e.g. '{method="messages.get"}'.
+    Parameters:
+        key: Labels - sorted label name and value pairs
+    """
+    if not key:
+        return ''
+    escaped = (
+        (label, value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')) for label, value in key)
+    return '{' + ','.join(f'{label}="{value}"' for label, value in escaped) + '}'
+
+
+def write_file_atomically(path: str, content: str) -> None:
+    """
+    Write the content to a temporary file, then move it over the given path.
+    Parameters:
+        path: str - path of the file
+        content: str - content of the file
+    """
+    temporary_path = f'{path}.tmp'
+    with open(temporary_path, 'w') as file:
+        file.write(content)
+    os.replace(temporary_path, path)
+
+
+# Metrics of the process, collected by every module
+METRICS = MetricsRegistry()
+
+
+class Profiler:
+    """
+    Class to profile a block of code with cProfile, in the calling thread and, before Python 3.12,
+    in the threads it starts.
+    Each new thread enables its own profiler and disables it when it ends, and the profiles are merged
+    once the block ends. Threads still running by then are left out, their profiles can't be stopped.
+    """
+    def __init__(self, profile_each_thread: Optional[bool]=PROFILE_EACH_THREAD):
+        """Initialize the profiler."""
+        self.profile_each_thread = profile_each_thread
+        self.profiles: List[cProfile.Profile] = []
+        self.lock = threading.Lock()
+
+    def _profile_run(self, run: Any) -> Any:
+        # Wraps Thread.run, so each thread enables and disables its own profiler
+        profiler = self
+
+        def profiled_run(thread: threading.Thread) -> None:
+            profile = cProfile.Profile()
+            profile.enable()
+            try:
+                run(thread)
+            finally:
+                profile.disable()
+                with profiler.lock:
+                    profiler.profiles.append(profile)
+        return profiled_run
+
+    @contextmanager
+    def profile(self) -> Iterator[None]:
+        """Profile the block of code."""
+        main_profile = cProfile.Profile()
+        run = threading.Thread.run
+        if self.profile_each_thread:
+            threading.Thread.run = self._profile_run(run)
+        main_profile.enable()
+        try:
+            yield
+        finally:
+            main_profile.disable()
+            threading.Thread.run = run
+            with self.lock:
+                self.profiles.append(main_profile)
+
+    def dump_stats(self, path: str) -> None:
+        """
+        Merge the profiles of all the threads and write them to a file readable by pstats.
+        Parameters:
+            path: str - path of the stats file
+        """
+        with self.lock:
+            stats = pstats.Stats(*self.profiles)
+        stats.dump_stats(path)
+
+
+@contextmanager
+def instrumented_run(
+    run_name: str,
+    summary_path: Optional[str]=METRICS_SUMMARY_PATH,
+    prometheus_path: Optional[str]=METRICS_PROMETHEUS_PATH,
+    profile_path: Optional[str]=PROFILE_PATH
+) -> Iterator[None]:
+    """
+    Instrument a run of the email processor: profile it with cProfile if profile_path is set,
+    then write the reports of the metrics it collected, whether it succeeds or not.
+    Parameters:
+        run_name: str - name of the run, e.g. 'fetch-emails'
+        summary_path: str - path of the JSON summary of the run
+        prometheus_path: str - path of the Prometheus text file of the run
+        profile_path: str - path of the cProfile stats of the run
+    """
+    profiler = Profiler() if profile_path else None
+    started_at = time.time()
+    try:
+        if profiler is None:
+            yield
+        else:
+            with profiler.profile():
+                yield
+    finally:
+        duration_seconds = round(time.time() - started_at, 3)
+        METRICS.write_reports(summary_path, prometheus_path, {
+            'run': run_name, 'started_at': started_at, 'duration_seconds': duration_seconds})
+        logging.info(f"Run {run_name} took {duration_seconds}s")
+        if profiler is not None:
+            profiler.dump_stats(profile_path)
+            logging.info(f"Profile of run {run_name} written to {profile_path}, read it with 'python -m pstats'")
@@ -0,0 +1,159 @@
+import hashlib
+import logging
+import threading
+import zlib
+from functools import lru_cache
+from typing import Any, Dict, Optional, Tuple
+from email_processor.models.constants import (
+    BODY_STORE_CODEC,
+    BODY_STORE_CODEC_ZLIB,
+    BODY_STORE_CODEC_ZSTD,
+    BODY_STORE_DICTIONARY_PATH,
+    BODY_STORE_ZLIB_LEVEL,
+    BODY_STORE_ZSTD_LEVEL,
+)
+
+BODY_ENCODING = 'utf-8'
+# Dictionaries by ID, the ID being a short hash of the dictionary content
+_DICTIONARIES: Dict[str, bytes] = {}
+_DICTIONARIES_LOCK = threading.Lock()
+# zstd compressors and decompressors are not thread safe, each thread keeps its own
+_LOCAL = threading.local()
+
+
+def hash_body(body: str) -> str:
+    """
+    Get the content hash identifying a body in the body store.
+    Parameters:
+        body: str - email body
+    """
+    return hashlib.sha256(body.encode(BODY_ENCODING)).hexdigest()
+
+
+def register_dictionary(dictionary: bytes) -> str:
+    """
+    Register a compression dictionary, returning its ID.
+    Parameters:
+        dictionary: bytes - dictionary content, e.g. trained with 'zstd --train' or sample bodies for zlib
+    """
+    dictionary_id = hashlib.sha256(dictionary).hexdigest()[:16]
+    with _DICTIONARIES_LOCK:
+        _DICTIONARIES[dictionary_id] = dictionary
+    return dictionary_id
+
+
+def load_dictionary(path: Optional[str]=BODY_STORE_DICTIONARY_PATH) -> Optional[str]:
+    """
+    Load and register the compression dictionary file, returning its ID, None when no path is set.
+    Parameters:
+        path: str - path of the dictionary file
+    """
+    if not path:
+        return None
+    with open(path, 'rb') as file:
+        return register_dictionary(file.read())
+
+
+@lru_cache(maxsize=None)
+def get_configured_dictionary_id() -> Optional[str]:
+    """Get the ID of the dictionary set in BODY_STORE_DICTIONARY_PATH, loaded on first use."""
+    return load_dictionary()
+
+
+def get_dictionary(dictionary_id: Optional[str]) -> Optional[bytes]:
+    """
+    Get a registered compression dictionary.
+    Raises ValueError when bodies were compressed with a dictionary that is not loaded.
+    Parameters:
+        dictionary_id: str - ID of the dictionary, None for no dictionary
+    """
+    if dictionary_id is None:
+        return None
+    if dictionary_id not in _DICTIONARIES:
+        get_configured_dictionary_id()
+    with _DICTIONARIES_LOCK:
+        if dictionary_id not in _DICTIONARIES:
+            raise ValueError(
+                f"Compression dictionary {dictionary_id} is not loaded, set BODY_STORE_DICTIONARY_PATH to it")
+        return _DICTIONARIES[dictionary_id]
+
+
+def _get_zstd_codec(kind: str, dictionary_id: Optional[str]) -> Any:
+    try:
+        import zstandard
+    except ImportError:
+        raise ImportError("zstandard is required for the zstd body codec: pip install zstandard")
+    codecs = _LOCAL.__dict__.setdefault('zstd_codecs', {})
+    if (kind, dictionary_id) not in codecs:
+        dictionary = get_dictionary(dictionary_id)
+        dict_data = zstandard.ZstdCompressionDict(dictionary) if dictionary is not None else None
+        if kind == 'compressor':
+            codecs[(kind, dictionary_id)] = zstandard.ZstdCompressor(level=BODY_STORE_ZSTD_LEVEL, dict_data=dict_data)
+        else:
+            codecs[(kind, dictionary_id)] = zstandard.ZstdDecompressor(dict_data=dict_data)
+    return codecs[(kind, dictionary_id)]
+
+
+def compress_body(
+    body: str,
+    codec: Optional[str]=BODY_STORE_CODEC,
+    dictionary_id: Optional[str]=None
+) -> bytes:
+    """
+    Compress a body with the given codec and dictionary.
+    Parameters:
+        body: str - email body
+        codec: str - 'zlib' or 'zstd'
+        dictionary_id: str - ID of a registered dictionary, None for no dictionary
+    """
+    data = body.encode(BODY_ENCODING)
+    if codec == BODY_STORE_CODEC_ZLIB:
+        dictionary = get_dictionary(dictionary_id)
+        compressor = zlib.compressobj(BODY_STORE_ZLIB_LEVEL, zdict=dictionary) if dictionary else zlib.compressobj(
+            BODY_STORE_ZLIB_LEVEL)
+        return compressor.compress(data) + compressor.flush()
+    elif codec == BODY_STORE_CODEC_ZSTD:
+        return _get_zstd_codec('compressor', dictionary_id).compress(data)
+    raise ValueError(f"Unknown body codec '{codec}', expected '{BODY_STORE_CODEC_ZLIB}' or '{BODY_STORE_CODEC_ZSTD}'")
+
+
+def decompress_body(codec: str, dictionary_id: Optional[str], data: bytes) -> str:
+    """
+    Decompress a body of the body store.
+    Parameters:
+        codec: str - codec the body was compressed with
+        dictionary_id: str - ID of the dictionary the body was compressed with, None for no dictionary
+        data: bytes - compressed body
+    """
+    if codec == BODY_STORE_CODEC_ZLIB:
+        dictionary = get_dictionary(dictionary_id)
+        decompressor = zlib.decompressobj(zdict=dictionary) if dictionary else zlib.decompressobj()
+        return (decompressor.decompress(data) + decompressor.flush()).decode(BODY_ENCODING)
+    elif codec == BODY_STORE_CODEC_ZSTD:
+        return _get_zstd_codec('decompressor', dictionary_id).decompress(data).decode(BODY_ENCODING)
+    raise ValueError(f"Unknown body codec '{codec}', expected '{BODY_STORE_CODEC_ZLIB}' or '{BODY_STORE_CODEC_ZSTD}'")
+
+
+def decompress_body_sql(codec: Optional[str], dictionary_id: Optional[str], data: Optional[bytes]) -> Optional[str]:
+    """
+    Decompress a body from SQL, registered as a SQLite function, None for a missing body.
+    Errors are logged, since SQLite only reports that the function raised.
+    """
+    if data is None:
+        return None
+    try:
+        return decompress_body(codec, dictionary_id, data)
+    except Exception as e:
+        logging.error(f"An error occurred while decompressing a body: {e}")
+        raise e
+
+
+def compress_body_for_store(body: str) -> Tuple[str, Optional[str], bytes]:
+    """
+    Compress a body with the configured codec and dictionary.
+    Returns the codec, the dictionary ID and the compressed body.
+    Parameters:
+        body: str - email body
+    """
+    dictionary_id = get_configured_dictionary_id()
+    return BODY_STORE_CODEC, dictionary_id, compress_body(body, BODY_STORE_CODEC, dictionary_id)
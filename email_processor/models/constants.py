@@ -10,7 +10,64 @@ elif SQLALCHEMY_ECHO_MODE == "debug":
 else:
     SQLALCHEMY_ECHO_MODE = False
 
-DATABASE_URL = "sqlite:///email.db"
+DATABASE_URL = os.getenv("EMAIL_PROCESSOR_DATABASE_URL", "sqlite:///email.db")
+# Set on every SQLite connection: WAL lets readers run while a batch is written,
+# and writers wait up to busy_timeout milliseconds for the write lock instead of failing
+SQLITE_PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'busy_timeout': 30000,
+    'cache_size': -64000,
+    'temp_store': 'MEMORY',
+}
+# Connection pool of server databases, e.g. PostgreSQL, sized for the worker threads writing at once
+DB_POOL_SIZE = int(os.getenv("EMAIL_PROCESSOR_DB_POOL_SIZE", "10"))
+DB_POOL_MAX_OVERFLOW = int(os.getenv("EMAIL_PROCESSOR_DB_POOL_MAX_OVERFLOW", "10"))
+DB_POOL_TIMEOUT_SECONDS = 30
+DB_POOL_RECYCLE_SECONDS = 30 * 60
+# Databases where LIKE ignores case, others use ILIKE for 'contains' conditions
+CASE_INSENSITIVE_LIKE_DIALECTS = ['sqlite']
+FULLTEXT_TABLE_NAME = 'emails_fts'
+# Body store, keeping bodies compressed and deduplicated by content hash in a side table.
+# SQLite only, PostgreSQL already compresses large values itself
+BODY_STORE_ENABLED = os.getenv("EMAIL_PROCESSOR_BODY_STORE") == "True"
+BODY_STORE_DIALECTS = ['sqlite']
+BODY_STORE_TABLE_NAME = 'email_bodies'
+# SQL function decompressing a stored body, registered on every SQLite connection
+BODY_STORE_SQL_FUNCTION = 'email_body'
+BODY_STORE_CODEC_ZLIB = 'zlib'
+BODY_STORE_CODEC_ZSTD = 'zstd'
+# 'zstd' requires pip install zstandard
+BODY_STORE_CODEC = os.getenv("EMAIL_PROCESSOR_BODY_CODEC", BODY_STORE_CODEC_ZLIB)
+# Optional compression dictionary, e.g. trained on sample bodies with 'zstd --train'
+BODY_STORE_DICTIONARY_PATH = os.getenv("EMAIL_PROCESSOR_BODY_DICTIONARY")
+BODY_STORE_ZLIB_LEVEL = 6
+BODY_STORE_ZSTD_LEVEL = 3
+# Shorter bodies are kept inline, compressing them saves next to nothing
+BODY_STORE_MIN_LENGTH = 256
+# SQLite user_version once the bodies stored inline by an older version were moved to the body store,
+# reset while the body store is disabled, so the emails table is scanned again only when bodies may remain
+BODY_STORE_SCHEMA_VERSION = 1
+# Filename, MIME type and size of the attachments of each email, their contents are never stored
+ATTACHMENTS_TABLE_NAME = 'email_attachments'
+# Rule match cache, keeping the emails matched by each rule and the last email it was evaluated on
+RULE_MATCHES_TABLE_NAME = 'rule_matches'
+RULE_STALE_EMAILS_TABLE_NAME = 'rule_stale_emails'
+# Bump when the rule evaluation semantics change, to evaluate every rule again
+RULE_MATCH_CACHE_VERSION = 1
+LABEL_IDS_SEPARATOR = ','
+# Databases whose rule semantics the in-process evaluator reproduces: LIKE and lower() folding ASCII case only.
+# Others, like PostgreSQL folding Unicode case, evaluate the rules on the stored emails
+IN_PROCESS_EVALUATION_DIALECTS = ['sqlite']
+# Maximum number of message IDs bound in a single IN clause
+QUERY_MESSAGE_IDS_CHUNK_SIZE = 500
+# Rows fetched at once from the cursor of streamed queries, a server-side cursor on PostgreSQL
+QUERY_YIELD_PER_SIZE = 1000
+ACTION_STATUS_PENDING = 'pending'
+ACTION_STATUS_DONE = 'done'
+ACTION_STATUS_FAILED = 'failed'
+# Trigram tokens match any substring of at least 3 characters, like LIKE '%value%'
+FULLTEXT_MIN_VALUE_LENGTH = 3
 DATETIME_FORMAT = '%d-%m-%Y'
 RULE_ACTION_MOVE_TO_FOLDER = "move_to_folder"
 RULE_ACTION_MARK_AS_READ = "mark_as_read"
@@ -22,6 +79,10 @@ RULE_COLLECTION_PREDICATES = [RULE_COLLECTION_PREDICATE_ALL, RULE_COLLECTION_PRE
 RULE_KEY_CONDITIONS = 'conditions'
 RULE_KEY_ACTIONS = 'actions'
 RULE_KEYS = [RULE_KEY_COLLECTION_PREDICATE, RULE_KEY_CONDITIONS, RULE_KEY_ACTIONS]
+RULE_KEY_NAME = 'name'
+RULE_KEY_PRIORITY = 'priority'
+RULE_KEY_STOP_PROCESSING = 'stop_processing'
+RULE_DEFAULT_PRIORITY = 0
 RULE_CONDITION_KEY_FIELD = 'field'
 RULE_CONDITION_KEY_PREDICATE = 'predicate'
 RULE_CONDITION_KEY_VALUE = 'value'
@@ -35,18 +96,49 @@ RULE_FIELD_TO_ADDRESS = 'to_address'
 RULE_FIELD_SUBJECT = 'subject'
 RULE_FIELD_RECEIVED_DATE = 'received_date'
 RULE_FIELD_BODY = 'body'
-RULE_FIELDS = [RULE_FIELD_FROM_ADDRESS, RULE_FIELD_TO_ADDRESS, RULE_FIELD_SUBJECT, RULE_FIELD_RECEIVED_DATE, RULE_FIELD_BODY]
-RULE_STRING_FIELDS = [RULE_FIELD_FROM_ADDRESS, RULE_FIELD_TO_ADDRESS, RULE_FIELD_SUBJECT, RULE_FIELD_BODY]
+RULE_FIELD_FROM_DOMAIN = 'from_domain'
+RULE_FIELD_HAS_ATTACHMENT = 'has_attachment'
+RULE_FIELD_ATTACHMENT_TYPE = 'attachment_type'
+RULE_FIELD_ATTACHMENT_NAME = 'attachment_name'
+RULE_FIELD_ATTACHMENT_SIZE = 'attachment_size'
+RULE_FIELDS = [
+    RULE_FIELD_FROM_ADDRESS,
+    RULE_FIELD_TO_ADDRESS,
+    RULE_FIELD_SUBJECT,
+    RULE_FIELD_RECEIVED_DATE,
+    RULE_FIELD_BODY,
+    RULE_FIELD_FROM_DOMAIN,
+    RULE_FIELD_HAS_ATTACHMENT,
+    RULE_FIELD_ATTACHMENT_TYPE,
+    RULE_FIELD_ATTACHMENT_NAME,
+    RULE_FIELD_ATTACHMENT_SIZE
+]
+# Fields matched against the attachments of an email, any attachment matching makes the condition true
+RULE_ATTACHMENT_FIELDS = [
+    RULE_FIELD_HAS_ATTACHMENT, RULE_FIELD_ATTACHMENT_TYPE, RULE_FIELD_ATTACHMENT_NAME, RULE_FIELD_ATTACHMENT_SIZE]
+RULE_ATTACHMENT_STRING_FIELDS = [RULE_FIELD_ATTACHMENT_TYPE, RULE_FIELD_ATTACHMENT_NAME]
+# Fields only known once the full message is fetched, emails fetched in metadata format are hydrated for them
+RULE_FULL_MESSAGE_FIELDS = [RULE_FIELD_BODY] + RULE_ATTACHMENT_FIELDS
+# Columns rule conditions read, an email whose columns change must be evaluated again
+RULE_MATCH_COLUMNS = RULE_FIELDS + ['from_email', 'body_id', 'attachment_count']
+RULE_STRING_FIELDS = [RULE_FIELD_FROM_ADDRESS, RULE_FIELD_TO_ADDRESS, RULE_FIELD_SUBJECT, RULE_FIELD_BODY, RULE_FIELD_FROM_DOMAIN]
+RULE_FULLTEXT_FIELDS = [RULE_FIELD_SUBJECT, RULE_FIELD_BODY]
 RULE_PREDICATE_CONTAINS = 'contains'
 RULE_PREDICATE_DOES_NOT_CONTAIN = 'does not contain'
 RULE_PREDICATE_GREATER_THAN = 'gt'
 RULE_PREDICATE_GREATER_THAN_EQUAL_TO = 'gte'
 RULE_PREDICATE_LESSER_THAN = 'lt'
 RULE_PREDICATE_LESSER_THAN_EQUAL_TO = 'lte'
-RULE_STRING_FIELDS_PREDICATES = [RULE_PREDICATE_CONTAINS, RULE_PREDICATE_DOES_NOT_CONTAIN]
+RULE_PREDICATE_EQUALS = 'equals'
+RULE_PREDICATE_DOES_NOT_EQUAL = 'does not equal'
+RULE_CONTAINS_PREDICATES = [RULE_PREDICATE_CONTAINS, RULE_PREDICATE_DOES_NOT_CONTAIN]
+RULE_EQUALS_PREDICATES = [RULE_PREDICATE_EQUALS, RULE_PREDICATE_DOES_NOT_EQUAL]
+RULE_STRING_FIELDS_PREDICATES = RULE_CONTAINS_PREDICATES + RULE_EQUALS_PREDICATES
 RULE_RECEIVED_DATE_PREDICATES = [
     RULE_PREDICATE_GREATER_THAN,
     RULE_PREDICATE_GREATER_THAN_EQUAL_TO,
     RULE_PREDICATE_LESSER_THAN,
     RULE_PREDICATE_LESSER_THAN_EQUAL_TO
-]
\ No newline at end of file
+]
+# Sizes of attachments are compared in bytes
+RULE_ATTACHMENT_SIZE_PREDICATES = RULE_RECEIVED_DATE_PREDICATES
@@ -1,16 +1,77 @@
+import email.utils
 import logging
-from typing import Any
-from sqlalchemy import create_engine, Column, Integer, String, DateTime, Text
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime, timedelta
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Set, Tuple
+from sqlalchemy import (
+    bindparam, create_engine, delete, event, func, insert, inspect, make_url, select, text, update,
+    Column, ForeignKey, Index, Integer, LargeBinary, String, DateTime, Text
+)
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.engine import Engine
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
-from email_processor.models.constants import DATABASE_URL, SQLALCHEMY_ECHO_MODE
-from email_processor.models.query import fetch_email_ids
+from sqlalchemy.orm import Session, sessionmaker
+from email_processor.metrics import METRICS, SIZE_BUCKETS
+from email_processor.models.bodies import compress_body_for_store, decompress_body_sql, hash_body
+from email_processor.models.constants import (
+    ACTION_STATUS_DONE,
+    ACTION_STATUS_FAILED,
+    ACTION_STATUS_PENDING,
+    ATTACHMENTS_TABLE_NAME,
+    BODY_STORE_DIALECTS,
+    BODY_STORE_ENABLED,
+    BODY_STORE_MIN_LENGTH,
+    BODY_STORE_SCHEMA_VERSION,
+    BODY_STORE_SQL_FUNCTION,
+    BODY_STORE_TABLE_NAME,
+    DATABASE_URL,
+    DB_POOL_MAX_OVERFLOW,
+    DB_POOL_RECYCLE_SECONDS,
+    DB_POOL_SIZE,
+    DB_POOL_TIMEOUT_SECONDS,
+    FULLTEXT_TABLE_NAME,
+    LABEL_IDS_SEPARATOR,
+    QUERY_MESSAGE_IDS_CHUNK_SIZE,
+    RULE_FULLTEXT_FIELDS,
+    RULE_MATCH_COLUMNS,
+    RULE_MATCHES_TABLE_NAME,
+    RULE_STALE_EMAILS_TABLE_NAME,
+    SQLALCHEMY_ECHO_MODE,
+    SQLITE_PRAGMAS,
+)
+from email_processor.models.query import (
+    evaluate_rule_matches,
+    fetch_email_ids,
+    fetch_rule_matches,
+    fetch_unhydrated_email_ids,
+    stream_cached_rule_matches,
+    stream_email_ids,
+    stream_rule_matches,
+)
 from email_processor.models.rules import Rule
 
 
 BASE = declarative_base()
 
 
+class EmailBody(BASE):
+    """Class to represent a compressed email body of the body store, shared by the emails with this body."""
+    __tablename__ = BODY_STORE_TABLE_NAME
+
+    id = Column(Integer, primary_key=True)
+    # SHA-256 of the decompressed body, identical bodies are stored once
+    content_hash = Column(String, unique=True, nullable=False)
+    codec = Column(String, nullable=False)
+    # ID of the compression dictionary, NULL when compressed without one
+    dictionary_id = Column(String)
+    data = Column(LargeBinary, nullable=False)
+
+
 class EmailMessage(BASE):
     """Class to represent email messages."""
     __tablename__ = 'emails'
@@ -18,15 +79,664 @@ class EmailMessage(BASE):
     id = Column(Integer, primary_key=True)
     message_id = Column(String, unique=True, nullable=False)
     from_address = Column(String)
+    # Lowercase sender address and domain parsed from from_address, for indexed lookups
+    from_email = Column(String, index=True)
+    from_domain = Column(String, index=True)
     to_address = Column(String)
     subject = Column(String)
-    received_date = Column(DateTime)
+    received_date = Column(DateTime, index=True)
     body = Column(Text)
+    # Body kept in the body store instead of the body column, NULL when the body is inline or not fetched
+    body_id = Column(Integer, ForeignKey(f'{BODY_STORE_TABLE_NAME}.id'), index=True)
+    # Gmail label IDs of the message, as last fetched or modified
+    label_ids = Column(Text)
+    # Number of attachments, NULL when the message was only fetched in metadata format
+    attachment_count = Column(Integer, index=True)
+
+
+class EmailAttachment(BASE):
+    """Class to represent the metadata of an email attachment, read from the message part tree without its content."""
+    __tablename__ = ATTACHMENTS_TABLE_NAME
+
+    id = Column(Integer, primary_key=True)
+    email_id = Column(Integer, ForeignKey('emails.id'), nullable=False, index=True)
+    filename = Column(String)
+    # Lowercase MIME type, e.g. 'application/pdf'
+    mime_type = Column(String, index=True)
+    # Size in bytes
+    size = Column(Integer, index=True)
+
+
+class SyncState(BASE):
+    """Class to represent the mailbox sync state of a user."""
+    __tablename__ = 'sync_state'
+
+    id = Column(Integer, primary_key=True)
+    user_email = Column(String, unique=True, nullable=False)
+    history_id = Column(String)
+
+
+def parse_sender(from_address: Optional[str]) -> Tuple[Optional[str], Optional[str]]:
+    """
+    Parse the lowercase sender address and domain from a From header value.
+    Parameters:
+        from_address: str - From header value, e.g. 'Name <addr@example.com>'
+    """
+    if not from_address:
+        return None, None
+    from_email = email.utils.parseaddr(from_address)[1].strip().lower()
+    if not from_email:
+        return None, None
+    return from_email, from_email.rpartition('@')[2] or None
+
+
+def serialize_label_ids(label_ids: Iterable[str]) -> str:
+    """
+    Serialize label IDs for the label_ids column.
+    Parameters:
+        label_ids: Iterable[str] - Gmail label IDs
+    """
+    return LABEL_IDS_SEPARATOR.join(sorted(label_ids))
+
+
+def parse_label_ids(label_ids: Optional[str]) -> Optional[Set[str]]:
+    """
+    Parse the label_ids column, None when the labels of the email are not known.
+    Parameters:
+        label_ids: str - serialized Gmail label IDs
+    """
+    if label_ids is None:
+        return None
+    return set(label_ids.split(LABEL_IDS_SEPARATOR)) if label_ids else set()
+
+
+@event.listens_for(BASE.metadata, 'after_create')
+def migrate_emails_table(target: Any, connection: Any, **kw: Any) -> None:
+    """
+    Add the columns and indexes missing from an emails table created by an older version,
+    and fill the parsed sender columns of the emails already stored.
+    """
+    email_table = EmailMessage.__table__
+    existing_columns = {column['name'] for column in inspect(connection).get_columns(email_table.name)}
+    for column in email_table.columns:
+        if column.name not in existing_columns:
+            logging.info(f"Adding column {column.name} to the {email_table.name} table")
+            connection.execute(text(
+                f"ALTER TABLE {email_table.name} ADD COLUMN {column.name} "
+                f"{column.type.compile(dialect=connection.dialect)}"))
+    for index in email_table.indexes:
+        index.create(connection, checkfirst=True)
+    # Indexes added to the other tables after they were first shipped
+    for index in RuleStaleEmail.__table__.indexes:
+        index.create(connection, checkfirst=True)
+
+    rows = connection.execute(
+        email_table.select().with_only_columns(email_table.c.id, email_table.c.from_address).where(
+            email_table.c.from_email.is_(None), email_table.c.from_address.isnot(None))
+    ).all()
+    if rows:
+        logging.info(f"Parsing the sender of {len(rows)} emails")
+        senders = []
+        for row in rows:
+            from_email, from_domain = parse_sender(row.from_address)
+            senders.append({'email_id': row.id, 'from_email': from_email, 'from_domain': from_domain})
+        connection.execute(
+            email_table.update().where(email_table.c.id == bindparam('email_id')).values(
+                from_email=bindparam('from_email'), from_domain=bindparam('from_domain')),
+            senders
+        )
+
+
+class Label(BASE):
+    """Class to represent the cached Gmail labels of the mailbox."""
+    __tablename__ = 'labels'
+
+    id = Column(Integer, primary_key=True)
+    name = Column(String, unique=True, nullable=False)
+    label_id = Column(String, nullable=False)
+    fetched_at = Column(DateTime, nullable=False)
+
+
+class LabelAction(BASE):
+    """Class to represent a planned batch modification of email labels, journaled until applied."""
+    __tablename__ = 'action_queue'
+
+    id = Column(Integer, primary_key=True)
+    message_ids = Column(Text, nullable=False)
+    add_label_ids = Column(Text, nullable=False)
+    remove_label_ids = Column(Text, nullable=False)
+    status = Column(String, nullable=False, default=ACTION_STATUS_PENDING, index=True)
+    attempts = Column(Integer, nullable=False, default=0)
+    last_error = Column(Text)
+    created_at = Column(DateTime, nullable=False, default=datetime.utcnow)
+    updated_at = Column(DateTime, nullable=False, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+
+class RuleMatch(BASE):
+    """Class to represent an email matched by a rule, cached until the rule conditions or the email change."""
+    __tablename__ = RULE_MATCHES_TABLE_NAME
+
+    # Hash of the rule conditions, see Rule.get_definition_hash
+    rule_hash = Column(String, primary_key=True)
+    email_id = Column(Integer, primary_key=True)
+
+    __table_args__ = (Index(f'ix_{RULE_MATCHES_TABLE_NAME}_email_id', 'email_id'),)
+
+
+class RuleWatermark(BASE):
+    """Class to represent the last email a rule was evaluated on, emails stored after it are not evaluated yet."""
+    __tablename__ = 'rule_watermarks'
+
+    rule_hash = Column(String, primary_key=True)
+    last_email_id = Column(Integer, nullable=False)
+    evaluated_at = Column(DateTime, nullable=False, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+
+class RuleStaleEmail(BASE):
+    """
+    Class to represent an email already evaluated whose rule columns changed, evaluated again by the next refresh.
+    An email is queued once however many times it changes, so the table holds at most one row per stored email
+    between two full runs, e.g. while the daemon keeps fetching.
+    """
+    __tablename__ = RULE_STALE_EMAILS_TABLE_NAME
+
+    id = Column(Integer, primary_key=True)
+    email_id = Column(Integer, nullable=False)
+
+    __table_args__ = (Index(f'ix_{RULE_STALE_EMAILS_TABLE_NAME}_email_id', 'email_id'),)
+
+
+def get_fulltext_body_sql(row: str) -> str:
+    """
+    Get the SQL expression of the body of an emails row, decompressed when it is in the body store.
+    Parameters:
+        row: str - name of the row in the SQL statement, e.g. 'new' in a trigger
+    """
+    return (
+        f"coalesce({row}.body, (SELECT {BODY_STORE_SQL_FUNCTION}(codec, dictionary_id, data) "
+        f"FROM {BODY_STORE_TABLE_NAME} WHERE id = {row}.body_id))")
+
+
+FULLTEXT_TABLE_DDL = f"""CREATE VIRTUAL TABLE {FULLTEXT_TABLE_NAME} USING fts5(
+    subject, body, content='emails', content_rowid='id', tokenize='trigram')"""
+# Triggers keeping the index in sync, recreated on every start so indexes created by an older version
+# follow the bodies moved to the body store
+FULLTEXT_TRIGGERS_DDL = {
+    f'{FULLTEXT_TABLE_NAME}_insert': f"""CREATE TRIGGER {FULLTEXT_TABLE_NAME}_insert AFTER INSERT ON emails BEGIN
+        INSERT INTO {FULLTEXT_TABLE_NAME}(rowid, subject, body) VALUES (new.id, new.subject, {get_fulltext_body_sql('new')});
+    END""",
+    f'{FULLTEXT_TABLE_NAME}_delete': f"""CREATE TRIGGER {FULLTEXT_TABLE_NAME}_delete AFTER DELETE ON emails BEGIN
+        INSERT INTO {FULLTEXT_TABLE_NAME}({FULLTEXT_TABLE_NAME}, rowid, subject, body)
+        VALUES ('delete', old.id, old.subject, {get_fulltext_body_sql('old')});
+    END""",
+    f'{FULLTEXT_TABLE_NAME}_update': f"""CREATE TRIGGER {FULLTEXT_TABLE_NAME}_update AFTER UPDATE OF subject, body, body_id ON emails BEGIN
+        INSERT INTO {FULLTEXT_TABLE_NAME}({FULLTEXT_TABLE_NAME}, rowid, subject, body)
+        VALUES ('delete', old.id, old.subject, {get_fulltext_body_sql('old')});
+        INSERT INTO {FULLTEXT_TABLE_NAME}(rowid, subject, body) VALUES (new.id, new.subject, {get_fulltext_body_sql('new')});
+    END""",
+}
+
+
+@event.listens_for(BASE.metadata, 'after_create')
+def create_fulltext_index(target: Any, connection: Any, **kw: Any) -> None:
+    """
+    Create the SQLite FTS5 index over email subjects and bodies, kept in sync by triggers.
+    Emails stored before the index existed are indexed when it is created.
+    The index reads bodies of the body store through the email_body SQL function,
+    since the FTS5 'rebuild' command would only see the body column.
+    """
+    if connection.dialect.name != 'sqlite':
+        return
+    try:
+        with connection.begin_nested():
+            created = not inspect(connection).has_table(FULLTEXT_TABLE_NAME)
+            if created:
+                connection.execute(text(FULLTEXT_TABLE_DDL))
+            for trigger_name, statement in FULLTEXT_TRIGGERS_DDL.items():
+                connection.execute(text(f"DROP TRIGGER IF EXISTS {trigger_name}"))
+                connection.execute(text(statement))
+            if created:
+                connection.execute(text(
+                    f"INSERT INTO {FULLTEXT_TABLE_NAME}(rowid, subject, body) "
+                    f"SELECT id, subject, {get_fulltext_body_sql('emails')} FROM emails"))
+    except Exception as e:
+        logging.warning(f"Full-text index is not available, 'contains' conditions will scan the emails: {e}")
+
+
+TRIGRAM_INDEX_DDL = ["CREATE EXTENSION IF NOT EXISTS pg_trgm"] + [
+    f"CREATE INDEX IF NOT EXISTS ix_emails_{field}_trgm ON emails USING gin ({field} gin_trgm_ops)"
+    for field in RULE_FULLTEXT_FIELDS
+]
+
+
+@event.listens_for(BASE.metadata, 'after_create')
+def create_trigram_indexes(target: Any, connection: Any, **kw: Any) -> None:
+    """
+    Create the PostgreSQL pg_trgm indexes over email subjects and bodies,
+    which serve the ILIKE filters of 'contains' conditions.
+    """
+    if connection.dialect.name != 'postgresql':
+        return
+    try:
+        with connection.begin_nested():
+            for statement in TRIGRAM_INDEX_DDL:
+                connection.execute(text(statement))
+    except Exception as e:
+        logging.warning(f"Trigram indexes are not available, 'contains' conditions will scan the emails: {e}")
+
+
+# Insert statements supporting ON CONFLICT upserts, by database backend
+UPSERT_INSERTS = {
+    'sqlite': sqlite_insert,
+    'postgresql': postgresql_insert,
+}
+
+
+def set_sqlite_pragmas(dbapi_connection: Any, connection_record: Any) -> None:
+    """Apply the SQLITE_PRAGMAS to a new SQLite connection."""
+    cursor = dbapi_connection.cursor()
+    try:
+        for name, value in SQLITE_PRAGMAS.items():
+            cursor.execute(f"PRAGMA {name}={value}")
+    finally:
+        cursor.close()
 
 
-DB_ENGINE = create_engine(DATABASE_URL, echo=SQLALCHEMY_ECHO_MODE)
+@event.listens_for(Engine, 'connect')
+def register_sqlite_functions(dbapi_connection: Any, connection_record: Any) -> None:
+    """
+    Register the SQL function decompressing bodies of the body store on every new SQLite connection,
+    whatever engine it comes from, so rule queries and full-text index triggers can read them.
+    """
+    if isinstance(dbapi_connection, sqlite3.Connection):
+        dbapi_connection.create_function(BODY_STORE_SQL_FUNCTION, 3, decompress_body_sql, deterministic=True)
+
+
+def create_database_engine(database_url: str) -> Engine:
+    """
+    Create the engine of a database, tuned for its backend.
+    SQLite connections run in WAL mode with the SQLITE_PRAGMAS, server databases like PostgreSQL
+    get a connection pool sized for the worker threads, with connections checked before use.
+    Parameters:
+        database_url: str - SQLAlchemy database URL, e.g. 'postgresql://user@localhost/emails'
+    """
+    url = make_url(database_url)
+    if url.get_backend_name() == 'sqlite':
+        engine = create_engine(url, echo=SQLALCHEMY_ECHO_MODE)
+        event.listen(engine, 'connect', set_sqlite_pragmas)
+        return engine
+    return create_engine(
+        url,
+        echo=SQLALCHEMY_ECHO_MODE,
+        pool_size=DB_POOL_SIZE,
+        max_overflow=DB_POOL_MAX_OVERFLOW,
+        pool_timeout=DB_POOL_TIMEOUT_SECONDS,
+        pool_recycle=DB_POOL_RECYCLE_SECONDS,
+        pool_pre_ping=True
+    )
+
+
+@event.listens_for(Session, 'before_commit')
+def start_commit_timer(session: Any) -> None:
+    """Record when a session starts committing, on every database."""
+    session.info['commit_started_at'] = time.perf_counter()
+
+
+@event.listens_for(Session, 'after_commit')
+def observe_commit_time(session: Any) -> None:
+    """Observe the time taken by a session commit, including the flush of pending changes."""
+    started_at = session.info.pop('commit_started_at', None)
+    if started_at is not None:
+        METRICS.observe('db_commit_seconds', time.perf_counter() - started_at)
+
+
+DB_ENGINE = create_database_engine(DATABASE_URL)
 DB_SESSION = sessionmaker(bind=DB_ENGINE)
 
+# Session factory of the database of the account being processed, DB_SESSION when not set
+_ACCOUNT_DB_SESSION = ContextVar('account_db_session', default=None)
+_ACCOUNT_DB_SESSIONS = {}
+_ACCOUNT_DB_SESSIONS_LOCK = threading.Lock()
+
+
+def get_session_factory() -> sessionmaker:
+    """Get the session factory of the database in use in the current context."""
+    return _ACCOUNT_DB_SESSION.get() or DB_SESSION
+
+
+def get_session() -> Any:
+    """Open a session on the database in use in the current context."""
+    return get_session_factory()()
+
+
+def get_engine() -> Engine:
+    """Get the engine of the database in use in the current context."""
+    with get_session() as session:
+        return session.get_bind()
+
+
+def get_dialect_name() -> str:
+    """Get the name of the backend of the database in use in the current context, e.g. 'sqlite'."""
+    return get_engine().dialect.name
+
+
+@contextmanager
+def use_database(database_url: str) -> Iterator[None]:
+    """
+    Use the given database for the models functions called in this context.
+    Engines are created once per database URL and shared between contexts.
+    Threads started in the context must run in a copy of it to use the same database.
+    Parameters:
+        database_url: str - SQLAlchemy database URL, e.g. 'sqlite:///alice.db'
+    """
+    with _ACCOUNT_DB_SESSIONS_LOCK:
+        if database_url not in _ACCOUNT_DB_SESSIONS:
+            _ACCOUNT_DB_SESSIONS[database_url] = sessionmaker(bind=create_database_engine(database_url))
+        session_factory = _ACCOUNT_DB_SESSIONS[database_url]
+    token = _ACCOUNT_DB_SESSION.set(session_factory)
+    try:
+        yield
+    finally:
+        _ACCOUNT_DB_SESSION.reset(token)
+
+
+def upsert_emails(email_messages: List[Dict[str, Any]]) -> None:
+    """
+    Insert a batch of email messages into the database in a single transaction.
+    Messages already present are updated in place, matched on their message ID.
+    Only the columns present in the messages are updated, so a body fetched earlier is kept.
+    The messages are left unchanged, the rows written are built from copies of them.
+    Raises ValueError when the messages don't all hold the same keys.
+    Parameters:
+        email_messages: List[Dict[str, Any]] - email messages keyed by EmailMessage column names
+    """
+    if any(message.keys() != email_messages[0].keys() for message in email_messages):
+        logging.error("Email messages of a batch must all hold the same keys")
+        raise ValueError("Email messages of a batch must all hold the same keys")
+    # Keep the last copy of a message fetched twice, a single statement can't upsert a row twice
+    email_messages = list({message['message_id']: dict(message) for message in email_messages}.values())
+    if not email_messages:
+        return
+    columns = set(email_messages[0])
+    if 'from_address' in columns:
+        for message in email_messages:
+            message['from_email'], message['from_domain'] = parse_sender(message['from_address'])
+    attachments = None
+    if 'attachments' in columns:
+        # Attachments go to their own table, only their count is an emails column
+        attachments = {message['message_id']: message.pop('attachments') for message in email_messages}
+        for message in email_messages:
+            message['attachment_count'] = len(attachments[message['message_id']])
+
+    METRICS.observe('db_write_batch_size', len(email_messages), SIZE_BUCKETS, operation='upsert_emails')
+    session = get_session()
+    try:
+        dialect_name = session.get_bind().dialect.name
+        if dialect_name not in UPSERT_INSERTS:
+            raise ValueError(f"Unsupported database '{dialect_name}', expected one of {', '.join(UPSERT_INSERTS)}")
+        with METRICS.timer('db_write_seconds', operation='upsert_emails'):
+            replaced_body_ids = []
+            if 'body' in email_messages[0]:
+                # A body fetched again replaces the stored one, wherever it is kept
+                use_body_store = BODY_STORE_ENABLED and dialect_name in BODY_STORE_DIALECTS
+                if dialect_name in BODY_STORE_DIALECTS:
+                    replaced_body_ids = get_email_body_ids(
+                        session, [message['message_id'] for message in email_messages])
+                bodies = [message['body'] for message in email_messages]
+                body_ids = store_bodies(session, bodies) if use_body_store else [None] * len(bodies)
+                for message, body_id in zip(email_messages, body_ids):
+                    message['body_id'] = body_id
+                    if body_id is not None:
+                        message['body'] = None
+            statement = UPSERT_INSERTS[dialect_name](EmailMessage.__table__)
+            statement = statement.on_conflict_do_update(
+                index_elements=[EmailMessage.message_id],
+                set_={
+                    column: statement.excluded[column]
+                    for column in email_messages[0] if column != 'message_id'
+                }
+            )
+            session.execute(statement, email_messages)
+            if replaced_body_ids:
+                delete_unreferenced_bodies(session, replaced_body_ids)
+            if attachments is not None:
+                store_attachments(session, attachments)
+            if any(column in RULE_MATCH_COLUMNS for column in email_messages[0]):
+                mark_rule_matches_stale(session, [message['message_id'] for message in email_messages])
+            session.commit()
+    except Exception as e:
+        logging.error(f"An error occurred while inserting emails in db: {e}")
+        session.rollback()
+        raise e
+    finally:
+        session.close()
+
+
+def store_attachments(session: Any, attachments: Dict[str, List[Dict[str, Any]]]) -> None:
+    """
+    Replace the stored attachments of the emails with the attachments read from their payload.
+    Parameters:
+        session: sqlalchemy.orm.session.Session - database session, committed by the caller
+        attachments: Dict[str, List[Dict[str, Any]]] - attachments keyed by EmailAttachment column names,
+            by message ID
+    """
+    message_ids = list(attachments)
+    for i in range(0, len(message_ids), QUERY_MESSAGE_IDS_CHUNK_SIZE):
+        email_ids = dict(session.query(EmailMessage.message_id, EmailMessage.id).filter(
+            EmailMessage.message_id.in_(message_ids[i:i + QUERY_MESSAGE_IDS_CHUNK_SIZE])).all())
+        session.query(EmailAttachment).filter(
+            EmailAttachment.email_id.in_(list(email_ids.values()))).delete(synchronize_session=False)
+        rows = [
+            {'email_id': email_id, **attachment}
+            for message_id, email_id in email_ids.items()
+            for attachment in attachments[message_id]
+        ]
+        if rows:
+            session.execute(insert(EmailAttachment), rows)
+
+
+def get_body_ids(session: Any, content_hashes: List[str]) -> Dict[str, int]:
+    """
+    Get the IDs of the bodies of the body store with the given content hashes.
+    Parameters:
+        session: sqlalchemy.orm.session.Session - database session
+        content_hashes: List[str] - content hashes of the bodies
+    """
+    body_ids = {}
+    for i in range(0, len(content_hashes), QUERY_MESSAGE_IDS_CHUNK_SIZE):
+        body_ids.update(session.query(EmailBody.content_hash, EmailBody.id).filter(
+            EmailBody.content_hash.in_(content_hashes[i:i + QUERY_MESSAGE_IDS_CHUNK_SIZE])).all())
+    return body_ids
+
+
+def get_email_body_ids(session: Any, message_ids: List[str]) -> List[int]:
+    """
+    Get the body store IDs of the bodies of the emails, leaving out emails whose body is inline or not fetched.
+    Parameters:
+        session: sqlalchemy.orm.session.Session - database session
+        message_ids: List[str] - IDs of the emails
+    """
+    body_ids = set()
+    for i in range(0, len(message_ids), QUERY_MESSAGE_IDS_CHUNK_SIZE):
+        body_ids.update(body_id for body_id, in session.query(EmailMessage.body_id).filter(
+            EmailMessage.message_id.in_(message_ids[i:i + QUERY_MESSAGE_IDS_CHUNK_SIZE]),
+            EmailMessage.body_id.isnot(None)))
+    return list(body_ids)
+
+
+def delete_unreferenced_bodies(session: Any, body_ids: List[int]) -> None:
+    """
+    Delete the given bodies of the body store that no email references any more, e.g. replaced by a body fetched again.
+    Parameters:
+        session: sqlalchemy.orm.session.Session - database session, committed by the caller
+        body_ids: List[int] - IDs of the bodies to delete when unreferenced
+    """
+    for i in range(0, len(body_ids), QUERY_MESSAGE_IDS_CHUNK_SIZE):
+        result = session.execute(delete(EmailBody).where(
+            EmailBody.id.in_(body_ids[i:i + QUERY_MESSAGE_IDS_CHUNK_SIZE]),
+            ~select(EmailMessage.id).where(EmailMessage.body_id == EmailBody.id).exists()))
+        METRICS.increment('body_store_bodies_total', result.rowcount, result='deleted')
+
+
+def store_bodies(session: Any, bodies: List[Optional[str]]) -> List[Optional[int]]:
+    """
+    Store the bodies in the body store, compressed and deduplicated by content hash.
+    Bodies shorter than BODY_STORE_MIN_LENGTH are not worth compressing and stay inline.
+    Returns the body store ID of each body, None for the bodies to keep inline.
+    Parameters:
+        session: sqlalchemy.orm.session.Session - database session, committed by the caller
+        bodies: List[Optional[str]] - email bodies
+    """
+    content_hashes = [
+        hash_body(body) if body is not None and len(body) >= BODY_STORE_MIN_LENGTH else None for body in bodies]
+    bodies_by_hash = {content_hash: body for content_hash, body in zip(content_hashes, bodies) if content_hash}
+    if not bodies_by_hash:
+        return [None] * len(bodies)
+    body_ids = get_body_ids(session, list(bodies_by_hash))
+    missing_hashes = [content_hash for content_hash in bodies_by_hash if content_hash not in body_ids]
+    if missing_hashes:
+        new_bodies = []
+        for content_hash in missing_hashes:
+            codec, dictionary_id, data = compress_body_for_store(bodies_by_hash[content_hash])
+            new_bodies.append(
+                {'content_hash': content_hash, 'codec': codec, 'dictionary_id': dictionary_id, 'data': data})
+        # Another writer may have stored the same body meanwhile
+        dialect_name = session.get_bind().dialect.name
+        session.execute(
+            UPSERT_INSERTS[dialect_name](EmailBody.__table__).on_conflict_do_nothing(
+                index_elements=[EmailBody.content_hash]),
+            new_bodies)
+        body_ids.update(get_body_ids(session, missing_hashes))
+    METRICS.increment('body_store_bodies_total', len(bodies_by_hash) - len(missing_hashes), result='deduplicated')
+    METRICS.increment('body_store_bodies_total', len(missing_hashes), result='stored')
+    return [body_ids.get(content_hash) for content_hash in content_hashes]
+
+
+def compress_stored_bodies(batch_size: Optional[int]=QUERY_MESSAGE_IDS_CHUNK_SIZE) -> int:
+    """
+    Move the bodies stored inline in the emails table to the body store, batch_size emails per transaction,
+    then vacuum the database to give the space back. Returns the number of emails moved.
+    Parameters:
+        batch_size: int - number of emails moved per transaction
+    """
+    moved = 0
+    session = get_session()
+    try:
+        if session.get_bind().dialect.name not in BODY_STORE_DIALECTS:
+            return moved
+        while True:
+            rows = session.query(EmailMessage.id, EmailMessage.body).filter(
+                EmailMessage.body.isnot(None),
+                func.length(EmailMessage.body) >= BODY_STORE_MIN_LENGTH
+            ).order_by(EmailMessage.id).limit(batch_size).all()
+            if not rows:
+                break
+            body_ids = store_bodies(session, [row.body for row in rows])
+            session.execute(update(EmailMessage), [
+                {'id': row.id, 'body': None, 'body_id': body_id} for row, body_id in zip(rows, body_ids)])
+            session.commit()
+            moved += len(rows)
+            logging.info(f"Moved {moved} email bodies to the body store")
+    except Exception as e:
+        logging.error(f"An error occurred while moving email bodies to the body store: {e}")
+        session.rollback()
+        raise e
+    finally:
+        session.close()
+    if moved:
+        with get_engine().connect() as connection:
+            connection.execution_options(isolation_level='AUTOCOMMIT').execute(text("VACUUM"))
+    return moved
+
+
+def mark_rule_matches_stale(session: Any, message_ids: List[str]) -> None:
+    """
+    Queue the emails some rule was already evaluated on for a new evaluation, after their rule columns changed.
+    Emails stored after every rule watermark are left out, they are evaluated as new emails,
+    and so are emails already queued.
+    Parameters:
+        session: sqlalchemy.orm.session.Session - database session, committed by the caller
+        message_ids: List[str] - IDs of the changed emails
+    """
+    last_evaluated_id = select(func.max(RuleWatermark.last_email_id)).scalar_subquery()
+    for i in range(0, len(message_ids), QUERY_MESSAGE_IDS_CHUNK_SIZE):
+        session.execute(insert(RuleStaleEmail).from_select(
+            ['email_id'],
+            select(EmailMessage.id).where(
+                EmailMessage.message_id.in_(message_ids[i:i + QUERY_MESSAGE_IDS_CHUNK_SIZE]),
+                EmailMessage.id <= last_evaluated_id,
+                ~select(RuleStaleEmail.id).where(RuleStaleEmail.email_id == EmailMessage.id).exists())
+        ))
+
+
+def get_rule_watermarks(rules: List[Rule]) -> Dict[str, int]:
+    """
+    Get the last email each rule was evaluated on by the rule match cache, by rule hash.
+    Rules never evaluated are left out.
+    Parameters:
+        rules: List[Rule] - rule objects
+    """
+    with get_session() as session:
+        return dict(session.query(RuleWatermark.rule_hash, RuleWatermark.last_email_id).filter(
+            RuleWatermark.rule_hash.in_({rule.get_definition_hash() for rule in rules})).all())
+
+
+def refresh_rule_matches(rules: List[Rule]) -> None:
+    """
+    Bring the cached matches of the rules up to date in a single transaction, evaluating each rule
+    only on the emails stored after its watermark and the emails changed since they were evaluated.
+    Cached matches of rules no longer defined, e.g. whose conditions were edited, are dropped.
+    Parameters:
+        rules: List[Rule] - rule objects
+    """
+    session = get_session()
+    try:
+        rules_by_hash = {rule.get_definition_hash(): rule for rule in rules}
+        if session.get_bind().dialect.name == 'postgresql':
+            # IDs are handed out before commit, wait for the transactions storing emails and hold the next ones
+            # until the refresh is committed, so no email is committed below the new watermarks
+            session.execute(text(f"LOCK TABLE {EmailMessage.__tablename__} IN SHARE ROW EXCLUSIVE MODE"))
+        # On SQLite, deleting first takes the write lock, no email is stored until the refresh is committed
+        session.query(RuleWatermark).filter(
+            RuleWatermark.rule_hash.notin_(list(rules_by_hash))).delete(synchronize_session=False)
+        session.query(RuleMatch).filter(
+            RuleMatch.rule_hash.notin_(list(rules_by_hash))).delete(synchronize_session=False)
+        watermarks = dict(session.query(RuleWatermark.rule_hash, RuleWatermark.last_email_id).all())
+        last_email_id = session.query(func.max(EmailMessage.id)).scalar() or 0
+        last_stale_id = session.query(func.max(RuleStaleEmail.id)).scalar() or 0
+        with METRICS.timer('rule_match_cache_refresh_seconds'):
+            for rule_hash, rule in rules_by_hash.items():
+                evaluate_rule_matches(
+                    session, EmailMessage, rule, rule_hash, watermarks.get(rule_hash, 0), last_email_id, last_stale_id)
+                session.merge(RuleWatermark(rule_hash=rule_hash, last_email_id=last_email_id))
+        session.query(RuleStaleEmail).filter(RuleStaleEmail.id <= last_stale_id).delete(synchronize_session=False)
+        session.commit()
+        logging.info(
+            f"Refreshed the matches of {len(rules_by_hash)} rules up to email {last_email_id}, "
+            f"oldest watermark was {min(watermarks.values(), default=0)}")
+    except Exception as e:
+        logging.error(f"An error occurred while refreshing rule matches in db: {e}")
+        session.rollback()
+        raise e
+    finally:
+        session.close()
+
+
+def iter_cached_rule_matches(rules: List[Rule]) -> Iterator[Tuple[str, Optional[str], List[int]]]:
+    """
+    Stream the emails matching any of the rules from the rule match cache, with their stored label IDs
+    and the indexes of the rules each one matches, in the format of iter_rule_matches.
+    The session stays open until the matches are consumed.
+    Parameters:
+        rules: List[Rule] - rule objects, refreshed by refresh_rule_matches
+    """
+    with get_session() as session:
+        try:
+            yield from stream_cached_rule_matches(session, EmailMessage, rules)
+        except Exception as e:
+            logging.error(f"An error occurred while reading rule matches from db: {e}")
+            raise e
+
 
 def insert_email(message_id: str, from_address: str, to_address: str, subject: str, received_date: DateTime, body: str):
     """
@@ -39,20 +749,268 @@ def insert_email(message_id: str, from_address: str, to_address: str, subject: s
         received_date: DateTime - date and time when the email was received
         body: str - email body
     """
-    session = DB_SESSION()
-    email_message = EmailMessage(
-        message_id=message_id,
-        from_address=from_address,
-        to_address=to_address,
-        subject=subject,
-        received_date=received_date,
-        body=body
-    )
-    session.add(email_message)
+    upsert_emails([{
+        'message_id': message_id,
+        'from_address': from_address,
+        'to_address': to_address,
+        'subject': subject,
+        'received_date': received_date,
+        'body': body
+    }])
+
+
+def _update_email_labels(session: Any, email_ids: List[str], add_label_ids: Set[str], remove_label_ids: Set[str]) -> None:
+    for i in range(0, len(email_ids), QUERY_MESSAGE_IDS_CHUNK_SIZE):
+        rows = session.query(EmailMessage.id, EmailMessage.label_ids).filter(
+            EmailMessage.message_id.in_(email_ids[i:i + QUERY_MESSAGE_IDS_CHUNK_SIZE]),
+            EmailMessage.label_ids.isnot(None)).all()
+        if rows:
+            session.execute(update(EmailMessage), [
+                {
+                    'id': row.id,
+                    'label_ids': serialize_label_ids(
+                        (parse_label_ids(row.label_ids) - remove_label_ids) | add_label_ids)
+                }
+                for row in rows
+            ])
+
+
+def update_email_labels(email_ids: List[str], add_label_ids: List[str], remove_label_ids: List[str]) -> None:
+    """
+    Apply label changes made in Gmail to the stored label IDs of the emails, in a single transaction.
+    Emails whose labels are not known are left unchanged.
+    Parameters:
+        email_ids: List[str] - IDs of the modified emails
+        add_label_ids: List[str] - label IDs added
+        remove_label_ids: List[str] - label IDs removed
+    """
+    session = get_session()
     try:
+        _update_email_labels(session, list(email_ids), set(add_label_ids), set(remove_label_ids))
         session.commit()
     except Exception as e:
-        logging.error(f"An error occurred while inserting emails in db: {e}")
+        logging.error(f"An error occurred while updating email labels in db: {e}")
+        session.rollback()
+        raise e
+    finally:
+        session.close()
+
+
+def apply_email_label_changes(label_changes: Dict[str, Tuple[Set[str], Set[str]]]) -> None:
+    """
+    Apply the label changes read from the mailbox history to the stored label IDs of the emails,
+    in a single transaction. Emails not stored or whose labels are not known are left unchanged.
+    Parameters:
+        label_changes: Dict[str, Tuple[Set[str], Set[str]]] - label IDs added and removed, by email ID
+    """
+    if not label_changes:
+        return
+    groups = {}
+    for email_id, (add_label_ids, remove_label_ids) in label_changes.items():
+        groups.setdefault((frozenset(add_label_ids), frozenset(remove_label_ids)), []).append(email_id)
+    session = get_session()
+    try:
+        for (add_label_ids, remove_label_ids), email_ids in groups.items():
+            _update_email_labels(session, email_ids, add_label_ids, remove_label_ids)
+        session.commit()
+    except Exception as e:
+        logging.error(f"An error occurred while updating email labels in db: {e}")
+        session.rollback()
+        raise e
+    finally:
+        session.close()
+
+
+def enqueue_label_actions(actions: List[Tuple[List[str], List[str], List[str]]]) -> List[int]:
+    """
+    Journal planned label modifications as pending actions, in a single transaction.
+    Returns the IDs of the label actions, in the order of the actions.
+    Parameters:
+        actions: List[Tuple[List[str], List[str], List[str]]] - email IDs, label IDs to add
+            and label IDs to remove of each batch modification
+    """
+    session = get_session()
+    try:
+        label_actions = [
+            LabelAction(
+                message_ids=LABEL_IDS_SEPARATOR.join(email_ids),
+                add_label_ids=serialize_label_ids(add_label_ids),
+                remove_label_ids=serialize_label_ids(remove_label_ids)
+            )
+            for email_ids, add_label_ids, remove_label_ids in actions
+        ]
+        session.add_all(label_actions)
+        # Flush to get the IDs, reading them after the commit would reload every action
+        session.flush()
+        action_ids = [label_action.id for label_action in label_actions]
+        session.commit()
+        return action_ids
+    except Exception as e:
+        logging.error(f"An error occurred while saving label actions in db: {e}")
+        session.rollback()
+        raise e
+    finally:
+        session.close()
+
+
+def get_pending_label_actions() -> List[Tuple[int, List[str], List[str], List[str]]]:
+    """Get the journaled label actions not applied yet, oldest first."""
+    session = get_session()
+    try:
+        actions = session.query(LabelAction).filter_by(
+            status=ACTION_STATUS_PENDING).order_by(LabelAction.id).all()
+        return [
+            (
+                action.id,
+                action.message_ids.split(LABEL_IDS_SEPARATOR),
+                sorted(parse_label_ids(action.add_label_ids)),
+                sorted(parse_label_ids(action.remove_label_ids))
+            )
+            for action in actions
+        ]
+    finally:
+        session.close()
+
+
+def complete_label_action(action_id: int) -> None:
+    """
+    Mark a label action as applied and update the stored labels of its emails, in a single transaction.
+    Parameters:
+        action_id: int - ID of the label action
+    """
+    session = get_session()
+    try:
+        action = session.get(LabelAction, action_id)
+        _update_email_labels(
+            session,
+            action.message_ids.split(LABEL_IDS_SEPARATOR),
+            parse_label_ids(action.add_label_ids),
+            parse_label_ids(action.remove_label_ids)
+        )
+        action.status = ACTION_STATUS_DONE
+        action.attempts += 1
+        action.last_error = None
+        session.commit()
+    except Exception as e:
+        logging.error(f"An error occurred while completing label action in db: {e}")
+        session.rollback()
+        raise e
+    finally:
+        session.close()
+
+
+def fail_label_action(action_id: int, error: str, retryable: bool) -> None:
+    """
+    Record a failed attempt of a label action.
+    Actions failing with a retryable error stay pending, to be resumed by the next run.
+    Parameters:
+        action_id: int - ID of the label action
+        error: str - error of the attempt
+        retryable: bool - whether the action can be retried later
+    """
+    session = get_session()
+    try:
+        action = session.get(LabelAction, action_id)
+        action.attempts += 1
+        action.last_error = error
+        if not retryable:
+            action.status = ACTION_STATUS_FAILED
+        session.commit()
+    except Exception as e:
+        logging.error(f"An error occurred while saving label action failure in db: {e}")
+        session.rollback()
+        raise e
+    finally:
+        session.close()
+
+
+def prune_label_actions() -> None:
+    """Delete the label actions already applied from the journal."""
+    session = get_session()
+    try:
+        session.query(LabelAction).filter_by(status=ACTION_STATUS_DONE).delete()
+        session.commit()
+    except Exception as e:
+        logging.error(f"An error occurred while pruning label actions in db: {e}")
+        session.rollback()
+    finally:
+        session.close()
+
+
+def get_history_id(user_email: str) -> Optional[str]:
+    """
+    Get the mailbox history ID saved by the last sync.
+    Parameters:
+        user_email: str - email address of the mailbox owner
+    """
+    session = get_session()
+    try:
+        sync_state = session.query(SyncState).filter_by(user_email=user_email).first()
+        return sync_state.history_id if sync_state else None
+    except Exception as e:
+        logging.error(f"An error occurred while reading sync state from db: {e}")
+        return None
+    finally:
+        session.close()
+
+
+def save_history_id(user_email: str, history_id: str) -> None:
+    """
+    Save the mailbox history ID reached by the current sync.
+    Parameters:
+        user_email: str - email address of the mailbox owner
+        history_id: str - Gmail mailbox history ID
+    """
+    session = get_session()
+    try:
+        sync_state = session.query(SyncState).filter_by(user_email=user_email).first()
+        if sync_state is None:
+            sync_state = SyncState(user_email=user_email)
+            session.add(sync_state)
+        sync_state.history_id = str(history_id)
+        session.commit()
+    except Exception as e:
+        logging.error(f"An error occurred while saving sync state in db: {e}")
+        session.rollback()
+    finally:
+        session.close()
+
+
+def get_cached_labels(max_age_seconds: int) -> Optional[Dict[str, str]]:
+    """
+    Get the cached label name to label ID map, if it was fetched less than max_age_seconds ago.
+    Parameters:
+        max_age_seconds: int - maximum age of the cached labels
+    """
+    session = get_session()
+    try:
+        labels = session.query(Label).all()
+        oldest = datetime.utcnow() - timedelta(seconds=max_age_seconds)
+        if not labels or any(label.fetched_at < oldest for label in labels):
+            return None
+        return {label.name: label.label_id for label in labels}
+    except Exception as e:
+        logging.error(f"An error occurred while reading labels from db: {e}")
+        return None
+    finally:
+        session.close()
+
+
+def save_labels(labels: Dict[str, str]) -> None:
+    """
+    Replace the cached labels with the label name to label ID map fetched from Gmail.
+    Parameters:
+        labels: Dict[str, str] - label name to label ID map
+    """
+    session = get_session()
+    try:
+        fetched_at = datetime.utcnow()
+        session.query(Label).delete()
+        session.add_all(
+            Label(name=name, label_id=label_id, fetched_at=fetched_at) for name, label_id in labels.items())
+        session.commit()
+    except Exception as e:
+        logging.error(f"An error occurred while saving labels in db: {e}")
         session.rollback()
     finally:
         session.close()
@@ -64,14 +1022,114 @@ def get_email_ids_for_rules(rule: Rule):
     Parameters:
         rule: Rule - rule object
     """
-    session = DB_SESSION()
-    email_ids = fetch_email_ids(session, EmailMessage, rule)
-    return email_ids
+    with get_session() as session:
+        return fetch_email_ids(session, EmailMessage, rule)
+
+
+def iter_email_ids_for_rule(rule: Rule) -> Iterator[str]:
+    """
+    Stream the IDs of the emails matching the rule, without holding all of them in memory.
+    The session stays open until the IDs are consumed.
+    Parameters:
+        rule: Rule - rule object
+    """
+    with get_session() as session:
+        try:
+            yield from stream_email_ids(session, EmailMessage, rule)
+        except Exception as e:
+            logging.error(f"An error occurred while reading emails from db: {e}")
+            raise e
+
+
+def iter_rule_matches(
+    rules: List[Rule],
+    message_ids: Optional[List[str]] = None
+) -> Iterator[Tuple[str, Optional[str], List[int]]]:
+    """
+    Stream the emails matching any of the rules, with their stored label IDs
+    and the indexes of the rules each one matches, without holding all of them in memory.
+    The session stays open until the matches are consumed.
+    Parameters:
+        rules: List[Rule] - rule objects
+        message_ids: List[str] - IDs of the emails to evaluate, all emails when not given
+    """
+    with get_session() as session:
+        try:
+            yield from stream_rule_matches(session, EmailMessage, rules, message_ids)
+        except Exception as e:
+            logging.error(f"An error occurred while reading emails from db: {e}")
+            raise e
+
+
+def get_rule_matches(
+    rules: List[Rule],
+    message_ids: Optional[List[str]] = None
+) -> List[Tuple[str, Optional[str], List[int]]]:
+    """
+    Get IDs of emails matching any of the rules, with their stored label IDs
+    and the indexes of the rules each one matches.
+    Parameters:
+        rules: List[Rule] - rule objects
+        message_ids: List[str] - IDs of the emails to evaluate, all emails when not given
+    """
+    with get_session() as session:
+        return fetch_rule_matches(session, EmailMessage, rules, message_ids)
+
+
+def get_unhydrated_email_ids(
+    rule: Rule,
+    message_ids: Optional[List[str]] = None,
+    after_email_id: Optional[int] = None
+) -> List[str]:
+    """
+    Get IDs of emails stored from metadata only whose body or attachments are needed to evaluate the rule.
+    Parameters:
+        rule: Rule - rule object
+        message_ids: List[str] - IDs of the emails to consider, all emails when not given
+        after_email_id: int - watermark of the rule, only the emails the rule match cache evaluates next are considered
+    """
+    with get_session() as session:
+        return fetch_unhydrated_email_ids(session, EmailMessage, rule, message_ids, after_email_id)
+
+
+def get_schema_version(engine: Engine) -> int:
+    """
+    Get the schema version of a SQLite database, kept in its user_version.
+    Parameters:
+        engine: sqlalchemy.engine.Engine - engine of the database
+    """
+    with engine.connect() as connection:
+        return connection.execute(text("PRAGMA user_version")).scalar()
+
+
+def set_schema_version(engine: Engine, version: int) -> None:
+    """
+    Set the schema version of a SQLite database, kept in its user_version.
+    Parameters:
+        engine: sqlalchemy.engine.Engine - engine of the database
+        version: int - schema version
+    """
+    with engine.begin() as connection:
+        connection.execute(text(f"PRAGMA user_version={int(version)}"))
 
 
 def create_database():
-    """Create the database."""
-    BASE.metadata.create_all(DB_ENGINE)
+    """
+    Create the database in use in the current context.
+    With the body store enabled, bodies stored inline by an older version, or while it was disabled,
+    are moved to it once. The schema version records that they were, so later runs skip the scan.
+    """
+    engine = get_engine()
+    BASE.metadata.create_all(engine)
+    if engine.dialect.name not in BODY_STORE_DIALECTS:
+        return
+    schema_version = get_schema_version(engine)
+    if BODY_STORE_ENABLED and schema_version < BODY_STORE_SCHEMA_VERSION:
+        compress_stored_bodies()
+        set_schema_version(engine, BODY_STORE_SCHEMA_VERSION)
+    elif not BODY_STORE_ENABLED and schema_version >= BODY_STORE_SCHEMA_VERSION:
+        # Bodies are stored inline again from now on
+        set_schema_version(engine, 0)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,227 @@
+import operator
+import re
+from functools import lru_cache
+import string
+from typing import Any, Callable, Dict, List, Optional, Tuple
+from email_processor.models.constants import *
+from email_processor.models.emails import parse_sender
+from email_processor.models.rules import Rule, parse_rule_date
+
+# SQLite lower() and LIKE only fold the case of ASCII letters
+ASCII_LOWERCASE_TABLE = str.maketrans(string.ascii_uppercase, string.ascii_lowercase)
+# Columns parsed from from_address, in the order parse_sender returns them
+SENDER_COLUMNS = ['from_email', 'from_domain']
+# Keys of the attachments of email records conditions on attachment fields compare against
+ATTACHMENT_KEYS = {RULE_FIELD_ATTACHMENT_TYPE: 'mime_type', RULE_FIELD_ATTACHMENT_NAME: 'filename'}
+# Columns equality conditions on sender fields compare against
+SENDER_EQUALS_COLUMNS = {RULE_FIELD_FROM_ADDRESS: 'from_email', RULE_FIELD_FROM_DOMAIN: 'from_domain'}
+# Comparisons of received_date and attachment_size conditions, by predicate
+DATE_OPERATORS = {
+    RULE_PREDICATE_GREATER_THAN: operator.gt,
+    RULE_PREDICATE_LESSER_THAN: operator.lt,
+    RULE_PREDICATE_GREATER_THAN_EQUAL_TO: operator.ge,
+    RULE_PREDICATE_LESSER_THAN_EQUAL_TO: operator.le,
+}
+
+
+class MissingFieldError(Exception):
+    """Raised when a condition is on a field the email record does not hold, e.g. a body not fetched yet."""
+
+
+@lru_cache(maxsize=256)
+def like_pattern(value: str) -> re.Pattern:
+    """
+    Compile the regular expression matching like SQLite's LIKE '%value%'.
+    % and _ in the value stay wildcards, and only ASCII letters are matched case-insensitively.
+    Parameters:
+        value: str - value of a 'contains' condition
+    """
+    pattern = ''.join(
+        '.*' if char == '%' else '.' if char == '_' else re.escape(char)
+        for char in value
+    )
+    return re.compile(pattern, re.IGNORECASE | re.ASCII | re.DOTALL)
+
+
+def get_field_value(email_message: Dict[str, Any], column: str) -> Any:
+    """
+    Get the value of a column of an email record, parsing the sender columns when not set yet.
+    Raises MissingFieldError when the record does not hold the column.
+    Parameters:
+        email_message: Dict[str, Any] - email message keyed by EmailMessage column names
+        column: str - EmailMessage column name
+    """
+    if column in email_message:
+        return email_message[column]
+    if column in SENDER_COLUMNS and RULE_FIELD_FROM_ADDRESS in email_message:
+        return dict(zip(SENDER_COLUMNS, parse_sender(email_message[RULE_FIELD_FROM_ADDRESS])))[column]
+    raise MissingFieldError(column)
+
+
+def compile_attachment_condition(field: str, predicate: str, value: Any) -> Callable[[Dict[str, Any]], Optional[bool]]:
+    """
+    Compile a condition on the attachments of emails, with the semantics of build_attachment_filter.
+    Email records hold the attachments extracted from full messages, those fetched in metadata format don't.
+    Parameters:
+        field: str - attachment field of the condition
+        predicate: str - predicate of the condition
+        value: Any - value of the condition
+    """
+    if field == RULE_FIELD_HAS_ATTACHMENT:
+        expected = value == (predicate == RULE_PREDICATE_EQUALS)
+
+        def evaluate_has_attachment(email_message: Dict[str, Any]) -> Optional[bool]:
+            return (len(get_field_value(email_message, 'attachments')) > 0) == expected
+        return evaluate_has_attachment
+    if field == RULE_FIELD_ATTACHMENT_SIZE:
+        compare = DATE_OPERATORS[predicate]
+
+        def evaluate_size(email_message: Dict[str, Any]) -> Optional[bool]:
+            return any(compare(attachment['size'], value) for attachment in get_field_value(email_message, 'attachments'))
+        return evaluate_size
+    key = ATTACHMENT_KEYS[field]
+    if predicate in RULE_EQUALS_PREDICATES:
+        expected = value.lower()
+
+        def matches(attachment_value: str) -> bool:
+            return attachment_value.translate(ASCII_LOWERCASE_TABLE) == expected
+    else:
+        pattern = like_pattern(value)
+
+        def matches(attachment_value: str) -> bool:
+            return pattern.search(attachment_value) is not None
+    expected_found = predicate in [RULE_PREDICATE_EQUALS, RULE_PREDICATE_CONTAINS]
+
+    def evaluate_attachments(email_message: Dict[str, Any]) -> Optional[bool]:
+        found = any(
+            attachment[key] is not None and matches(attachment[key])
+            for attachment in get_field_value(email_message, 'attachments')
+        )
+        return found == expected_found
+    return evaluate_attachments
+
+
+def compile_condition(condition: dict, parsed_value: Optional[Any]=None) -> Callable[[Dict[str, Any]], Optional[bool]]:
+    """
+    Compile a rule condition into a predicate on email records, with the semantics of build_condition_filter.
+    The values compared with are prepared once, e.g. the date parsed and the LIKE pattern compiled.
+    The predicate returns None where SQL evaluates to NULL, i.e. when the field is NULL.
+    Parameters:
+        condition: dict - rule condition
+        parsed_value: Any - value of the condition already parsed by the rule, parsed here when not given
+    """
+    field = condition[RULE_CONDITION_KEY_FIELD]
+    predicate = condition[RULE_CONDITION_KEY_PREDICATE]
+    value = condition[RULE_CONDITION_KEY_VALUE]
+    if field == RULE_FIELD_RECEIVED_DATE and predicate in DATE_OPERATORS:
+        compare = DATE_OPERATORS[predicate]
+        datetime_val = parsed_value if parsed_value is not None else parse_rule_date(value)
+
+        def evaluate_date(email_message: Dict[str, Any]) -> Optional[bool]:
+            received_date = get_field_value(email_message, field)
+            if received_date is None:
+                return None
+            # SQLite stores the local time of the Date header, dropping its timezone
+            return compare(received_date.replace(tzinfo=None), datetime_val)
+        return evaluate_date
+    elif field in RULE_ATTACHMENT_FIELDS:
+        return compile_attachment_condition(field, predicate, value)
+    elif field in RULE_STRING_FIELDS and predicate in RULE_EQUALS_PREDICATES:
+        # Values other than strings are compared as text, like SQL does
+        value, expected_equal = str(value), predicate == RULE_PREDICATE_EQUALS
+        if field in SENDER_EQUALS_COLUMNS:
+            column, lowercase = SENDER_EQUALS_COLUMNS[field], False
+            expected = value.strip().lstrip('@').lower() if field == RULE_FIELD_FROM_DOMAIN else value.strip().lower()
+        else:
+            column, lowercase, expected = field, True, value.lower()
+
+        def evaluate_equals(email_message: Dict[str, Any]) -> Optional[bool]:
+            field_value = get_field_value(email_message, column)
+            if field_value is None:
+                return None
+            if lowercase:
+                field_value = field_value.translate(ASCII_LOWERCASE_TABLE)
+            return (field_value == expected) == expected_equal
+        return evaluate_equals
+    elif field in RULE_STRING_FIELDS and predicate in RULE_CONTAINS_PREDICATES:
+        pattern, expected_found = like_pattern(str(value)), predicate == RULE_PREDICATE_CONTAINS
+
+        def evaluate_contains(email_message: Dict[str, Any]) -> Optional[bool]:
+            field_value = get_field_value(email_message, field)
+            if field_value is None:
+                return None
+            return (pattern.search(field_value) is not None) == expected_found
+        return evaluate_contains
+    raise ValueError(f"Unsupported condition: {condition}")
+
+
+def evaluate_condition(email_message: Dict[str, Any], condition: dict) -> Optional[bool]:
+    """
+    Evaluate a rule condition on an email record, with the semantics of build_condition_filter.
+    Returns None where SQL evaluates to NULL, i.e. when the field is NULL.
+    Parameters:
+        email_message: Dict[str, Any] - email message keyed by EmailMessage column names
+        condition: dict - rule condition
+    """
+    return compile_condition(condition)(email_message)
+
+
+def get_condition_predicates(rule: Rule) -> List[Callable[[Dict[str, Any]], Optional[bool]]]:
+    """
+    Get the predicates of the conditions of a rule, compiled once and cached on the rule.
+    Parameters:
+        rule: Rule - rule object
+    """
+    return rule.get_compiled('predicates', lambda: [
+        compile_condition(condition, parsed_value)
+        for condition, parsed_value in zip(rule.conditions, rule.condition_values)
+    ])
+
+
+def evaluate_rule(email_message: Dict[str, Any], rule: Rule) -> bool:
+    """
+    Evaluate a rule on an email record, with the same result as compile_rule on the stored email.
+    Conditions evaluating to NULL never make a rule match.
+    Raises MissingFieldError when the result depends on a field the record does not hold.
+    Parameters:
+        email_message: Dict[str, Any] - email message keyed by EmailMessage column names
+        rule: Rule - rule object
+    """
+    missing = None
+    for condition_predicate in get_condition_predicates(rule):
+        try:
+            result = condition_predicate(email_message)
+        except MissingFieldError as e:
+            missing = e
+            continue
+        if rule.collection_predicate == RULE_COLLECTION_PREDICATE_ANY and result is True:
+            return True
+        if rule.collection_predicate == RULE_COLLECTION_PREDICATE_ALL and result is not True:
+            return False
+    if missing is not None:
+        raise missing
+    return rule.collection_predicate == RULE_COLLECTION_PREDICATE_ALL
+
+
+def match_rules(
+    email_messages: List[Dict[str, Any]],
+    rules: List[Rule]
+) -> Tuple[List[Tuple[str, Optional[str], List[int]]], List[str]]:
+    """
+    Evaluate all the rules on email records, without reading them from the database.
+    Returns the matches in the format of fetch_rule_matches, and the IDs of the emails
+    that can't be evaluated from their records and need the database path.
+    Parameters:
+        email_messages: List[Dict[str, Any]] - email messages keyed by EmailMessage column names
+        rules: List[Rule] - rule objects
+    """
+    matches, undecided_ids = [], []
+    for email_message in email_messages:
+        try:
+            rule_indexes = [index for index, rule in enumerate(rules) if evaluate_rule(email_message, rule)]
+        except MissingFieldError:
+            undecided_ids.append(email_message['message_id'])
+            continue
+        if rule_indexes:
+            matches.append((email_message['message_id'], email_message.get('label_ids'), rule_indexes))
+    return matches, undecided_ids
@@ -1,13 +1,52 @@
-from datetime import datetime
 import logging
-from typing import Any, List
+import operator
+from typing import Any, Iterator, List, Optional, Tuple
+from sqlalchemy import (
+    and_, case, column, delete, false, func, insert, inspect, literal, literal_column, or_, select, table, true
+)
+from email_processor.metrics import METRICS
 from email_processor.models.constants import *
-from email_processor.models.rules import Rule
+from email_processor.models.rules import Rule, parse_rule_date
+
+FULLTEXT_TABLE = table(FULLTEXT_TABLE_NAME, column('rowid'))
+RULE_MATCHES_TABLE = table(RULE_MATCHES_TABLE_NAME, column('rule_hash'), column('email_id'))
+RULE_STALE_EMAILS_TABLE = table(RULE_STALE_EMAILS_TABLE_NAME, column('id'), column('email_id'))
+ATTACHMENTS_TABLE = table(
+    ATTACHMENTS_TABLE_NAME, column('email_id'), column('filename'), column('mime_type'), column('size'))
+# Comparisons of attachment_size conditions, by predicate
+SIZE_OPERATORS = {
+    RULE_PREDICATE_GREATER_THAN: operator.gt,
+    RULE_PREDICATE_LESSER_THAN: operator.lt,
+    RULE_PREDICATE_GREATER_THAN_EQUAL_TO: operator.ge,
+    RULE_PREDICATE_LESSER_THAN_EQUAL_TO: operator.le,
+}
+BODY_STORE_TABLE = table(BODY_STORE_TABLE_NAME, column('id'), column('codec'), column('dictionary_id'), column('data'))
+
+
+def stream_email_ids(
+    db_session: Any,
+    email_table: Any,
+    rule: Rule,
+    chunk_size: Optional[int] = QUERY_YIELD_PER_SIZE
+) -> Iterator[str]:
+    """
+    Stream the IDs of the emails matching the rule, fetched from the cursor chunk_size rows at a time.
+    Parameters:
+        db_session: sqlalchemy.orm.session.Session - database session, kept open while the IDs are consumed
+        email_table: EmailMessage - EmailMessage object
+        rule: Rule - rule object
+        chunk_size: int - number of rows fetched at once
+    """
+    query = db_session.query(email_table.message_id).filter(compile_rule(
+        email_table, rule, has_fulltext_index(db_session), get_dialect_name(db_session))).distinct()
+    for email in query.yield_per(chunk_size):
+        yield email.message_id
 
 
 def fetch_email_ids(db_session: Any, email_table: Any, rule: Rule) -> List[str]:
     """
     Fetch email IDs from the database based on the rule.
+    The whole rule is compiled into a single expression and executed in one query.
     Parameters:
         db_session: sqlalchemy.orm.session.Session - database session
         email_table: EmailMessage - EmailMessage object
@@ -15,61 +54,424 @@ def fetch_email_ids(db_session: Any, email_table: Any, rule: Rule) -> List[str]:
     """
     email_ids = []
     try:
-        query = db_session.query(email_table.message_id)
-        if rule.collection_predicate == RULE_COLLECTION_PREDICATE_ALL:
-            for condition in rule.conditions:
-                field = condition[RULE_CONDITION_KEY_FIELD]
-                predicate = condition[RULE_CONDITION_KEY_PREDICATE]
-                value = condition[RULE_CONDITION_KEY_VALUE]
-                if field == RULE_FIELD_RECEIVED_DATE:
-                    datetime_val = datetime.strptime(
-                        condition[RULE_CONDITION_KEY_VALUE], DATETIME_FORMAT)
-                    if predicate == RULE_PREDICATE_GREATER_THAN:
-                        query = query.filter(
-                            email_table.received_date > datetime_val)
-                    elif predicate == RULE_PREDICATE_LESSER_THAN:
-                        query = query.filter(
-                            email_table.received_date < datetime_val)
-                    elif predicate == RULE_PREDICATE_GREATER_THAN_EQUAL_TO:
-                        query = query.filter(
-                            email_table.received_date >= datetime_val)
-                    elif predicate == RULE_PREDICATE_LESSER_THAN_EQUAL_TO:
-                        query = query.filter(
-                            email_table.received_date <= datetime_val)
-                elif field in RULE_STRING_FIELDS:
-                    if predicate == RULE_PREDICATE_CONTAINS:
-                        query = query.filter(
-                            getattr(email_table, field).contains(value))
-                    elif predicate == RULE_PREDICATE_DOES_NOT_CONTAIN:
-                        query = query.filter(
-                            ~getattr(email_table, field).contains(value))
-            email_ids = [email.message_id for email in query.all()]
-
-        elif rule.collection_predicate == RULE_COLLECTION_PREDICATE_ANY:
-            for condition in rule.conditions:
-                field = condition[RULE_CONDITION_KEY_FIELD]
-                predicate = condition[RULE_CONDITION_KEY_PREDICATE]
-                value = condition[RULE_CONDITION_KEY_VALUE]
-                if field == RULE_FIELD_RECEIVED_DATE:
-                    if predicate == RULE_PREDICATE_GREATER_THAN:
-                        query = query.filter(email_table.received_date > value)
-                    elif predicate == RULE_PREDICATE_LESSER_THAN:
-                        query = query.filter(email_table.received_date < value)
-                    elif predicate == RULE_PREDICATE_GREATER_THAN_EQUAL_TO:
-                        query = query.filter(
-                            email_table.received_date >= value)
-                    elif predicate == RULE_PREDICATE_LESSER_THAN_EQUAL_TO:
-                        query = query.filter(
-                            email_table.received_date <= value)
-                elif field in RULE_STRING_FIELDS:
-                    if predicate == RULE_PREDICATE_CONTAINS:
-                        query = query.filter(
-                            getattr(email_table, field).contains(value))
-                    elif predicate == RULE_PREDICATE_DOES_NOT_CONTAIN:
-                        query = query.filter(
-                            ~getattr(email_table, field).contains(value))
-                email_ids.extend([email.message_id for email in query.all()])
+        with METRICS.timer('rule_query_seconds', rule=rule.name or 'unnamed'):
+            email_ids = list(stream_email_ids(db_session, email_table, rule))
+    except Exception as e:
+        logging.error(f"An error occurred while reading emails from db: {e}")
+    finally:
+        db_session.close()
+        return email_ids
+
+
+def restrict_to_message_ids(query: Any, email_table: Any, message_ids: Optional[List[str]]) -> Iterator[Any]:
+    """
+    Restrict the query to the given emails, split in queries binding a bounded number of IDs.
+    Yields the query unchanged when no message IDs are given.
+    Parameters:
+        query: sqlalchemy.orm.Query - query on the emails table
+        email_table: EmailMessage - EmailMessage object
+        message_ids: List[str] - IDs of the emails to restrict the query to
+    """
+    if message_ids is None:
+        yield query
+        return
+    for i in range(0, len(message_ids), QUERY_MESSAGE_IDS_CHUNK_SIZE):
+        yield query.filter(email_table.message_id.in_(message_ids[i:i + QUERY_MESSAGE_IDS_CHUNK_SIZE]))
+
+
+def stream_rule_matches(
+    db_session: Any,
+    email_table: Any,
+    rules: List[Rule],
+    message_ids: Optional[List[str]] = None,
+    chunk_size: Optional[int] = QUERY_YIELD_PER_SIZE
+) -> Iterator[Tuple[str, Optional[str], List[int]]]:
+    """
+    Evaluate all the rules in a single pass over the emails table, streaming the matches
+    from the cursor chunk_size rows at a time.
+    Yields the ID of each email matching at least one rule, with its stored label IDs
+    and the indexes of the rules it matches.
+    Parameters:
+        db_session: sqlalchemy.orm.session.Session - database session, kept open while the matches are consumed
+        email_table: EmailMessage - EmailMessage object
+        rules: List[Rule] - rule objects
+        message_ids: List[str] - IDs of the emails to evaluate, all emails when not given
+        chunk_size: int - number of rows fetched at once
+    """
+    use_fulltext_index, dialect_name = has_fulltext_index(db_session), get_dialect_name(db_session)
+    rule_filters = [compile_rule(email_table, rule, use_fulltext_index, dialect_name) for rule in rules]
+    query = db_session.query(
+        email_table.message_id,
+        email_table.label_ids,
+        *[case((rule_filter, True), else_=False) for rule_filter in rule_filters]
+    ).filter(or_(false(), *rule_filters))
+    for chunk_query in restrict_to_message_ids(query, email_table, message_ids):
+        for row in chunk_query.yield_per(chunk_size):
+            yield row[0], row[1], [index for index, matched in enumerate(row[2:]) if matched]
+
+
+def fetch_rule_matches(
+    db_session: Any,
+    email_table: Any,
+    rules: List[Rule],
+    message_ids: Optional[List[str]] = None
+) -> List[Tuple[str, Optional[str], List[int]]]:
+    """
+    Evaluate all the rules in a single pass over the emails table.
+    Returns the ID of each email matching at least one rule, with its stored label IDs
+    and the indexes of the rules it matches.
+    Parameters:
+        db_session: sqlalchemy.orm.session.Session - database session
+        email_table: EmailMessage - EmailMessage object
+        rules: List[Rule] - rule objects
+        message_ids: List[str] - IDs of the emails to evaluate, all emails when not given
+    """
+    matches = []
+    try:
+        with METRICS.timer('rule_matches_query_seconds'):
+            matches.extend(stream_rule_matches(db_session, email_table, rules, message_ids))
+    except Exception as e:
+        logging.error(f"An error occurred while reading emails from db: {e}")
+    finally:
+        db_session.close()
+        return matches
+
+
+def evaluate_rule_matches(
+    db_session: Any,
+    email_table: Any,
+    rule: Rule,
+    rule_hash: str,
+    after_email_id: int,
+    last_email_id: int,
+    last_stale_id: int
+) -> None:
+    """
+    Add the matches of the rule to the rule match cache, evaluating it only on the emails stored after
+    its watermark and the emails queued as stale, entirely in the database.
+    Parameters:
+        db_session: sqlalchemy.orm.session.Session - database session, committed by the caller
+        email_table: EmailMessage - EmailMessage object
+        rule: Rule - rule object
+        rule_hash: str - hash of the rule conditions
+        after_email_id: int - watermark of the rule, 0 when it was never evaluated
+        last_email_id: int - last email to evaluate, the new watermark of the rule
+        last_stale_id: int - last entry of the stale emails queue to evaluate
+    """
+    rule_filter = compile_rule(email_table, rule, has_fulltext_index(db_session), get_dialect_name(db_session))
+    stale_email_ids = select(RULE_STALE_EMAILS_TABLE.c.email_id).where(
+        RULE_STALE_EMAILS_TABLE.c.id <= last_stale_id)
+    db_session.execute(delete(RULE_MATCHES_TABLE).where(
+        RULE_MATCHES_TABLE.c.rule_hash == rule_hash, RULE_MATCHES_TABLE.c.email_id.in_(stale_email_ids)))
+    # New emails are a range of the primary key, stale ones are looked up by ID, each in its own statement
+    for scope in [
+        and_(email_table.id > after_email_id, email_table.id <= last_email_id),
+        and_(email_table.id.in_(stale_email_ids), email_table.id <= after_email_id),
+    ]:
+        db_session.execute(insert(RULE_MATCHES_TABLE).from_select(
+            ['rule_hash', 'email_id'], select(literal(rule_hash), email_table.id).where(scope, rule_filter)))
+
+
+def stream_cached_rule_matches(
+    db_session: Any,
+    email_table: Any,
+    rules: List[Rule],
+    chunk_size: Optional[int] = QUERY_YIELD_PER_SIZE
+) -> Iterator[Tuple[str, Optional[str], List[int]]]:
+    """
+    Stream the emails of the rule match cache matching any of the rules, fetched chunk_size rows at a time.
+    Yields the ID of each email with its stored label IDs and the indexes of the rules it matches,
+    like stream_rule_matches, without evaluating any rule.
+    Parameters:
+        db_session: sqlalchemy.orm.session.Session - database session, kept open while the matches are consumed
+        email_table: EmailMessage - EmailMessage object
+        rules: List[Rule] - rule objects
+        chunk_size: int - number of rows fetched at once
+    """
+    rule_indexes_by_hash = {}
+    for index, rule in enumerate(rules):
+        rule_indexes_by_hash.setdefault(rule.get_definition_hash(), []).append(index)
+    rule_hashes = list(rule_indexes_by_hash)
+    query = db_session.query(
+        email_table.message_id,
+        email_table.label_ids,
+        *[
+            select(RULE_MATCHES_TABLE.c.email_id).where(
+                RULE_MATCHES_TABLE.c.rule_hash == rule_hash, RULE_MATCHES_TABLE.c.email_id == email_table.id
+            ).exists()
+            for rule_hash in rule_hashes
+        ]
+    ).filter(email_table.id.in_(
+        select(RULE_MATCHES_TABLE.c.email_id).where(RULE_MATCHES_TABLE.c.rule_hash.in_(rule_hashes))))
+    for row in query.yield_per(chunk_size):
+        rule_indexes = sorted(
+            index
+            for rule_hash, matched in zip(rule_hashes, row[2:]) if matched
+            for index in rule_indexes_by_hash[rule_hash]
+        )
+        yield row[0], row[1], rule_indexes
+
+
+def get_dialect_name(db_session: Any) -> str:
+    """
+    Get the name of the database backend of the session, e.g. 'sqlite' or 'postgresql'.
+    Parameters:
+        db_session: sqlalchemy.orm.session.Session - database session
+    """
+    return db_session.get_bind().dialect.name
+
+
+def has_fulltext_index(db_session: Any) -> bool:
+    """
+    Check whether the database has the full-text index over email subjects and bodies.
+    Parameters:
+        db_session: sqlalchemy.orm.session.Session - database session
+    """
+    # Inspect through the session connection, a connection of its own could end the session transaction
+    return get_dialect_name(db_session) == 'sqlite' and inspect(db_session.connection()).has_table(FULLTEXT_TABLE_NAME)
+
+
+def compile_rule(email_table: Any, rule: Rule, use_fulltext_index: bool = False, dialect_name: str = 'sqlite') -> Any:
+    """
+    Compile the rule into a single SQL filter expression.
+    The expression is built once per table and backend, and cached on the rule.
+    Parameters:
+        email_table: EmailMessage - EmailMessage object
+        rule: Rule - rule object
+        use_fulltext_index: bool - whether 'contains' conditions can be routed through the full-text index
+        dialect_name: str - name of the database backend the expression runs on
+    """
+    def build() -> Any:
+        filters = [
+            build_condition_filter(email_table, condition, use_fulltext_index, dialect_name, parsed_value)
+            for condition, parsed_value in zip(rule.conditions, rule.condition_values)
+        ]
+        if rule.collection_predicate == RULE_COLLECTION_PREDICATE_ANY:
+            return or_(false(), *filters)
+        return and_(true(), *filters)
+
+    return rule.get_compiled(('sql', email_table, use_fulltext_index, dialect_name), build)
+
+
+def is_fulltext_compatible(condition: dict) -> bool:
+    """
+    Check whether a condition gives the same result through the trigram full-text index as with LIKE.
+    Values must be strings long enough to hold a trigram, ASCII since LIKE only folds ASCII case,
+    and free of LIKE wildcards. Other values, e.g. numbers, are left to LIKE.
+    Parameters:
+        condition: dict - rule condition
+    """
+    value = condition[RULE_CONDITION_KEY_VALUE]
+    return (
+        condition[RULE_CONDITION_KEY_FIELD] in RULE_FULLTEXT_FIELDS
+        and condition[RULE_CONDITION_KEY_PREDICATE] in RULE_CONTAINS_PREDICATES
+        and isinstance(value, str)
+        and len(value) >= FULLTEXT_MIN_VALUE_LENGTH
+        and value.isascii()
+        and '%' not in value and '_' not in value
+    )
+
+
+def build_fulltext_filter(email_table: Any, condition: dict) -> Any:
+    """
+    Build the SQL filter expression for a 'contains' condition, matched through the full-text index.
+    Parameters:
+        email_table: EmailMessage - EmailMessage object
+        condition: dict - rule condition
+    """
+    field = condition[RULE_CONDITION_KEY_FIELD]
+    phrase = condition[RULE_CONDITION_KEY_VALUE].replace('"', '""')
+    matching_ids = select(FULLTEXT_TABLE.c.rowid).where(
+        literal_column(FULLTEXT_TABLE_NAME).op('MATCH')(f'{field} : "{phrase}"'))
+    if condition[RULE_CONDITION_KEY_PREDICATE] == RULE_PREDICATE_CONTAINS:
+        return email_table.id.in_(matching_ids)
+    # Like NOT LIKE, never match emails where the field is NULL, without decompressing stored bodies
+    field_is_set = getattr(email_table, field).isnot(None)
+    if field == RULE_FIELD_BODY:
+        field_is_set = or_(field_is_set, email_table.body_id.isnot(None))
+    return and_(field_is_set, email_table.id.notin_(matching_ids))
+
+
+def get_field_expression(email_table: Any, field: str, dialect_name: str = 'sqlite') -> Any:
+    """
+    Get the SQL expression of a rule field.
+    Bodies of the body store are decompressed by the email_body SQL function,
+    only for the rows the condition is evaluated on.
+    Parameters:
+        email_table: EmailMessage - EmailMessage object
+        field: str - rule field
+        dialect_name: str - name of the database backend the expression runs on
+    """
+    if field != RULE_FIELD_BODY or dialect_name not in BODY_STORE_DIALECTS:
+        return getattr(email_table, field)
+    stored_body = select(getattr(func, BODY_STORE_SQL_FUNCTION)(
+        BODY_STORE_TABLE.c.codec, BODY_STORE_TABLE.c.dictionary_id, BODY_STORE_TABLE.c.data
+    )).where(BODY_STORE_TABLE.c.id == email_table.body_id).scalar_subquery()
+    return func.coalesce(email_table.body, stored_body)
+
+
+def build_equals_filter(email_table: Any, field: str, value: Any, dialect_name: str = 'sqlite') -> Any:
+    """
+    Build the case-insensitive SQL equality filter for a string field.
+    Sender fields compare against the indexed lowercase sender address and domain.
+    Values other than strings, e.g. numbers, are compared as text, like the column does.
+    Parameters:
+        email_table: EmailMessage - EmailMessage object
+        field: str - rule field
+        value: Any - value to compare with
+        dialect_name: str - name of the database backend the expression runs on
+    """
+    value = str(value)
+    if field == RULE_FIELD_FROM_ADDRESS:
+        return email_table.from_email == value.strip().lower()
+    elif field == RULE_FIELD_FROM_DOMAIN:
+        return email_table.from_domain == value.strip().lstrip('@').lower()
+    return func.lower(get_field_expression(email_table, field, dialect_name)) == value.lower()
+
+
+def build_contains_filter(email_table: Any, field: str, value: str, dialect_name: str = 'sqlite') -> Any:
+    """
+    Build the case-insensitive SQL substring filter for a string field.
+    LIKE ignores case on SQLite, other databases use ILIKE, served by a trigram index on PostgreSQL.
+    Parameters:
+        email_table: EmailMessage - EmailMessage object
+        field: str - rule field
+        value: str - substring to look for
+        dialect_name: str - name of the database backend the expression runs on
+    """
+    field_expression = get_field_expression(email_table, field, dialect_name)
+    if dialect_name in CASE_INSENSITIVE_LIKE_DIALECTS:
+        return field_expression.contains(value)
+    return field_expression.icontains(value)
+
+
+def build_attachment_filter(email_table: Any, condition: dict, dialect_name: str = 'sqlite') -> Any:
+    """
+    Build the SQL filter expression for a condition on the attachments of emails.
+    Positive conditions match the emails having any matching attachment, looked up through the indexes
+    of the attachments table. Negative ones match the emails having none, among the emails whose attachments are known.
+    Parameters:
+        email_table: EmailMessage - EmailMessage object
+        condition: dict - rule condition
+        dialect_name: str - name of the database backend the expression runs on
+    """
+    field = condition[RULE_CONDITION_KEY_FIELD]
+    predicate = condition[RULE_CONDITION_KEY_PREDICATE]
+    value = condition[RULE_CONDITION_KEY_VALUE]
+    if field == RULE_FIELD_HAS_ATTACHMENT:
+        if value == (predicate == RULE_PREDICATE_EQUALS):
+            return email_table.attachment_count > 0
+        return email_table.attachment_count == 0
+    if field == RULE_FIELD_ATTACHMENT_SIZE:
+        return email_table.id.in_(select(ATTACHMENTS_TABLE.c.email_id).where(
+            SIZE_OPERATORS[predicate](ATTACHMENTS_TABLE.c.size, value)))
+    if field == RULE_FIELD_ATTACHMENT_TYPE:
+        attachment_column = ATTACHMENTS_TABLE.c.mime_type
+        # Stored lowercase, compared as is so the index serves equality
+        attachment_match = attachment_column == value.lower()
+    else:
+        attachment_column = ATTACHMENTS_TABLE.c.filename
+        attachment_match = func.lower(attachment_column) == value.lower()
+    if predicate in RULE_CONTAINS_PREDICATES:
+        if dialect_name in CASE_INSENSITIVE_LIKE_DIALECTS:
+            attachment_match = attachment_column.contains(value)
+        else:
+            attachment_match = attachment_column.icontains(value)
+    matching = email_table.id.in_(select(ATTACHMENTS_TABLE.c.email_id).where(attachment_match))
+    if predicate in [RULE_PREDICATE_EQUALS, RULE_PREDICATE_CONTAINS]:
+        return matching
+    # Like the other negative conditions, never match emails whose attachments are not known
+    return and_(email_table.attachment_count.isnot(None), ~matching)
 
+
+def build_condition_filter(
+    email_table: Any,
+    condition: dict,
+    use_fulltext_index: bool = False,
+    dialect_name: str = 'sqlite',
+    parsed_value: Optional[Any] = None
+) -> Any:
+    """
+    Build the SQL filter expression for a single rule condition.
+    Parameters:
+        email_table: EmailMessage - EmailMessage object
+        condition: dict - rule condition
+        use_fulltext_index: bool - whether 'contains' conditions can be routed through the full-text index
+        dialect_name: str - name of the database backend the expression runs on
+        parsed_value: Any - value of the condition already parsed by the rule, parsed here when not given
+    """
+    field = condition[RULE_CONDITION_KEY_FIELD]
+    predicate = condition[RULE_CONDITION_KEY_PREDICATE]
+    value = condition[RULE_CONDITION_KEY_VALUE]
+    if use_fulltext_index and is_fulltext_compatible(condition):
+        return build_fulltext_filter(email_table, condition)
+    if field in RULE_ATTACHMENT_FIELDS:
+        return build_attachment_filter(email_table, condition, dialect_name)
+    if field == RULE_FIELD_RECEIVED_DATE:
+        datetime_val = parsed_value if parsed_value is not None else parse_rule_date(value)
+        if predicate == RULE_PREDICATE_GREATER_THAN:
+            return email_table.received_date > datetime_val
+        elif predicate == RULE_PREDICATE_LESSER_THAN:
+            return email_table.received_date < datetime_val
+        elif predicate == RULE_PREDICATE_GREATER_THAN_EQUAL_TO:
+            return email_table.received_date >= datetime_val
+        elif predicate == RULE_PREDICATE_LESSER_THAN_EQUAL_TO:
+            return email_table.received_date <= datetime_val
+    elif field in RULE_STRING_FIELDS:
+        if predicate in RULE_EQUALS_PREDICATES:
+            equals_filter = build_equals_filter(email_table, field, value, dialect_name)
+            return equals_filter if predicate == RULE_PREDICATE_EQUALS else ~equals_filter
+        elif predicate == RULE_PREDICATE_CONTAINS:
+            return build_contains_filter(email_table, field, value, dialect_name)
+        elif predicate == RULE_PREDICATE_DOES_NOT_CONTAIN:
+            return ~build_contains_filter(email_table, field, value, dialect_name)
+    raise ValueError(f"Unsupported condition: {condition}")
+
+
+def fetch_unhydrated_email_ids(
+    db_session: Any,
+    email_table: Any,
+    rule: Rule,
+    message_ids: Optional[List[str]] = None,
+    after_email_id: Optional[int] = None
+) -> List[str]:
+    """
+    Fetch IDs of emails stored from metadata only whose body or attachments are needed to evaluate the rule.
+    For 'All' rules these are the emails matching every other condition,
+    for 'Any' rules the emails matching none of the other conditions.
+    Parameters:
+        db_session: sqlalchemy.orm.session.Session - database session
+        email_table: EmailMessage - EmailMessage object
+        rule: Rule - rule object
+        message_ids: List[str] - IDs of the emails to consider, all emails when not given
+        after_email_id: int - watermark of the rule, only the emails stored after it
+            or queued as stale are considered when given
+    """
+    email_ids = []
+    try:
+        use_fulltext_index, dialect_name = has_fulltext_index(db_session), get_dialect_name(db_session)
+        other_filters = [
+            build_condition_filter(email_table, condition, use_fulltext_index, dialect_name, parsed_value)
+            for condition, parsed_value in zip(rule.conditions, rule.condition_values)
+            if condition[RULE_CONDITION_KEY_FIELD] not in RULE_FULL_MESSAGE_FIELDS
+        ]
+        missing_filters = []
+        if rule.has_condition_on(RULE_FIELD_BODY):
+            missing_filters.append(and_(email_table.body.is_(None), email_table.body_id.is_(None)))
+        if any(rule.has_condition_on(field) for field in RULE_ATTACHMENT_FIELDS):
+            missing_filters.append(email_table.attachment_count.is_(None))
+        query = db_session.query(email_table.message_id).filter(or_(false(), *missing_filters))
+        if after_email_id is not None:
+            query = query.filter(or_(
+                email_table.id > after_email_id,
+                email_table.id.in_(select(RULE_STALE_EMAILS_TABLE.c.email_id))))
+        if other_filters and rule.collection_predicate == RULE_COLLECTION_PREDICATE_ALL:
+            query = query.filter(and_(*other_filters))
+        elif other_filters and rule.collection_predicate == RULE_COLLECTION_PREDICATE_ANY:
+            # Conditions on NULL columns are unknown, coalesce them to false before negating
+            query = query.filter(~or_(*[func.coalesce(f, false()) for f in other_filters]))
+        for chunk_query in restrict_to_message_ids(query, email_table, message_ids):
+            email_ids.extend(email.message_id for email in chunk_query.all())
     except Exception as e:
         logging.error(f"An error occurred while reading emails from db: {e}")
     finally:
@@ -1,14 +1,42 @@
+import hashlib
 import json
 from datetime import datetime
 from email_processor.models.constants import *
 
+
+def parse_rule_date(value):
+    """Parse a date value of a rule condition."""
+    return datetime.strptime(value, DATETIME_FORMAT)
+
+
+def parse_condition_value(condition):
+    """Parse the value of a rule condition, dates of received_date conditions and strings as they are."""
+    if condition[RULE_CONDITION_KEY_FIELD] == RULE_FIELD_RECEIVED_DATE:
+        return parse_rule_date(condition[RULE_CONDITION_KEY_VALUE])
+    return condition[RULE_CONDITION_KEY_VALUE]
+
+
 class Rule:
     """Class to represent rules"""
-    def __init__(self, collection_predicate, conditions, actions):
+    def __init__(self, collection_predicate, conditions, actions, name=None,
+                 priority=RULE_DEFAULT_PRIORITY, stop_processing=False):
         """Initialize the rule."""
         self.collection_predicate = collection_predicate
         self.conditions = conditions
         self.actions = actions
+        self.name = name
+        self.priority = priority
+        self.stop_processing = stop_processing
+        # Values of the conditions parsed once, e.g. dates, in condition order
+        self.condition_values = [parse_condition_value(condition) for condition in conditions]
+        # Compiled forms of the rule, e.g. SQL filters by database backend, built on first use
+        self.compiled = {}
+
+    def get_compiled(self, key, build):
+        """Get the compiled form of the rule identified by key, e.g. its SQL filter for a backend, built on first use."""
+        if key not in self.compiled:
+            self.compiled[key] = build()
+        return self.compiled[key]
 
     @classmethod
     def from_dict(cls, data):
@@ -20,11 +48,30 @@ class Rule:
         conditions = data[RULE_KEY_CONDITIONS]
         actions = data[RULE_KEY_ACTIONS]
 
+        name = data.get(RULE_KEY_NAME)
+        priority = data.get(RULE_KEY_PRIORITY, RULE_DEFAULT_PRIORITY)
+        stop_processing = data.get(RULE_KEY_STOP_PROCESSING, False)
+
         cls.validate_collection_predicate(collection_predicate)
         cls.validate_conditions(conditions)
         cls.validate_actions(actions)
+        cls.validate_processing_order(priority, stop_processing)
 
-        return cls(collection_predicate, conditions, actions)
+        return cls(collection_predicate, conditions, actions, name, priority, stop_processing)
+
+    @classmethod
+    def list_from_json(cls, data):
+        """
+        Create rules from a JSON rule set, either a single rule or a list of rules.
+        Rules are returned in evaluation order: by ascending priority, then in file order.
+        """
+        if isinstance(data, dict):
+            data = [data]
+        if not isinstance(data, list):
+            raise ValueError("Rules must be a rule object or a list of rule objects")
+
+        rules = [cls.from_dict(rule_data) for rule_data in data]
+        return sorted(rules, key=lambda rule: rule.priority)
 
     @classmethod
     def validate_collection_predicate(cls, collection_predicate):
@@ -47,9 +94,20 @@ class Rule:
                     raise ValueError(f"Invalid predicate for the received_date field. Allowed predicates are {', '.join(RULE_RECEIVED_DATE_PREDICATES)}")
                 else:
                     try:
-                        datetime.strptime(condition[RULE_CONDITION_KEY_VALUE], DATETIME_FORMAT)
+                        parse_rule_date(condition[RULE_CONDITION_KEY_VALUE])
                     except ValueError:
                         raise ValueError(f"Invalid date format in the condition. Accepted format is '{DATETIME_FORMAT}'")
+            elif condition[RULE_CONDITION_KEY_FIELD] == RULE_FIELD_HAS_ATTACHMENT:
+                if condition[RULE_CONDITION_KEY_PREDICATE] not in RULE_EQUALS_PREDICATES:
+                    raise ValueError(f"Invalid predicate for the has_attachment field. Allowed predicates are {', '.join(RULE_EQUALS_PREDICATES)}")
+                if not isinstance(condition[RULE_CONDITION_KEY_VALUE], bool):
+                    raise ValueError("Invalid value for the has_attachment field, expected true or false")
+            elif condition[RULE_CONDITION_KEY_FIELD] == RULE_FIELD_ATTACHMENT_SIZE:
+                if condition[RULE_CONDITION_KEY_PREDICATE] not in RULE_ATTACHMENT_SIZE_PREDICATES:
+                    raise ValueError(f"Invalid predicate for the attachment_size field. Allowed predicates are {', '.join(RULE_ATTACHMENT_SIZE_PREDICATES)}")
+                value = condition[RULE_CONDITION_KEY_VALUE]
+                if not isinstance(value, int) or isinstance(value, bool) or value < 0:
+                    raise ValueError("Invalid value for the attachment_size field, expected a size in bytes")
             elif condition[RULE_CONDITION_KEY_PREDICATE] not in RULE_STRING_FIELDS_PREDICATES:
                 raise ValueError(f"Invalid predicate for the field. Allowed predicates are {', '.join(RULE_STRING_FIELDS_PREDICATES)}")
 
@@ -60,6 +118,32 @@ class Rule:
             if action not in RULE_ACTIONS:
                 raise ValueError(f"Invalid action. Allowed actions are {', '.join(RULE_ACTIONS)}")
 
+    @classmethod
+    def validate_processing_order(cls, priority, stop_processing):
+        """Validate the priority and stop processing flag."""
+        if not isinstance(priority, int) or isinstance(priority, bool):
+            raise ValueError("Rule priority must be an integer")
+        if not isinstance(stop_processing, bool):
+            raise ValueError("Rule stop_processing flag must be a boolean")
+
+    def get_definition_hash(self):
+        """
+        Get the hash of what decides which emails the rule matches, i.e. its conditions and collection predicate.
+        Rules differing only by their actions or processing order share the hash, and their cached matches.
+        """
+        definition = json.dumps(
+            [RULE_MATCH_CACHE_VERSION, self.collection_predicate, self.conditions], sort_keys=True)
+        return hashlib.sha256(definition.encode()).hexdigest()
+
+    def has_condition_on(self, field):
+        """Check whether any condition of the rule is on the given field."""
+        return any(condition[RULE_CONDITION_KEY_FIELD] == field for condition in self.conditions)
+
+    def needs_full_message(self):
+        """Check whether any condition of the rule is on a field only known once the full message is fetched."""
+        return any(condition[RULE_CONDITION_KEY_FIELD] in RULE_FULL_MESSAGE_FIELDS for condition in self.conditions)
+
     def __repr__(self):
         """Return the string representation of the rule."""
-        return f"Rule(collection_predicate={self.collection_predicate}, conditions={self.conditions}, actions={self.actions})"
+        return (f"Rule(name={self.name}, priority={self.priority}, stop_processing={self.stop_processing}, "
+                f"collection_predicate={self.collection_predicate}, conditions={self.conditions}, actions={self.actions})")
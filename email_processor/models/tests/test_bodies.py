@@ -0,0 +1,40 @@
+import importlib.util
+import unittest
+from email_processor.models import bodies
+
+
+class TestBodies(unittest.TestCase):
+    def setUp(self):
+        self.body = 'Top stories of the week, amount due on your subscription. ' * 10
+
+    def test_compress_body_when_codec_is_zlib(self):
+        # Call the function
+        data = bodies.compress_body(self.body, 'zlib')
+
+        # Assert that the body round trips and shrinks
+        self.assertLess(len(data), len(self.body))
+        self.assertEqual(bodies.decompress_body('zlib', None, data), self.body)
+
+    def test_compress_body_when_dictionary_is_used(self):
+        dictionary_id = bodies.register_dictionary(self.body.encode())
+
+        # Call the function
+        data = bodies.compress_body(self.body, 'zlib', dictionary_id)
+
+        # Assert that the dictionary shrinks the body further, and is needed to decompress it
+        self.assertLess(len(data), len(bodies.compress_body(self.body, 'zlib')))
+        self.assertEqual(bodies.decompress_body('zlib', dictionary_id, data), self.body)
+        with self.assertRaises(ValueError):
+            bodies.decompress_body('zlib', 'unknown', data)
+
+    @unittest.skipUnless(importlib.util.find_spec('zstandard'), 'zstandard is not installed')
+    def test_compress_body_when_codec_is_zstd(self):
+        data = bodies.compress_body(self.body, 'zstd')
+        self.assertEqual(bodies.decompress_body('zstd', None, data), self.body)
+
+    def test_decompress_body_sql_when_body_is_missing(self):
+        self.assertIsNone(bodies.decompress_body_sql(None, None, None))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,451 @@
+import os
+import tempfile
+import unittest
+from datetime import datetime
+from unittest.mock import MagicMock, patch
+from sqlalchemy import create_engine, inspect, text
+from sqlalchemy.orm import sessionmaker
+from email_processor.models import emails
+from email_processor.models.rules import Rule
+
+
+class TestEmails(unittest.TestCase):
+    def setUp(self):
+        # Use an in-memory database for each test
+        self.engine = create_engine('sqlite://')
+        emails.BASE.metadata.create_all(self.engine)
+        self.session_patcher = patch.object(emails, 'DB_SESSION', sessionmaker(bind=self.engine))
+        self.session_patcher.start()
+
+    def tearDown(self):
+        self.session_patcher.stop()
+
+    def build_email(self, message_id, subject):
+        return {
+            'message_id': message_id,
+            'from_address': 'Sender <sender@example.com>',
+            'to_address': 'test@example.com',
+            'subject': subject,
+            'received_date': datetime(2024, 3, 8),
+            'body': 'body'
+        }
+
+    def test_upsert_emails_when_emails_are_new(self):
+        # Call the function
+        emails.upsert_emails([self.build_email('1', 'First'), self.build_email('2', 'Second')])
+
+        # Assert that both emails were inserted
+        session = emails.DB_SESSION()
+        self.assertEqual(session.query(emails.EmailMessage).count(), 2)
+        session.close()
+
+    def test_upsert_emails_when_emails_are_refetched(self):
+        # Insert the email once
+        emails.upsert_emails([self.build_email('1', 'First')])
+
+        # Call the function with a refetched copy, twice in the same batch
+        emails.upsert_emails([self.build_email('1', 'Stale'), self.build_email('1', 'Updated')])
+
+        # Assert that the existing row was updated instead of duplicated
+        session = emails.DB_SESSION()
+        rows = session.query(emails.EmailMessage).all()
+        self.assertEqual(len(rows), 1)
+        self.assertEqual(rows[0].subject, 'Updated')
+        session.close()
+
+    def test_upsert_emails_when_body_is_not_fetched(self):
+        # Insert the email with its body, then refetch its metadata only
+        emails.upsert_emails([self.build_email('1', 'First')])
+        metadata = self.build_email('1', 'Updated')
+        del metadata['body']
+        emails.upsert_emails([metadata])
+
+        # Assert that the stored body was kept
+        session = emails.DB_SESSION()
+        row = session.query(emails.EmailMessage).one()
+        self.assertEqual((row.subject, row.body), ('Updated', 'body'))
+        session.close()
+
+    def test_get_unhydrated_email_ids(self):
+        # Store emails from metadata only, except for email 3
+        for message_id, subject in [('1', 'Invoice'), ('2', 'Newsletter'), ('3', 'Invoice')]:
+            email_message = self.build_email(message_id, subject)
+            if message_id != '3':
+                del email_message['body']
+            emails.upsert_emails([email_message])
+
+        conditions = [
+            {'field': 'subject', 'predicate': 'contains', 'value': 'Invoice'},
+            {'field': 'body', 'predicate': 'contains', 'value': 'paid'},
+        ]
+        all_rule = Rule.from_dict({'collection_predicate': 'All', 'conditions': conditions, 'actions': {}})
+        any_rule = Rule.from_dict({'collection_predicate': 'Any', 'conditions': conditions, 'actions': {}})
+
+        # Assert that only bodies able to change the rule result are requested
+        self.assertEqual(emails.get_unhydrated_email_ids(all_rule), ['1'])
+        self.assertEqual(emails.get_unhydrated_email_ids(any_rule), ['2'])
+
+    def test_upsert_emails_when_attachments_are_refetched(self):
+        invoice = {'filename': 'invoice.pdf', 'mime_type': 'application/pdf', 'size': 120000}
+        logo = {'filename': None, 'mime_type': 'image/png', 'size': 2048}
+        email_message = self.build_email('1', 'Invoice')
+        email_message['attachments'] = [invoice, logo]
+        emails.upsert_emails([email_message])
+
+        # Call the function with a refetched copy holding a single attachment
+        emails.upsert_emails([{'message_id': '1', 'body': 'body', 'attachments': [invoice]}])
+
+        # Assert that the attachments were replaced and counted
+        session = emails.DB_SESSION()
+        email_row = session.query(emails.EmailMessage).one()
+        attachment_rows = session.query(emails.EmailAttachment).all()
+        self.assertEqual(email_row.attachment_count, 1)
+        self.assertEqual(
+            [(row.email_id, row.filename, row.mime_type, row.size) for row in attachment_rows],
+            [(email_row.id, 'invoice.pdf', 'application/pdf', 120000)])
+        session.close()
+
+    def test_get_unhydrated_email_ids_when_rule_is_on_attachments(self):
+        # Store email 1 from metadata only, email 2 with its attachments known
+        emails.upsert_emails([{**self.build_email('1', 'Invoice'), 'body': None}])
+        emails.upsert_emails([{**self.build_email('2', 'Invoice'), 'attachments': []}])
+        rule = Rule.from_dict({'collection_predicate': 'All', 'conditions': [
+            {'field': 'subject', 'predicate': 'contains', 'value': 'Invoice'},
+            {'field': 'has_attachment', 'predicate': 'equals', 'value': True},
+        ], 'actions': {}})
+
+        # Assert that only emails whose attachments are unknown are requested
+        self.assertEqual(emails.get_unhydrated_email_ids(rule), ['1'])
+
+    def test_create_database_when_emails_table_is_outdated(self):
+        # Create the emails table as shipped by the first version
+        engine = create_engine('sqlite://')
+        with engine.begin() as connection:
+            connection.execute(text(
+                "CREATE TABLE emails (id INTEGER PRIMARY KEY, message_id VARCHAR NOT NULL UNIQUE, "
+                "from_address VARCHAR, to_address VARCHAR, subject VARCHAR, received_date DATETIME, body TEXT)"))
+            connection.execute(text(
+                "INSERT INTO emails (message_id, from_address) VALUES ('1', 'Sender <Sender@Example.COM>')"))
+
+        # Call the function
+        emails.BASE.metadata.create_all(engine)
+
+        # Assert that the new columns were added, indexed and filled
+        inspector = inspect(engine)
+        self.assertTrue({'from_email', 'from_domain'} <= {column['name'] for column in inspector.get_columns('emails')})
+        indexed_columns = {index['column_names'][0] for index in inspector.get_indexes('emails')}
+        self.assertTrue({'from_email', 'from_domain', 'received_date'} <= indexed_columns)
+        with engine.connect() as connection:
+            row = connection.execute(text("SELECT from_email, from_domain FROM emails")).one()
+        self.assertEqual(tuple(row), ('sender@example.com', 'example.com'))
+
+    def test_upsert_emails_when_sender_is_parsed(self):
+        # Call the function
+        emails.upsert_emails([self.build_email('1', 'First')])
+
+        # Assert that the sender address and domain were normalized
+        session = emails.DB_SESSION()
+        row = session.query(emails.EmailMessage).one()
+        self.assertEqual((row.from_email, row.from_domain), ('sender@example.com', 'example.com'))
+        session.close()
+
+    def test_get_cached_labels_when_labels_are_saved(self):
+        # Call the function
+        emails.save_labels({'Invoices': 'Label_1'})
+
+        # Assert that the labels are returned while fresh only
+        self.assertEqual(emails.get_cached_labels(60), {'Invoices': 'Label_1'})
+        self.assertIsNone(emails.get_cached_labels(-1))
+
+    def test_update_email_labels_when_labels_are_modified(self):
+        email_message = self.build_email('1', 'First')
+        email_message['label_ids'] = emails.serialize_label_ids(['UNREAD', 'INBOX'])
+        emails.upsert_emails([email_message])
+        emails.upsert_emails([self.build_email('2', 'Second')])
+
+        # Call the function
+        emails.update_email_labels(['1', '2'], ['Label_1'], ['UNREAD'])
+
+        # Assert that known labels were updated and unknown ones left alone
+        session = emails.DB_SESSION()
+        labels = dict(session.query(emails.EmailMessage.message_id, emails.EmailMessage.label_ids))
+        session.close()
+        self.assertEqual(emails.parse_label_ids(labels['1']), {'INBOX', 'Label_1'})
+        self.assertIsNone(emails.parse_label_ids(labels['2']))
+
+    def test_complete_label_action_when_ids_are_chunked(self):
+        for message_id in ['1', '2', '3']:
+            email_message = self.build_email(message_id, 'First')
+            email_message['label_ids'] = emails.serialize_label_ids(['UNREAD'])
+            emails.upsert_emails([email_message])
+        [action_id] = emails.enqueue_label_actions([(['1', '2', '3'], ['Label_1'], ['UNREAD'])])
+
+        # Call the function, binding at most two message IDs per query
+        with patch.object(emails, 'QUERY_MESSAGE_IDS_CHUNK_SIZE', 2):
+            emails.complete_label_action(action_id)
+
+        # Assert that the labels of every email were updated
+        session = emails.DB_SESSION()
+        labels = dict(session.query(emails.EmailMessage.message_id, emails.EmailMessage.label_ids))
+        session.close()
+        self.assertEqual({emails.parse_label_ids(label_ids) == {'Label_1'} for label_ids in labels.values()}, {True})
+        self.assertEqual(len(labels), 3)
+
+    def test_fail_label_action_when_database_write_fails(self):
+        session = MagicMock()
+        session.commit.side_effect = RuntimeError('disk I/O error')
+
+        # Assert that the errors are raised, so the caller doesn't go on as if they were saved
+        with patch.object(emails, 'get_session', return_value=session):
+            with self.assertRaises(RuntimeError):
+                emails.fail_label_action(1, 'error', True)
+            with self.assertRaises(RuntimeError):
+                emails.update_email_labels(['1'], ['Label_1'], [])
+        self.assertEqual(session.rollback.call_count, 2)
+
+    def test_apply_email_label_changes_when_history_is_read(self):
+        for message_id in ['1', '2']:
+            email_message = self.build_email(message_id, 'First')
+            email_message['label_ids'] = emails.serialize_label_ids(['UNREAD', 'INBOX'])
+            emails.upsert_emails([email_message])
+
+        # Call the function, for an email not stored too
+        emails.apply_email_label_changes({
+            '1': ({'Label_1'}, {'UNREAD'}),
+            '2': ({'STARRED'}, set()),
+            '3': ({'STARRED'}, set()),
+        })
+
+        # Assert that each email got its own changes
+        session = emails.DB_SESSION()
+        labels = dict(session.query(emails.EmailMessage.message_id, emails.EmailMessage.label_ids))
+        session.close()
+        self.assertEqual(emails.parse_label_ids(labels['1']), {'INBOX', 'Label_1'})
+        self.assertEqual(emails.parse_label_ids(labels['2']), {'INBOX', 'STARRED', 'UNREAD'})
+        self.assertEqual(set(labels), {'1', '2'})
+
+    def test_save_history_id_when_sync_state_exists(self):
+        # Call the function twice for the same mailbox
+        emails.save_history_id('test@example.com', '100')
+        emails.save_history_id('test@example.com', '120')
+
+        # Assert that the latest history ID is returned
+        self.assertEqual(emails.get_history_id('test@example.com'), '120')
+        self.assertIsNone(emails.get_history_id('other@example.com'))
+
+    def test_create_database_engine_when_database_is_sqlite(self):
+        with tempfile.TemporaryDirectory() as directory:
+            engine = emails.create_database_engine(f"sqlite:///{os.path.join(directory, 'email.db')}")
+
+            # Assert that connections run in WAL mode and wait for the write lock
+            with engine.connect() as connection:
+                self.assertEqual(connection.execute(text("PRAGMA journal_mode")).scalar(), 'wal')
+                self.assertEqual(connection.execute(text("PRAGMA busy_timeout")).scalar(), 30000)
+            engine.dispose()
+
+    def test_upsert_emails_when_body_store_is_enabled(self):
+        newsletter = 'Top stories of the week, amount due on your subscription. ' * 10
+        email_messages = [self.build_email(message_id, 'Digest') for message_id in ['1', '2', '3']]
+        email_messages[0]['body'] = email_messages[1]['body'] = newsletter
+
+        # Call the function
+        with patch.object(emails, 'BODY_STORE_ENABLED', True):
+            emails.upsert_emails(email_messages)
+
+        # Assert that the identical bodies were stored once, and the short one kept inline
+        session = emails.DB_SESSION()
+        self.assertEqual(session.query(emails.EmailBody).count(), 1)
+        rows = session.query(emails.EmailMessage).order_by(emails.EmailMessage.message_id).all()
+        self.assertEqual([row.body for row in rows], [None, None, 'body'])
+        self.assertEqual(rows[0].body_id, rows[1].body_id)
+        session.close()
+
+        # Assert that body conditions read stored bodies, with and without the full-text index
+        for value in ['AMOUNT DUE', '%of the week%']:
+            rule = Rule.from_dict({
+                'collection_predicate': 'All',
+                'conditions': [{'field': 'body', 'predicate': 'contains', 'value': value}],
+                'actions': {}
+            })
+            self.assertEqual(sorted(emails.get_email_ids_for_rules(rule)), ['1', '2'])
+        rule = Rule.from_dict({
+            'collection_predicate': 'All',
+            'conditions': [{'field': 'body', 'predicate': 'does not contain', 'value': 'amount due'}],
+            'actions': {}
+        })
+        self.assertEqual(emails.get_email_ids_for_rules(rule), ['3'])
+        self.assertEqual(emails.get_unhydrated_email_ids(rule), [])
+
+    def test_upsert_emails_when_stored_bodies_are_replaced(self):
+        newsletter = 'Top stories of the week, amount due on your subscription. ' * 10
+        email_messages = [self.build_email(message_id, 'Digest') for message_id in ['1', '2']]
+        for email_message in email_messages:
+            email_message['body'] = newsletter
+
+        # Replace the shared body of one email, then the bodies of both
+        with patch.object(emails, 'BODY_STORE_ENABLED', True):
+            emails.upsert_emails(email_messages)
+            email_messages[0]['body'] = newsletter.upper()
+            emails.upsert_emails(email_messages[:1])
+            session = emails.DB_SESSION()
+            # Assert that a body still referenced by another email is kept
+            self.assertEqual(session.query(emails.EmailBody).count(), 2)
+            session.close()
+            email_messages[1]['body'] = 'short'
+            emails.upsert_emails(email_messages[1:])
+
+        # Assert that the bodies no email references any more were deleted
+        session = emails.DB_SESSION()
+        [body] = session.query(emails.EmailBody).all()
+        self.assertEqual(session.query(emails.EmailMessage.body_id).filter_by(message_id='1').scalar(), body.id)
+        session.close()
+
+    def test_compress_stored_bodies_when_bodies_are_inline(self):
+        newsletter = 'Top stories of the week, amount due on your subscription. ' * 10
+        email_message = self.build_email('1', 'Digest')
+        email_message['body'] = newsletter
+        emails.upsert_emails([email_message])
+
+        # Call the function
+        self.assertEqual(emails.compress_stored_bodies(), 1)
+
+        # Assert that the body was moved and is still found through the full-text index
+        session = emails.DB_SESSION()
+        row = session.query(emails.EmailMessage).one()
+        self.assertIsNone(row.body)
+        self.assertIsNotNone(row.body_id)
+        session.close()
+        rule = Rule.from_dict({
+            'collection_predicate': 'All',
+            'conditions': [{'field': 'body', 'predicate': 'contains', 'value': 'subscription'}],
+            'actions': {}
+        })
+        self.assertEqual(emails.get_email_ids_for_rules(rule), ['1'])
+        self.assertEqual(emails.compress_stored_bodies(), 0)
+
+    @patch('email_processor.models.emails.compress_stored_bodies')
+    def test_create_database_when_bodies_were_moved(self, mock_compress_stored_bodies):
+        # Call the function on every run, the body store being disabled for the third one
+        with patch.object(emails, 'BODY_STORE_ENABLED', True):
+            emails.create_database()
+            emails.create_database()
+        self.assertEqual(emails.get_schema_version(self.engine), emails.BODY_STORE_SCHEMA_VERSION)
+        emails.create_database()
+        self.assertEqual(emails.get_schema_version(self.engine), 0)
+        with patch.object(emails, 'BODY_STORE_ENABLED', True):
+            emails.create_database()
+
+        # Assert that the emails table was scanned once, and again after bodies may have been stored inline
+        self.assertEqual(mock_compress_stored_bodies.call_count, 2)
+
+    def test_refresh_rule_matches_when_emails_change(self):
+        invoice_rule = Rule.from_dict({
+            'collection_predicate': 'All',
+            'conditions': [{'field': 'body', 'predicate': 'contains', 'value': 'amount due'}],
+            'actions': {'mark_as_read': True}
+        })
+        digest_rule = Rule.from_dict({
+            'collection_predicate': 'Any',
+            'conditions': [{'field': 'subject', 'predicate': 'equals', 'value': 'digest'}],
+            'actions': {'move_to_folder': 'News'}
+        })
+        rules = [invoice_rule, digest_rule]
+        email_messages = [self.build_email('1', 'Invoice'), self.build_email('2', 'Digest')]
+        email_messages[0]['body'] = 'Amount due'
+        emails.upsert_emails(email_messages)
+
+        def get_cached_matches():
+            emails.refresh_rule_matches(rules)
+            cached_matches = sorted(emails.iter_cached_rule_matches(rules))
+            # Assert that the cache gives the result of evaluating every email
+            self.assertEqual(cached_matches, sorted(emails.get_rule_matches(rules)))
+            return cached_matches
+
+        self.assertEqual(get_cached_matches(), [('1', None, [0]), ('2', None, [1])])
+        self.assertEqual(set(emails.get_rule_watermarks(rules).values()), {2})
+
+        # Store a new email and change the body of an evaluated one
+        new_email = self.build_email('3', 'Digest')
+        new_email['body'] = 'Amount due'
+        emails.upsert_emails([new_email])
+        emails.upsert_emails([{'message_id': '1', 'body': 'Paid'}])
+        emails.upsert_emails([{'message_id': '1', 'body': 'Paid'}])
+
+        # Assert that the changed email was queued once, then evaluated again, and the new one evaluated
+        session = emails.DB_SESSION()
+        self.assertEqual(session.query(emails.RuleStaleEmail.email_id).all(), [(1,)])
+        session.close()
+        self.assertEqual(get_cached_matches(), [('2', None, [1]), ('3', None, [0, 1])])
+        session = emails.DB_SESSION()
+        self.assertEqual(session.query(emails.RuleStaleEmail).count(), 0)
+        session.close()
+
+        # Assert that editing the conditions of a rule drops its cached matches
+        rules[1] = Rule.from_dict({
+            'collection_predicate': 'Any',
+            'conditions': [{'field': 'subject', 'predicate': 'equals', 'value': 'invoice'}],
+            'actions': {'move_to_folder': 'News'}
+        })
+        self.assertEqual(get_cached_matches(), [('1', None, [1]), ('3', None, [0])])
+        session = emails.DB_SESSION()
+        self.assertEqual(session.query(emails.RuleWatermark).count(), 2)
+        session.close()
+
+    def test_refresh_rule_matches_when_database_is_postgresql(self):
+        session = MagicMock()
+        session.get_bind().dialect.name = 'postgresql'
+
+        # Call the function
+        with patch.object(emails, 'get_session', return_value=session):
+            emails.refresh_rule_matches([])
+
+        # Assert that emails can't be committed below the watermarks while they are read
+        self.assertEqual(
+            str(session.execute.call_args_list[0].args[0]), 'LOCK TABLE emails IN SHARE ROW EXCLUSIVE MODE')
+        session.commit.assert_called_once()
+
+    def test_upsert_emails_when_messages_are_written_again(self):
+        email_message = self.build_email('1', 'Digest')
+        email_message['body'] = 'Top stories of the week, amount due on your subscription. ' * 10
+        email_message['attachments'] = [{'filename': 'notes.txt', 'mime_type': 'text/plain', 'size': 10}]
+        original = dict(email_message)
+
+        # Call the function twice on the same messages, like a retry after a failed commit
+        with patch.object(emails, 'BODY_STORE_ENABLED', True):
+            emails.upsert_emails([email_message])
+            emails.upsert_emails([email_message])
+
+        # Assert that the messages were left unchanged, so the second write kept the body and attachments
+        self.assertEqual(email_message, original)
+        session = emails.DB_SESSION()
+        row = session.query(emails.EmailMessage).one()
+        self.assertIsNotNone(row.body_id)
+        self.assertEqual(row.attachment_count, 1)
+        self.assertEqual(session.query(emails.EmailAttachment).count(), 1)
+        session.close()
+
+    def test_upsert_emails_when_messages_hold_different_keys(self):
+        email_message = self.build_email('2', 'Second')
+        del email_message['body']
+
+        # Assert that the batch is rejected instead of nulling or dropping columns
+        with self.assertRaises(ValueError):
+            emails.upsert_emails([self.build_email('1', 'First'), email_message])
+        session = emails.DB_SESSION()
+        self.assertEqual(session.query(emails.EmailMessage).count(), 0)
+        session.close()
+
+    def test_upsert_emails_when_database_is_not_supported(self):
+        session = MagicMock()
+        session.get_bind().dialect.name = 'mysql'
+
+        # Assert that the error is raised before anything is written
+        with patch.object(emails, 'get_session', return_value=session):
+            with self.assertRaises(ValueError):
+                emails.upsert_emails([self.build_email('1', 'First')])
+        session.execute.assert_not_called()
+        session.close.assert_called_once()
+
+
+if __name__ == '__main__':
+    unittest.main()
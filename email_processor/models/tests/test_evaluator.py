@@ -0,0 +1,117 @@
+import copy
+import itertools
+import unittest
+from datetime import datetime, timedelta, timezone
+from unittest.mock import patch
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from email_processor.models import emails
+from email_processor.models.evaluator import evaluate_rule, match_rules, MissingFieldError
+from email_processor.models.query import fetch_rule_matches
+from email_processor.models.rules import Rule
+
+EMAILS = [
+    {'message_id': '1', 'from_address': 'News <News@Example.com>', 'to_address': 'me@example.com',
+     'subject': 'Weekly digest', 'received_date': datetime(2024, 3, 1, 23, 30, tzinfo=timezone(timedelta(hours=-5))),
+     'body': 'Top stories: 100% free', 'label_ids': 'INBOX,UNREAD', 'attachments': []},
+    {'message_id': '2', 'from_address': 'billing@shop.example.org', 'to_address': 'me@example.com',
+     'subject': 'INVOICE_2024', 'received_date': datetime(2024, 3, 10), 'body': 'Amount due\nby Friday',
+     'label_ids': 'INBOX', 'attachments': [
+         {'filename': 'Invoice_March.PDF', 'mime_type': 'application/pdf', 'size': 120000},
+         {'filename': None, 'mime_type': 'image/png', 'size': 2048}]},
+    {'message_id': '3', 'from_address': 'Émile <émile@exämple.fr>', 'to_address': 'me@example.com',
+     'subject': 'Résumé ÉTÉ', 'received_date': datetime(2024, 3, 8), 'body': None, 'label_ids': None,
+     'attachments': [{'filename': 'Résumé.docx', 'mime_type': 'application/msword', 'size': 5000}]},
+    {'message_id': '4', 'from_address': '', 'to_address': 'me@example.com',
+     'subject': '', 'received_date': datetime(2024, 3, 8, 0, 0, 1), 'body': '', 'label_ids': '', 'attachments': []},
+]
+
+CONDITIONS = [
+    ('from_address', ['news@example.com', 'NEWS', 'example', 'shop.example.org', 'émile@exämple.fr', 'ÉMILE']),
+    ('from_domain', ['example.com', '@Example.com', 'example', 'exämple.fr']),
+    ('to_address', ['ME@example.com', 'me']),
+    ('subject', ['invoice', 'INVOICE_2024', 'invoice%2024', 'invoice_2024', 'résumé été', 'ÉTÉ', 'été', 'digest', '', 2024]),
+    ('body', ['100%', 'due by', 'due_by', 'top stories', 'amount', '']),
+    ('attachment_type', ['application/pdf', 'APPLICATION/PDF', 'pdf', 'image', 'word']),
+    ('attachment_name', ['invoice', 'invoice_march.pdf', '.PDF', 'résumé.docx', 'RÉSUMÉ', '_march']),
+]
+DATES = ['01-03-2024', '02-03-2024', '08-03-2024', '10-03-2024']
+SIZES = [0, 2048, 5000, 100000]
+
+
+class TestEvaluator(unittest.TestCase):
+    def setUp(self):
+        # Store the emails the way fetched emails are stored, in an in-memory database
+        engine = create_engine('sqlite://')
+        emails.BASE.metadata.create_all(engine)
+        self.db_session = sessionmaker(bind=engine)
+        with patch.object(emails, 'DB_SESSION', self.db_session):
+            emails.upsert_emails(copy.deepcopy(EMAILS))
+
+    def build_rules(self):
+        conditions = [
+            {'field': field, 'predicate': predicate, 'value': value}
+            for field, values in CONDITIONS for value in values
+            for predicate in ['contains', 'does not contain', 'equals', 'does not equal']
+        ] + [
+            {'field': 'received_date', 'predicate': predicate, 'value': value}
+            for value in DATES for predicate in ['gt', 'gte', 'lt', 'lte']
+        ] + [
+            {'field': 'attachment_size', 'predicate': predicate, 'value': value}
+            for value in SIZES for predicate in ['gt', 'gte', 'lt', 'lte']
+        ] + [
+            {'field': 'has_attachment', 'predicate': predicate, 'value': value}
+            for value in [True, False] for predicate in ['equals', 'does not equal']
+        ]
+        rules = [Rule('All', [condition], {}) for condition in conditions]
+        # Combine conditions, with NULL bodies making some of them unknown
+        for first, second in itertools.combinations(conditions[::10], 2):
+            rules.append(Rule('All', [first, second], {}))
+            rules.append(Rule('Any', [first, second], {}))
+        return rules + [Rule('All', [], {}), Rule('Any', [], {})]
+
+    def test_match_rules_when_compared_with_database(self):
+        rules = self.build_rules()
+
+        # Call both evaluators
+        expected = fetch_rule_matches(self.db_session(), emails.EmailMessage, rules)
+        matches, undecided_ids = match_rules(copy.deepcopy(EMAILS), rules)
+
+        # Assert that both evaluators give the same result for every rule and email
+        self.assertEqual(undecided_ids, [])
+        self.assertEqual(sorted(matches), sorted(expected))
+
+    def test_match_rules_when_body_is_not_fetched(self):
+        email_message = {key: value for key, value in EMAILS[1].items() if key != 'body'}
+        body_rule = Rule('All', [{'field': 'body', 'predicate': 'contains', 'value': 'due'}], {})
+        subject_rule = Rule('Any', [
+            {'field': 'subject', 'predicate': 'contains', 'value': 'invoice'},
+            {'field': 'body', 'predicate': 'contains', 'value': 'due'},
+        ], {})
+        decided_rule = Rule('All', [
+            {'field': 'subject', 'predicate': 'contains', 'value': 'digest'},
+            {'field': 'body', 'predicate': 'contains', 'value': 'due'},
+        ], {})
+
+        # Assert that rules decided by the other conditions are evaluated without the body
+        self.assertTrue(evaluate_rule(email_message, subject_rule))
+        self.assertFalse(evaluate_rule(email_message, decided_rule))
+        with self.assertRaises(MissingFieldError):
+            evaluate_rule(email_message, body_rule)
+
+        # Assert that the email is left to the database path
+        self.assertEqual(match_rules([email_message], [subject_rule, body_rule]), ([], ['2']))
+        self.assertEqual(match_rules([email_message], [subject_rule]), ([('2', 'INBOX', [0])], []))
+
+    def test_match_rules_when_attachments_are_not_fetched(self):
+        email_message = {key: value for key, value in EMAILS[1].items() if key not in ['body', 'attachments']}
+        attachment_rule = Rule('All', [{'field': 'attachment_type', 'predicate': 'equals', 'value': 'application/pdf'}], {})
+
+        # Assert that the email is left to the database path
+        with self.assertRaises(MissingFieldError):
+            evaluate_rule(email_message, attachment_rule)
+        self.assertTrue(evaluate_rule(EMAILS[1], attachment_rule))
+
+
+if __name__ == '__main__':
+    unittest.main()
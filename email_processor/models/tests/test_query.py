@@ -0,0 +1,200 @@
+import unittest
+from datetime import datetime
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from email_processor.models.emails import BASE, EmailMessage, parse_sender
+from sqlalchemy.dialects import postgresql, sqlite
+from email_processor.models.query import compile_rule, fetch_email_ids, fetch_rule_matches, has_fulltext_index, stream_rule_matches
+from email_processor.models.rules import Rule
+
+
+class TestQuery(unittest.TestCase):
+    def setUp(self):
+        # Use an in-memory database for each test
+        engine = create_engine('sqlite://')
+        BASE.metadata.create_all(engine)
+        self.db_session = sessionmaker(bind=engine)
+        session = self.db_session()
+        session.add_all([
+            EmailMessage(message_id='1', from_address='news@example.com', subject='Weekly digest',
+                         received_date=datetime(2024, 3, 1), body='Top stories'),
+            EmailMessage(message_id='2', from_address='Billing <billing@shop.example.org>', subject='Invoice',
+                         received_date=datetime(2024, 3, 10), body='Amount due'),
+            EmailMessage(message_id='3', from_address='news@example.com', subject='Invoice reminder',
+                         received_date=datetime(2024, 3, 12), body='Amount due'),
+        ])
+        for email_message in session.new:
+            email_message.from_email, email_message.from_domain = parse_sender(email_message.from_address)
+        session.commit()
+        session.close()
+
+    def fetch(self, collection_predicate, conditions):
+        rule = Rule.from_dict({
+            'collection_predicate': collection_predicate,
+            'conditions': conditions,
+            'actions': {'mark_as_read': True}
+        })
+        return sorted(fetch_email_ids(self.db_session(), EmailMessage, rule))
+
+    def test_fetch_email_ids_when_all_conditions_must_match(self):
+        email_ids = self.fetch('All', [
+            {'field': 'from_address', 'predicate': 'contains', 'value': 'news@'},
+            {'field': 'received_date', 'predicate': 'gt', 'value': '08-03-2024'},
+        ])
+        self.assertEqual(email_ids, ['3'])
+
+    def test_fetch_email_ids_when_any_condition_must_match(self):
+        email_ids = self.fetch('Any', [
+            {'field': 'subject', 'predicate': 'contains', 'value': 'Invoice'},
+            {'field': 'body', 'predicate': 'contains', 'value': 'Amount'},
+            {'field': 'received_date', 'predicate': 'lte', 'value': '01-03-2024'},
+        ])
+
+        # Assert that each match is returned once, and the date was parsed
+        self.assertEqual(email_ids, ['1', '2', '3'])
+
+    def test_fetch_email_ids_when_sender_equals(self):
+        self.assertEqual(self.fetch('All', [
+            {'field': 'from_address', 'predicate': 'equals', 'value': 'Billing@Shop.Example.org'},
+        ]), ['2'])
+        self.assertEqual(self.fetch('All', [
+            {'field': 'from_domain', 'predicate': 'equals', 'value': '@example.com'},
+        ]), ['1', '3'])
+        self.assertEqual(self.fetch('All', [
+            {'field': 'from_domain', 'predicate': 'does not equal', 'value': 'example.com'},
+            {'field': 'subject', 'predicate': 'equals', 'value': 'INVOICE'},
+        ]), ['2'])
+
+    def test_fetch_email_ids_when_value_is_a_number(self):
+        session = self.db_session()
+        session.add(EmailMessage(message_id='4', subject='2024', body='Yearly report'))
+        session.commit()
+        session.close()
+
+        # Assert that numbers are compared as text, like the stored strings
+        self.assertEqual(self.fetch('All', [{'field': 'subject', 'predicate': 'equals', 'value': 2024}]), ['4'])
+        self.assertEqual(self.fetch('All', [{'field': 'from_address', 'predicate': 'equals', 'value': 5}]), [])
+
+    def test_compile_rule_when_rule_is_compiled_again(self):
+        rule = Rule.from_dict({
+            'collection_predicate': 'All',
+            'conditions': [{'field': 'received_date', 'predicate': 'gt', 'value': '08-03-2024'}],
+            'actions': {}
+        })
+
+        # Assert that the filter is built once per backend
+        self.assertIs(compile_rule(EmailMessage, rule), compile_rule(EmailMessage, rule))
+        self.assertIsNot(compile_rule(EmailMessage, rule), compile_rule(EmailMessage, rule, dialect_name='postgresql'))
+
+    def test_compile_rule_when_sender_equals_uses_index(self):
+        rule = Rule.from_dict({
+            'collection_predicate': 'All',
+            'conditions': [
+                {'field': 'from_domain', 'predicate': 'equals', 'value': 'example.com'},
+                {'field': 'received_date', 'predicate': 'gt', 'value': '08-03-2024'},
+            ],
+            'actions': {}
+        })
+        session = self.db_session()
+        statement = session.query(EmailMessage.message_id).filter(compile_rule(EmailMessage, rule)).statement
+        compiled = statement.compile(session.get_bind(), compile_kwargs={'literal_binds': True})
+
+        # Assert that SQLite plans an index lookup instead of a table scan
+        plan = session.connection().exec_driver_sql(f'EXPLAIN QUERY PLAN {compiled}').all()
+        session.close()
+        self.assertIn('USING INDEX', ' '.join(row[-1] for row in plan))
+
+    def test_fetch_email_ids_when_no_condition_matches(self):
+        email_ids = self.fetch('Any', [
+            {'field': 'subject', 'predicate': 'contains', 'value': 'Unknown'},
+            {'field': 'received_date', 'predicate': 'lt', 'value': '01-01-2024'},
+        ])
+        self.assertEqual(email_ids, [])
+
+    def test_fetch_rule_matches_when_rules_overlap(self):
+        rules = [
+            Rule.from_dict({
+                'collection_predicate': 'All',
+                'conditions': [{'field': 'subject', 'predicate': 'contains', 'value': 'Invoice'}],
+                'actions': {'mark_as_read': True}
+            }),
+            Rule.from_dict({
+                'collection_predicate': 'All',
+                'conditions': [{'field': 'from_address', 'predicate': 'contains', 'value': 'news@'}],
+                'actions': {'mark_as_read': True}
+            }),
+        ]
+
+        # Call the function
+        matches = sorted(fetch_rule_matches(self.db_session(), EmailMessage, rules))
+
+        # Assert that every email is returned once with all the rules it matches
+        self.assertEqual(matches, [('1', None, [1]), ('2', None, [0]), ('3', None, [0, 1])])
+
+        # Assert that streaming the matches a row at a time gives the same matches, restricted to the given emails
+        session = self.db_session()
+        self.assertEqual(
+            sorted(stream_rule_matches(session, EmailMessage, rules, ['1', '3'], chunk_size=1)),
+            [('1', None, [1]), ('3', None, [0, 1])])
+        session.close()
+
+    def test_fetch_email_ids_when_fulltext_index_is_used(self):
+        # Update a body after insert, the index must follow
+        session = self.db_session()
+        session.query(EmailMessage).filter_by(message_id='1').update({'body': 'Top stories, amount due'})
+        session.add(EmailMessage(message_id='4', subject='No body'))
+        session.add(EmailMessage(message_id='5', subject='Report 2024', body='Yearly report'))
+        session.commit()
+        self.assertTrue(has_fulltext_index(session))
+        session.close()
+
+        for conditions in [
+            [{'field': 'body', 'predicate': 'contains', 'value': 'AMOUNT due'}],
+            [{'field': 'body', 'predicate': 'does not contain', 'value': 'amount'}],
+            [{'field': 'subject', 'predicate': 'contains', 'value': 'voic'}],
+            [{'field': 'subject', 'predicate': 'contains', 'value': 'in'}],
+            [{'field': 'subject', 'predicate': 'contains', 'value': 2024}],
+        ]:
+            rule = Rule.from_dict({'collection_predicate': 'All', 'conditions': conditions, 'actions': {}})
+            with_index = compile_rule(EmailMessage, rule, use_fulltext_index=True)
+            without_index = compile_rule(EmailMessage, rule, use_fulltext_index=False)
+
+            # Assert that the index gives the same emails as LIKE
+            session = self.db_session()
+            self.assertEqual(
+                sorted(row.message_id for row in session.query(EmailMessage.message_id).filter(with_index)),
+                sorted(row.message_id for row in session.query(EmailMessage.message_id).filter(without_index)),
+                conditions
+            )
+            session.close()
+
+        # Assert that only conditions holding a trigram are routed through the index
+        self.assertIn('MATCH', str(compile_rule(EmailMessage, Rule.from_dict({
+            'collection_predicate': 'All',
+            'conditions': [{'field': 'body', 'predicate': 'contains', 'value': 'amount'}],
+            'actions': {}
+        }), use_fulltext_index=True)))
+        self.assertNotIn('MATCH', str(without_index))
+        self.assertNotIn('MATCH', str(with_index))
+
+    def test_compile_rule_when_database_is_postgresql(self):
+        rule = Rule.from_dict({
+            'collection_predicate': 'Any',
+            'conditions': [
+                {'field': 'subject', 'predicate': 'contains', 'value': 'Invoice'},
+                {'field': 'body', 'predicate': 'does not contain', 'value': 'unsubscribe'},
+            ],
+            'actions': {}
+        })
+
+        # Compile the rule for both databases
+        sqlite_filter = str(compile_rule(EmailMessage, rule, dialect_name='sqlite').compile(dialect=sqlite.dialect()))
+        postgresql_filter = str(compile_rule(EmailMessage, rule, dialect_name='postgresql').compile(
+            dialect=postgresql.dialect()))
+
+        # Assert that PostgreSQL, where LIKE is case-sensitive, matches substrings with ILIKE
+        self.assertNotIn('ILIKE', sqlite_filter)
+        self.assertEqual(postgresql_filter.count('ILIKE'), 2)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,240 @@
+import contextvars
+import json
+import logging
+import signal
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, List, Optional
+from email_processor.metrics import METRICS, instrumented_run
+from email_processor.models.emails import create_database, use_database
+from email_processor.service.batch_requests import use_executors
+from email_processor.service.fetch_emails import get_service
+from email_processor.service.process_rules import fetch_and_process_emails
+import email_processor.service.constants as constants
+
+ACCOUNT_KEY_NAME = 'name'
+ACCOUNT_KEY_TOKEN_PATH = 'token_path'
+ACCOUNT_KEY_DATABASE_URL = 'database_url'
+ACCOUNT_KEY_USER_ID = 'user_id'
+ACCOUNT_KEYS = [ACCOUNT_KEY_NAME, ACCOUNT_KEY_TOKEN_PATH, ACCOUNT_KEY_DATABASE_URL]
+
+
+class Account:
+    """
+    Class to represent a mailbox processed in multi-account mode,
+    with its own token file and its own database.
+    """
+    def __init__(
+        self,
+        name: str,
+        token_path: str,
+        database_url: str,
+        user_id: Optional[str]=constants.DEFAULT_GMAIL_USER_ID
+    ):
+        """Initialize the account."""
+        self.name = name
+        self.token_path = token_path
+        self.database_url = database_url
+        self.user_id = user_id
+        self.service = None
+        self.database_created = False
+
+    @classmethod
+    def from_dict(cls, data: dict) -> 'Account':
+        """Create an account from a dictionary."""
+        if not all(key in data for key in ACCOUNT_KEYS):
+            raise ValueError(f"Some fields are missing in the account, expected fields are {', '.join(ACCOUNT_KEYS)}")
+        return cls(
+            data[ACCOUNT_KEY_NAME],
+            data[ACCOUNT_KEY_TOKEN_PATH],
+            data[ACCOUNT_KEY_DATABASE_URL],
+            data.get(ACCOUNT_KEY_USER_ID, constants.DEFAULT_GMAIL_USER_ID)
+        )
+
+    def get_service(self) -> Any:
+        """Get the Gmail API service of the account, built on first use and reused by every sync."""
+        if self.service is None:
+            self.service = get_service(self.token_path)
+        return self.service
+
+    def __repr__(self):
+        """Return the string representation of the account."""
+        return f"Account(name={self.name}, token_path={self.token_path}, database_url={self.database_url})"
+
+
+def read_accounts_from_json(file_path: Optional[str]=constants.ACCOUNTS_FILE_PATH) -> List[Account]:
+    """
+    Read the account registry from a JSON file holding a list of accounts.
+    Parameters:
+        file_path: str - path to the JSON file containing accounts
+    """
+    with open(file_path, 'r') as file:
+        accounts_data = json.load(file)
+
+    try:
+        if not isinstance(accounts_data, list):
+            raise ValueError("Accounts must be a list of account objects")
+        accounts = [Account.from_dict(account_data) for account_data in accounts_data]
+        names = [account.name for account in accounts]
+        if len(set(names)) != len(names):
+            raise ValueError("Account names must be unique")
+        return accounts
+    except ValueError as e:
+        logging.error(f"Error processing accounts: {str(e)}")
+        raise e
+
+
+def sync_account(account: Account) -> None:
+    """
+    Fetch the new emails of the account and process them, in the account's database.
+    Parameters:
+        account: Account - account to sync
+    """
+    with use_database(account.database_url):
+        if not account.database_created:
+            create_database()
+            account.database_created = True
+        with METRICS.timer('account_sync_seconds', account=account.name):
+            fetched_count = fetch_and_process_emails(account.get_service(), account.user_id)
+    logging.info(f"Synced {fetched_count} emails of account {account.name}")
+
+
+class AccountPool:
+    """
+    Class to process accounts on a pool of worker threads shared by all of them.
+    Accounts are served in the order they are scheduled and an account is never processed
+    by two workers at once, so a large mailbox holds a single worker and can't starve the others.
+    Each account has its own Gmail service, so its own rate limiter for its per-user quota.
+    Emails are fetched and label actions applied on two pools of workers shared by all the accounts,
+    so each running account only adds its own pipeline threads.
+    """
+    def __init__(
+        self,
+        process: Optional[Callable[[Account], None]]=sync_account,
+        workers: Optional[int]=constants.ACCOUNT_WORKERS,
+        fetch_workers: Optional[int]=constants.ACCOUNT_GET_EMAILS_WORKERS,
+        modify_workers: Optional[int]=constants.ACCOUNT_MODIFY_EMAILS_WORKERS
+    ):
+        """Initialize the pool and start its workers."""
+        self.process = process
+        self.fetch_executor = ThreadPoolExecutor(max_workers=fetch_workers, thread_name_prefix='gmail-fetch')
+        self.modify_executor = ThreadPoolExecutor(max_workers=modify_workers, thread_name_prefix='gmail-modify')
+        self.pending = deque()
+        self.queued, self.running, self.rescheduled = set(), set(), set()
+        self.closed = False
+        self.condition = threading.Condition()
+        self.threads = [
+            threading.Thread(target=self._work, name=f'account-worker-{index}', daemon=True)
+            for index in range(workers)
+        ]
+        for thread in self.threads:
+            thread.start()
+
+    def schedule(self, account: Account) -> None:
+        """
+        Schedule the account to be processed.
+        An account already waiting is not queued twice, an account being processed
+        is queued again once its current run ends.
+        Parameters:
+            account: Account - account to process
+        """
+        with self.condition:
+            if account.name in self.queued:
+                return
+            if account.name in self.running:
+                self.rescheduled.add(account.name)
+                return
+            self.pending.append(account)
+            self.queued.add(account.name)
+            self.condition.notify_all()
+
+    def _process(self, account: Account) -> None:
+        with use_executors(self.fetch_executor, self.modify_executor):
+            self.process(account)
+
+    def _work(self) -> None:
+        while True:
+            with self.condition:
+                while not self.pending and not self.closed:
+                    self.condition.wait()
+                if not self.pending:
+                    return
+                account = self.pending.popleft()
+                self.queued.discard(account.name)
+                self.running.add(account.name)
+            try:
+                # Each run gets a fresh context, so the account database doesn't leak into the next run
+                contextvars.Context().run(self._process, account)
+            except Exception as e:
+                logging.error(f"Error occured while processing account {account.name}: {e}")
+            finally:
+                with self.condition:
+                    self.running.discard(account.name)
+                    if account.name in self.rescheduled:
+                        self.rescheduled.discard(account.name)
+                        self.pending.append(account)
+                        self.queued.add(account.name)
+                    self.condition.notify_all()
+
+    def join(self) -> None:
+        """Wait until every scheduled account has been processed."""
+        with self.condition:
+            while self.pending or self.running:
+                self.condition.wait()
+
+    def close(self) -> None:
+        """Stop the workers after their current run, dropping the accounts still waiting."""
+        with self.condition:
+            self.closed = True
+            self.pending.clear()
+            self.queued.clear()
+            self.rescheduled.clear()
+            self.condition.notify_all()
+        for thread in self.threads:
+            thread.join()
+        self.fetch_executor.shutdown()
+        self.modify_executor.shutdown()
+
+
+def process_accounts(
+    accounts: List[Account],
+    interval_seconds: Optional[float]=constants.ACCOUNTS_SYNC_INTERVAL_SECONDS,
+    stopped: Optional[threading.Event]=None
+) -> None:
+    """
+    Sync all the accounts on a shared worker pool, once or every interval_seconds until stopped.
+    An account still syncing when the next interval starts is synced again right after,
+    without holding up the others.
+    Parameters:
+        accounts: List[Account] - accounts to sync
+        interval_seconds: float - seconds between two syncs of every account, 0 to sync them once
+        stopped: threading.Event - set to stop syncing
+    """
+    stopped = stopped or threading.Event()
+    pool = AccountPool()
+    try:
+        while True:
+            for account in accounts:
+                pool.schedule(account)
+            if not interval_seconds:
+                pool.join()
+                break
+            if stopped.wait(interval_seconds):
+                break
+    finally:
+        pool.close()
+
+
+def main() -> None:
+    """Sync the accounts of the registry, stopping on SIGINT or SIGTERM."""
+    logging.basicConfig(level=logging.INFO)
+    stopped = threading.Event()
+    for signal_number in [signal.SIGINT, signal.SIGTERM]:
+        signal.signal(signal_number, lambda *args: stopped.set())
+    with instrumented_run('process-accounts'):
+        process_accounts(read_accounts_from_json(), stopped=stopped)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,165 @@
+import contextvars
+import logging
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, wait
+from typing import Any, FrozenSet, Iterable, Iterator, List, Optional, Tuple
+from googleapiclient.errors import HttpError
+from email_processor.metrics import METRICS, SIZE_BUCKETS
+from email_processor.models.emails import (
+    complete_label_action,
+    enqueue_label_actions,
+    fail_label_action,
+    get_pending_label_actions,
+)
+from email_processor.service.batch_requests import (
+    TokenBucket,
+    backoff_delay,
+    execute_request,
+    get_modify_executor,
+    get_rate_limiter,
+    is_rate_limit_error,
+    is_retryable_error,
+    new_authorized_http,
+)
+import email_processor.service.constants as constants
+
+
+def batch_label_changes(
+    changes: Iterable[Tuple[str, FrozenSet[str], FrozenSet[str]]]
+) -> Iterator[Tuple[List[str], List[str], List[str]]]:
+    """
+    Group the label changes of emails into batch modifications of at most MODIFY_EMAILS_BATCH_SIZE emails,
+    yielding each one as soon as it is full, so a modification can be applied while the next emails are read.
+    Only the emails of unfinished batches are held, one batch per distinct label change at most.
+    Parameters:
+        changes: Iterable[Tuple[str, FrozenSet[str], FrozenSet[str]]] - email ID, label IDs to add
+            and label IDs to remove of each email
+    """
+    groups = {}
+    for email_id, add_label_ids, remove_label_ids in changes:
+        email_ids = groups.setdefault((add_label_ids, remove_label_ids), [])
+        email_ids.append(email_id)
+        if len(email_ids) >= constants.MODIFY_EMAILS_BATCH_SIZE:
+            yield email_ids, sorted(add_label_ids), sorted(remove_label_ids)
+            groups[(add_label_ids, remove_label_ids)] = []
+    for (add_label_ids, remove_label_ids), email_ids in groups.items():
+        if email_ids:
+            yield email_ids, sorted(add_label_ids), sorted(remove_label_ids)
+
+
+def journal_label_actions(
+    actions: Iterable[Tuple[List[str], List[str], List[str]]]
+) -> Iterator[Tuple[int, List[str], List[str], List[str]]]:
+    """
+    Journal each planned batch modification as a pending label action, yielding it with its ID once saved,
+    so every action is journaled before it is applied.
+    Parameters:
+        actions: Iterable[Tuple[List[str], List[str], List[str]]] - email IDs, label IDs to add
+            and label IDs to remove of each batch modification
+    """
+    for email_ids, add_label_ids, remove_label_ids in actions:
+        action_id = enqueue_label_actions([(email_ids, add_label_ids, remove_label_ids)])[0]
+        yield action_id, email_ids, add_label_ids, remove_label_ids
+
+
+def drain_label_actions(
+    service: Any,
+    user_id: Optional[str]=constants.DEFAULT_GMAIL_USER_ID,
+    workers: Optional[int]=constants.MODIFY_EMAILS_WORKERS,
+    rate_limiter: Optional[TokenBucket]=None
+) -> None:
+    """
+    Apply the pending label actions of the journal with a bounded pool of workers.
+    Each action is retried with exponential backoff on transient errors and marked done once applied,
+    so an interrupted run resumes with the actions it did not apply.
+    Raises the first error of the actions that could not be applied.
+    Parameters:
+        service: googleapiclient.discovery.Resource - Gmail API service object
+        user_id: str - user ID
+        workers: int - number of batch modifications in flight
+        rate_limiter: TokenBucket - rate limiter for the user's quota
+    """
+    actions = get_pending_label_actions()
+    if not actions:
+        return
+    logging.info(f"Applying {len(actions)} pending label actions")
+    apply_label_actions(service, actions, user_id, workers, rate_limiter)
+
+
+def apply_label_actions(
+    service: Any,
+    actions: Iterable[Tuple[int, List[str], List[str], List[str]]],
+    user_id: Optional[str]=constants.DEFAULT_GMAIL_USER_ID,
+    workers: Optional[int]=constants.MODIFY_EMAILS_WORKERS,
+    rate_limiter: Optional[TokenBucket]=None
+) -> None:
+    """
+    Apply journaled label actions with a bounded pool of workers, as they come.
+    Actions are consumed lazily, at most twice as many as workers being in flight,
+    so the first modification is sent while the next ones are still being planned.
+    Each action is retried with exponential backoff on transient errors and marked done once applied.
+    Raises the first error of the actions that could not be applied, once all of them were tried.
+    Parameters:
+        service: googleapiclient.discovery.Resource - Gmail API service object
+        actions: Iterable[Tuple[int, List[str], List[str], List[str]]] - ID, email IDs, label IDs to add
+            and label IDs to remove of each label action
+        user_id: str - user ID
+        workers: int - number of batch modifications in flight
+        rate_limiter: TokenBucket - rate limiter for the user's quota
+    """
+    rate_limiter = rate_limiter or get_rate_limiter(service)
+    local = threading.local()
+
+    def apply(action: Tuple[int, List[str], List[str], List[str]]) -> None:
+        action_id, email_ids, add_label_ids, remove_label_ids = action
+        if not hasattr(local, 'http'):
+            local.http = new_authorized_http(service)
+        attempt = 0
+        METRICS.observe('gmail_batch_size', len(email_ids), SIZE_BUCKETS, method='messages.batchModify')
+        while True:
+            rate_limiter.acquire(constants.GMAIL_QUOTA_UNITS['messages.batchModify'])
+            try:
+                execute_request(service.users().messages().batchModify(userId=user_id, body={
+                    "ids": email_ids,
+                    "addLabelIds": add_label_ids,
+                    "removeLabelIds": remove_label_ids
+                }), 'messages.batchModify', http=local.http)
+            except HttpError as error:
+                attempt += 1
+                retryable = is_retryable_error(error)
+                if not retryable or attempt > constants.RETRY_MAX_ATTEMPTS:
+                    logging.error(f'Error occured while performing label action {action_id}: {error}')
+                    fail_label_action(action_id, str(error), retryable)
+                    raise error
+                if is_rate_limit_error(error):
+                    rate_limiter.penalize()
+                METRICS.increment('gmail_api_retries_total', method='messages.batchModify')
+                logging.warning(f'Retrying label action {action_id}, attempt {attempt}: {error}')
+                time.sleep(backoff_delay(attempt))
+                continue
+            rate_limiter.reward()
+            complete_label_action(action_id)
+            logging.info(
+                f"Label action {action_id} applied to {len(email_ids)} emails: "
+                f"addLabelIds={add_label_ids}, removeLabelIds={remove_label_ids}")
+            return
+
+    total_actions, errors = 0, []
+
+    def collect(futures: Iterable[Any]) -> None:
+        errors.extend(future.exception() for future in futures if future.exception() is not None)
+
+    with get_modify_executor(workers) as executor:
+        in_flight = set()
+        for action in actions:
+            total_actions += 1
+            # Actions run in a copy of the caller's context, to use the same account database
+            in_flight.add(executor.submit(contextvars.copy_context().run, apply, action))
+            if len(in_flight) >= workers * 2:
+                done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                collect(done)
+        collect(wait(in_flight).done)
+    if errors:
+        logging.error(f"{len(errors)} of {total_actions} label actions could not be applied")
+        raise errors[0]
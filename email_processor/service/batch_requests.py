@@ -0,0 +1,343 @@
+import itertools
+import logging
+import random
+import threading
+import time
+import weakref
+from concurrent.futures import FIRST_COMPLETED, Executor, ThreadPoolExecutor, wait
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, ContextManager, Dict, Iterable, Iterator, List, Optional
+import httplib2
+from google_auth_httplib2 import AuthorizedHttp
+from googleapiclient.errors import HttpError
+from email_processor.metrics import METRICS, SIZE_BUCKETS
+import email_processor.service.constants as constants
+
+RETRYABLE_STATUS_CODES = [429, 500, 502, 503, 504]
+RATE_LIMIT_REASONS = [b'rateLimitExceeded', b'userRateLimitExceeded']
+# Connection failures raised before any response, e.g. socket timeouts, resets and DNS failures
+TRANSPORT_ERRORS = (OSError, httplib2.HttpLib2Error)
+
+
+class TokenBucket:
+    """
+    Class to represent a token bucket rate limiter shared between threads.
+    The refill rate adapts to the API: it is halved when the API rate limits us
+    and recovers step by step with every successful request.
+    """
+    def __init__(self, rate: float, capacity: float, min_rate: Optional[float]=None):
+        """Initialize the token bucket with a full bucket."""
+        self.max_rate = rate
+        self.min_rate = min_rate or rate / 16
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def acquire(self, tokens: float) -> None:
+        """
+        Block until the tokens are available, then take them.
+        Requests larger than the bucket wait for a full bucket and leave it in deficit.
+        """
+        started_at = time.perf_counter()
+        while True:
+            with self.lock:
+                self._refill()
+                needed = min(tokens, self.capacity)
+                if self.tokens >= needed:
+                    self.tokens -= tokens
+                    break
+                wait_seconds = (needed - self.tokens) / self.rate
+            time.sleep(wait_seconds)
+        # Time spent waiting for quota, as opposed to waiting for the API
+        METRICS.observe('rate_limiter_wait_seconds', time.perf_counter() - started_at)
+
+    def penalize(self) -> None:
+        """Halve the refill rate after the API rate limited a request."""
+        with self.lock:
+            self.rate = max(self.min_rate, self.rate / 2)
+        METRICS.increment('rate_limiter_penalties_total')
+
+    def reward(self) -> None:
+        """Recover part of the refill rate after a successful request."""
+        with self.lock:
+            self.rate = min(self.max_rate, self.rate + self.max_rate / 16)
+
+
+def new_rate_limiter() -> TokenBucket:
+    """Create a token bucket sized to the Gmail per-user quota."""
+    return TokenBucket(
+        rate=constants.GMAIL_QUOTA_UNITS_PER_SECOND,
+        capacity=constants.GMAIL_QUOTA_UNITS_PER_SECOND
+    )
+
+
+# Rate limiters by service object, each service being authorized for a single mailbox
+_RATE_LIMITERS = weakref.WeakKeyDictionary()
+_RATE_LIMITERS_LOCK = threading.Lock()
+
+
+def get_rate_limiter(service: Any) -> TokenBucket:
+    """
+    Get the rate limiter of the mailbox the service is authorized for, created on first use.
+    Every request made for a mailbox shares its per-user quota, whichever thread makes it.
+    Parameters:
+        service: googleapiclient.discovery.Resource - Gmail API service object
+    """
+    with _RATE_LIMITERS_LOCK:
+        if service not in _RATE_LIMITERS:
+            _RATE_LIMITERS[service] = new_rate_limiter()
+        return _RATE_LIMITERS[service]
+
+
+# Executors shared by every context using them, e.g. by all the accounts in multi-account mode
+_FETCH_EXECUTOR = ContextVar('fetch_executor', default=None)
+_MODIFY_EXECUTOR = ContextVar('modify_executor', default=None)
+
+
+@contextmanager
+def use_executors(fetch_executor: Executor, modify_executor: Executor) -> Iterator[None]:
+    """
+    Run the email fetches and label modifications started in this context on the given executors,
+    instead of a pool of workers started for each of them.
+    Threads started in the context must run in a copy of it to use the same executors.
+    Parameters:
+        fetch_executor: Executor - executor of the batch requests fetching email messages
+        modify_executor: Executor - executor of the label modifications
+    """
+    fetch_token = _FETCH_EXECUTOR.set(fetch_executor)
+    modify_token = _MODIFY_EXECUTOR.set(modify_executor)
+    try:
+        yield
+    finally:
+        _MODIFY_EXECUTOR.reset(modify_token)
+        _FETCH_EXECUTOR.reset(fetch_token)
+
+
+@contextmanager
+def _get_executor(shared_executor: ContextVar, workers: int, thread_name_prefix: str) -> Iterator[Executor]:
+    executor = shared_executor.get()
+    if executor is not None:
+        yield executor
+        return
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix=thread_name_prefix) as executor:
+        yield executor
+
+
+def get_fetch_executor(workers: int) -> ContextManager[Executor]:
+    """
+    Get the executor fetching email messages: the shared one in use in the current context,
+    else a new pool of workers shut down on exit.
+    Parameters:
+        workers: int - number of workers of a new pool
+    """
+    return _get_executor(_FETCH_EXECUTOR, workers, 'gmail-fetch')
+
+
+def get_modify_executor(workers: int) -> ContextManager[Executor]:
+    """
+    Get the executor applying label modifications: the shared one in use in the current context,
+    else a new pool of workers shut down on exit.
+    Parameters:
+        workers: int - number of workers of a new pool
+    """
+    return _get_executor(_MODIFY_EXECUTOR, workers, 'gmail-modify')
+
+
+def is_retryable_error(error: Exception) -> bool:
+    """
+    Check whether a failed Gmail API request is worth retrying: transient HTTP errors and connection failures.
+    Parameters:
+        error: Exception - error raised by the request
+    """
+    if isinstance(error, TRANSPORT_ERRORS):
+        return True
+    if not isinstance(error, HttpError):
+        return False
+    if error.resp.status in RETRYABLE_STATUS_CODES:
+        return True
+    return error.resp.status == 403 and any(
+        reason in (error.content or b'') for reason in RATE_LIMIT_REASONS)
+
+
+def is_rate_limit_error(error: Exception) -> bool:
+    """
+    Check whether a Gmail API request failed because the quota was exceeded.
+    Parameters:
+        error: Exception - error raised by the request
+    """
+    return isinstance(error, HttpError) and is_retryable_error(error) and error.resp.status in [403, 429]
+
+
+def get_error_status(error: Optional[Exception]) -> str:
+    """
+    Get the status label of a Gmail API request for the metrics: 'ok', the HTTP status or the error type.
+    Parameters:
+        error: Exception - error raised by the request, None when it succeeded
+    """
+    if error is None:
+        return 'ok'
+    if isinstance(error, HttpError):
+        return str(error.resp.status)
+    return type(error).__name__
+
+
+def execute_request(request: Any, method: str, **kwargs: Any) -> Any:
+    """
+    Execute a Gmail API request, counting it and timing its round trip under the given method.
+    Parameters:
+        request: googleapiclient.http.HttpRequest - request or batch request to execute
+        method: str - Gmail API method of the request, e.g. 'messages.list', or 'batch'
+        kwargs: Any - arguments of the request's execute method, e.g. http
+    """
+    error = None
+    try:
+        with METRICS.timer('gmail_api_request_seconds', method=method):
+            return request.execute(**kwargs)
+    except Exception as e:
+        error = e
+        raise e
+    finally:
+        METRICS.increment('gmail_api_requests_total', method=method, status=get_error_status(error))
+
+
+def backoff_delay(attempt: int) -> float:
+    """
+    Get the exponential backoff delay in seconds, with jitter, before the given retry attempt.
+    Parameters:
+        attempt: int - retry attempt number, starting at 1
+    """
+    delay = min(constants.RETRY_MAX_DELAY_SECONDS, constants.RETRY_BASE_DELAY_SECONDS * 2 ** (attempt - 1))
+    return delay / 2 + random.uniform(0, delay / 2)
+
+
+def new_authorized_http(service: Any) -> Optional[AuthorizedHttp]:
+    """
+    Create a new authorized http object for the service's credentials.
+    httplib2 is not thread safe, so every worker thread needs its own http object.
+    Parameters:
+        service: googleapiclient.discovery.Resource - Gmail API service object
+    """
+    credentials = getattr(getattr(service, '_http', None), 'credentials', None)
+    if credentials is None:
+        return None
+    return AuthorizedHttp(credentials, http=httplib2.Http())
+
+
+class BatchFetcher:
+    """
+    Class to fetch email messages with several batch requests in flight at once.
+    Each worker thread owns an authorized http object, every batch takes its quota
+    units from the rate limiter, and failed requests are retried with exponential backoff.
+    """
+    def __init__(
+        self,
+        service: Any,
+        user_id: Optional[str]=constants.DEFAULT_GMAIL_USER_ID,
+        workers: Optional[int]=constants.GET_EMAILS_WORKERS,
+        rate_limiter: Optional[TokenBucket]=None,
+        request_params: Optional[Dict[str, Any]]=None
+    ):
+        """Initialize the batch fetcher."""
+        self.service = service
+        self.user_id = user_id
+        self.workers = workers
+        self.rate_limiter = rate_limiter or get_rate_limiter(service)
+        self.request_params = request_params or {}
+        self.local = threading.local()
+
+    def _get_http(self) -> Optional[AuthorizedHttp]:
+        if not hasattr(self.local, 'http'):
+            self.local.http = new_authorized_http(self.service)
+        return self.local.http
+
+    def fetch_batch(self, message_ids: List[str]) -> List[Dict[str, Any]]:
+        """
+        Fetch one batch of email messages, retrying the requests that failed transiently.
+        Messages failing permanently, e.g. deleted since they were listed, are skipped.
+        Parameters:
+            message_ids: List[str] - list of email message IDs
+        """
+        messages, pending, attempt = [], list(message_ids), 0
+
+        while pending:
+            failed, errors = [], []
+
+            def callback(request_id, response, exception):
+                METRICS.increment(
+                    'gmail_api_requests_total', method='messages.get', status=get_error_status(exception))
+                if exception is None:
+                    messages.append(response)
+                elif is_retryable_error(exception):
+                    failed.append(request_id)
+                    errors.append(exception)
+                else:
+                    logging.error(f'Error occured while processing batch request: {exception}')
+
+            self.rate_limiter.acquire(len(pending) * constants.GMAIL_QUOTA_UNITS['messages.get'])
+            METRICS.observe('gmail_batch_size', len(pending), SIZE_BUCKETS, method='messages.get')
+            batch = self.service.new_batch_http_request(callback=callback)
+            for message_id in pending:
+                batch.add(
+                    self.service.users().messages().get(
+                        userId=self.user_id, id=message_id, **self.request_params),
+                    request_id=message_id
+                )
+            try:
+                execute_request(batch, 'batch', http=self._get_http())
+            except (HttpError, *TRANSPORT_ERRORS) as error:
+                if not is_retryable_error(error):
+                    logging.error(
+                        f'Error occured while requesting email messages in batches: {error}')
+                    raise error
+                fetched_ids = {message['id'] for message in messages}
+                failed = [message_id for message_id in pending if message_id not in fetched_ids]
+                errors = [error]
+
+            if not failed:
+                self.rate_limiter.reward()
+                break
+
+            attempt += 1
+            if attempt > constants.RETRY_MAX_ATTEMPTS:
+                logging.error(
+                    f'Giving up on {len(failed)} email messages after {attempt - 1} retries: {errors[-1]}')
+                raise errors[-1]
+            if any(is_rate_limit_error(error) for error in errors):
+                self.rate_limiter.penalize()
+            METRICS.increment('gmail_api_retries_total', len(failed), method='messages.get')
+            logging.warning(f'Retrying {len(failed)} email messages, attempt {attempt}: {errors[-1]}')
+            time.sleep(backoff_delay(attempt))
+            pending = failed
+
+        return messages
+
+    def fetch(self, message_ids: Iterable[str]) -> Iterator[List[Dict[str, Any]]]:
+        """
+        Fetch email messages in batches, yielding each batch as soon as it completes.
+        At most twice as many batches as workers are in flight, keeping memory bounded.
+        Message IDs are consumed lazily, so fetching overlaps with listing them.
+        Parameters:
+            message_ids: Iterable[str] - email message IDs
+        """
+        message_ids = iter(message_ids)
+        batches = iter(lambda: list(itertools.islice(message_ids, constants.GET_EMAILS_BATCH_SIZE)), [])
+        with get_fetch_executor(self.workers) as executor:
+            in_flight = set()
+            for batch in batches:
+                in_flight.add(executor.submit(self.fetch_batch, batch))
+                if len(in_flight) >= self.workers * 2:
+                    done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        yield future.result()
+            while in_flight:
+                done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield future.result()
@@ -1,8 +1,66 @@
+import os
+
 SCOPES = ['https://www.googleapis.com/auth/gmail.readonly', 'https://www.googleapis.com/auth/gmail.modify', 'https://www.googleapis.com/auth/gmail.labels']
 CREDENTIALS_PATH = "credentials.json"
+TOKEN_PATH = "token.pickle"
 DEFAULT_GMAIL_USER_ID="me"
-LIST_EMAILS_PAGINATION_MAX_SIZE=10
+LIST_EMAILS_PAGINATION_MAX_SIZE=500
 LIST_EMAILS_INCLUDE_SPAM_TRASH_EMAILS=False
+# Gmail search query applied when listing emails, e.g. 'after:2024/03/08'
+LIST_EMAILS_QUERY=None
+INCREMENTAL_SYNC_ENABLED=True
+LIST_HISTORY_PAGINATION_MAX_SIZE=500
+HISTORY_TYPES=['messageAdded', 'messageDeleted', 'labelAdded', 'labelRemoved']
+GET_EMAILS_BATCH_SIZE=50
+MESSAGE_FORMAT_FULL='full'
+MESSAGE_FORMAT_METADATA='metadata'
+# 'metadata' fetches only the rule headers, bodies are fetched when a body condition needs them
+MESSAGE_FETCH_FORMAT=MESSAGE_FORMAT_METADATA
+METADATA_HEADERS=['From', 'To', 'Subject', 'Date']
+GET_EMAILS_WORKERS=4
+PIPELINE_QUEUE_SIZE=4
+# Gmail API per-user quota, see https://developers.google.com/gmail/api/reference/quota
+GMAIL_QUOTA_UNITS_PER_SECOND=250
+GMAIL_QUOTA_UNITS={
+    'users.getProfile': 1,
+    'messages.get': 5,
+    'messages.list': 5,
+    'messages.batchModify': 50,
+    'history.list': 2,
+    'labels.list': 1,
+}
+RETRY_MAX_ATTEMPTS=5
+RETRY_BASE_DELAY_SECONDS=1
+RETRY_MAX_DELAY_SECONDS=32
 MODIFY_EMAILS_BATCH_SIZE=1000
+MODIFY_EMAILS_WORKERS=4
 MAX_EMAILS_TO_FETCH=5
-RULE_FILE_PATH = 'email_processor/service/rules.json'
\ No newline at end of file
+# Maximum number of characters stored for an email body, None for no limit
+MAX_BODY_LENGTH=256 * 1024
+# Use the text of HTML parts as the body of emails without a text/plain part
+BODY_HTML_TO_TEXT=False
+LABELS_CACHE_TTL_SECONDS=24 * 60 * 60
+# Minimum interval between two reloads of the labels from the API when a label name is not found
+LABELS_MISS_RELOAD_INTERVAL_SECONDS=60
+LABELS_CREATE_MISSING=False
+RULE_FILE_PATH = 'email_processor/service/rules.json'
+# Evaluate full runs of the rules only on the emails stored or changed since the last run, reusing earlier matches
+RULE_MATCH_CACHE_ENABLED = os.getenv("EMAIL_PROCESSOR_RULE_MATCH_CACHE", "True") == "True"
+# Daemon mode, notified of mailbox changes through a 'file' feed or Gmail 'pubsub' watch
+DAEMON_NOTIFICATION_SOURCE = os.getenv("EMAIL_PROCESSOR_NOTIFICATION_SOURCE", "file")
+DAEMON_NOTIFICATION_FILE_PATH = os.getenv("EMAIL_PROCESSOR_NOTIFICATION_FILE", "notifications.jsonl")
+DAEMON_POLL_INTERVAL_SECONDS = 1
+PUBSUB_TOPIC_NAME = os.getenv("GMAIL_PUBSUB_TOPIC")
+PUBSUB_SUBSCRIPTION_NAME = os.getenv("GMAIL_PUBSUB_SUBSCRIPTION")
+# Gmail watches expire after 7 days, renew them daily
+GMAIL_WATCH_RENEW_INTERVAL_SECONDS = 24 * 60 * 60
+# Registry of the accounts processed in multi-account mode
+ACCOUNTS_FILE_PATH = os.getenv("EMAIL_PROCESSOR_ACCOUNTS_FILE", "accounts.json")
+# Number of accounts processed at once by the shared worker pool
+ACCOUNT_WORKERS = 8
+# Workers fetching emails and applying label actions, each pool shared by all the accounts,
+# so the threads don't grow with ACCOUNT_WORKERS beyond the pipeline threads of each account
+ACCOUNT_GET_EMAILS_WORKERS = 8
+ACCOUNT_MODIFY_EMAILS_WORKERS = 8
+# Seconds between two syncs of every account, 0 to sync them once
+ACCOUNTS_SYNC_INTERVAL_SECONDS = 0
@@ -0,0 +1,236 @@
+import json
+import logging
+from abc import ABC, abstractmethod
+import os
+import queue
+import signal
+import threading
+import time
+from typing import Any, Dict, Optional
+from email_processor.metrics import METRICS, METRICS_PROMETHEUS_PATH, METRICS_SUMMARY_PATH, instrumented_run
+from email_processor.models.emails import create_database
+from email_processor.service.batch_requests import execute_request
+from email_processor.service.fetch_emails import get_service
+from email_processor.service.process_rules import fetch_and_process_emails
+import email_processor.service.constants as constants
+
+
+class NotificationSource(ABC):
+    """Base class of the sources of mailbox change notifications."""
+
+    def start(self, service: Any, user_id: str) -> None:
+        """Start receiving notifications for the user's mailbox."""
+
+    @abstractmethod
+    def get(self, timeout: float) -> Optional[Dict[str, Any]]:
+        """Wait up to timeout seconds for the next notification, None when there is none."""
+
+    def close(self) -> None:
+        """Stop receiving notifications."""
+
+
+class FileNotificationSource(NotificationSource):
+    """
+    Class to read notifications appended to a file, one JSON object per line.
+    Stands in for Gmail push notifications locally and in tests.
+    """
+    def __init__(
+        self,
+        file_path: Optional[str]=constants.DAEMON_NOTIFICATION_FILE_PATH,
+        from_beginning: Optional[bool]=False
+    ):
+        """Initialize the file notification source."""
+        self.file_path = file_path
+        self.from_beginning = from_beginning
+        self.file = None
+
+    def start(self, service: Any, user_id: str) -> None:
+        """Open the notification file, only reading the notifications appended from now on by default."""
+        self.file = open(self.file_path, 'a+')
+        self.file.seek(0, os.SEEK_SET if self.from_beginning else os.SEEK_END)
+
+    def get(self, timeout: float) -> Optional[Dict[str, Any]]:
+        """Read the next notification, polling the file until timeout. Malformed lines are logged and skipped."""
+        deadline = time.monotonic() + timeout
+        while True:
+            position = self.file.tell()
+            line = self.file.readline()
+            if line.endswith('\n'):
+                if line.strip():
+                    try:
+                        return json.loads(line)
+                    except json.JSONDecodeError as e:
+                        logging.error(f"Skipping malformed notification {line.strip()!r}: {e}")
+                continue
+            # Rewind partially written lines until they are complete
+            self.file.seek(position)
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return None
+            time.sleep(min(remaining, constants.DAEMON_POLL_INTERVAL_SECONDS))
+
+    def close(self) -> None:
+        """Close the notification file."""
+        if self.file is not None:
+            self.file.close()
+
+
+class PubSubNotificationSource(NotificationSource):
+    """
+    Class to receive Gmail push notifications through a Cloud Pub/Sub subscription.
+    Watches the mailbox on start and renews the watch before it expires.
+    Requires the google-cloud-pubsub package.
+    """
+    def __init__(
+        self,
+        topic_name: Optional[str]=constants.PUBSUB_TOPIC_NAME,
+        subscription_name: Optional[str]=constants.PUBSUB_SUBSCRIPTION_NAME
+    ):
+        """Initialize the Pub/Sub notification source."""
+        if not topic_name or not subscription_name:
+            raise ValueError("GMAIL_PUBSUB_TOPIC and GMAIL_PUBSUB_SUBSCRIPTION must be set for Pub/Sub notifications")
+        self.topic_name = topic_name
+        self.subscription_name = subscription_name
+        self.notifications = queue.Queue()
+        self.service, self.user_id = None, None
+        self.subscriber, self.streaming_pull = None, None
+        self.watched_at = 0
+
+    def _watch(self) -> None:
+        response = execute_request(
+            self.service.users().watch(userId=self.user_id, body={'topicName': self.topic_name}), 'users.watch')
+        self.watched_at = time.monotonic()
+        logging.info(f"Watching mailbox from history ID {response['historyId']} until {response['expiration']}")
+
+    def _on_message(self, message: Any) -> None:
+        try:
+            self.notifications.put(json.loads(message.data.decode('utf-8')))
+        except (UnicodeDecodeError, json.JSONDecodeError) as e:
+            # Acked anyway, redelivering a malformed message would fail the same way
+            logging.error(f"Skipping malformed notification {message.data!r}: {e}")
+        message.ack()
+
+    def start(self, service: Any, user_id: str) -> None:
+        """Watch the mailbox and subscribe to its notifications."""
+        try:
+            from google.cloud import pubsub_v1
+        except ImportError:
+            raise ImportError("google-cloud-pubsub is required for Pub/Sub notifications: pip install google-cloud-pubsub")
+
+        self.service, self.user_id = service, user_id
+        self._watch()
+        self.subscriber = pubsub_v1.SubscriberClient()
+        self.streaming_pull = self.subscriber.subscribe(self.subscription_name, callback=self._on_message)
+
+    def get(self, timeout: float) -> Optional[Dict[str, Any]]:
+        """
+        Wait for the next notification, renewing the watch when due.
+        A failed renewal is logged and tried again by the next call, the watch lasting days longer.
+        """
+        if time.monotonic() - self.watched_at > constants.GMAIL_WATCH_RENEW_INTERVAL_SECONDS:
+            try:
+                self._watch()
+            except Exception as e:
+                logging.error(f"Error occured while renewing the mailbox watch: {e}")
+        try:
+            return self.notifications.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def close(self) -> None:
+        """Unsubscribe and stop watching the mailbox."""
+        if self.streaming_pull is not None:
+            self.streaming_pull.cancel()
+            self.subscriber.close()
+        if self.service is not None:
+            try:
+                execute_request(self.service.users().stop(userId=self.user_id), 'users.stop')
+            except Exception as e:
+                # Raised while closing, it would hide the error the daemon is stopping on
+                logging.error(f"Error occured while stopping the mailbox watch: {e}")
+
+
+def create_notification_source(source_type: Optional[str]=constants.DAEMON_NOTIFICATION_SOURCE) -> NotificationSource:
+    """
+    Create the notification source of the given type.
+    Parameters:
+        source_type: str - 'file' or 'pubsub'
+    """
+    if source_type == 'file':
+        return FileNotificationSource()
+    elif source_type == 'pubsub':
+        return PubSubNotificationSource()
+    raise ValueError(f"Unknown notification source '{source_type}', expected 'file' or 'pubsub'")
+
+
+class EmailProcessorDaemon:
+    """
+    Class to keep emails processed as they arrive.
+    Builds the Gmail service once, then runs an incremental fetch and the rules
+    on the changed emails only, for every notification of a mailbox change.
+    """
+    def __init__(
+        self,
+        source: NotificationSource,
+        service: Optional[Any]=None,
+        user_id: Optional[str]=constants.DEFAULT_GMAIL_USER_ID
+    ):
+        """Initialize the daemon."""
+        self.source = source
+        self.service = service
+        self.user_id = user_id
+        self.stopped = threading.Event()
+
+    def sync(self) -> None:
+        """
+        Fetch the emails changed since the last sync and process them, logging any error.
+        The metrics reports are rewritten after every sync, so they stay current while the daemon runs.
+        """
+        status = 'ok'
+        try:
+            with METRICS.timer('sync_seconds'):
+                fetched_count = fetch_and_process_emails(self.service, self.user_id)
+            logging.info(f"Synced {fetched_count} changed emails")
+        except Exception as e:
+            status = 'error'
+            logging.error(f"Error occured while syncing emails: {e}")
+        finally:
+            METRICS.increment('syncs_total', status=status)
+            METRICS.write_reports(METRICS_SUMMARY_PATH, METRICS_PROMETHEUS_PATH)
+
+    def run(self) -> None:
+        """Process mailbox changes until stopped."""
+        create_database()
+        self.service = self.service or get_service()
+        self.source.start(self.service, self.user_id)
+        try:
+            # Catch up with the changes made while the daemon was not running
+            self.sync()
+            while not self.stopped.is_set():
+                notification = self.source.get(timeout=constants.DAEMON_POLL_INTERVAL_SECONDS)
+                if notification is None:
+                    continue
+                # A single incremental sync covers every notification already waiting
+                while self.source.get(timeout=0) is not None:
+                    pass
+                self.sync()
+        finally:
+            self.source.close()
+
+    def stop(self) -> None:
+        """Stop the daemon after the current sync."""
+        self.stopped.set()
+
+
+def main() -> None:
+    """Run the daemon until it receives SIGINT or SIGTERM."""
+    logging.basicConfig(level=logging.INFO)
+    daemon = EmailProcessorDaemon(create_notification_source())
+    for signal_number in [signal.SIGINT, signal.SIGTERM]:
+        signal.signal(signal_number, lambda *args: daemon.stop())
+    with instrumented_run('daemon'):
+        daemon.run()
+
+
+if __name__ == '__main__':
+    main()
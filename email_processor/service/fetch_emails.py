@@ -1,64 +1,88 @@
-import base64
-import email.utils
+import itertools
 import logging
 import os.path
 import pickle
-import re
 from google_auth_oauthlib.flow import InstalledAppFlow
 from googleapiclient.discovery import build
 from googleapiclient.errors import HttpError
 from google.auth.transport.requests import Request
-from email_processor.models.emails import insert_email
-from typing import List, Dict, Any, Optional
+from email_processor.models.emails import (
+    apply_email_label_changes,
+    get_history_id,
+    save_history_id,
+    serialize_label_ids,
+    upsert_emails,
+)
+from email_processor.metrics import instrumented_run
+from email_processor.service.batch_requests import BatchFetcher, TokenBucket, execute_request, get_rate_limiter
+from email_processor.service.message_parser import extract_attachments, extract_body, parse_date, parse_headers
+from email_processor.service.pipeline import run_pipeline
+from typing import List, Dict, Any, Callable, Iterable, Iterator, Optional, Tuple
 import email_processor.service.constants as constants
 
-# List to store email messages
-emails = []
-
 
 def get_messages(
+    service: Any,
+    message_ids: Iterable[str],
+    user_id: Optional[str]=constants.DEFAULT_GMAIL_USER_ID,
+    rate_limiter: Optional[TokenBucket]=None,
+    message_format: Optional[str]=constants.MESSAGE_FETCH_FORMAT
+) -> Iterator[List[Dict[str, Any]]]:
+    """
+    Get email messages in concurrent batches, yielding each batch of messages as soon as it is fetched.
+    Parameters:
+        service: googleapiclient.discovery.Resource - Gmail API service object
+        message_ids: Iterable[str] - email message IDs, consumed lazily
+        user_id: str - user's email address
+        rate_limiter: TokenBucket - rate limiter for the user's quota
+        message_format: str - 'full' for whole messages, 'metadata' for the rule headers only
+    """
+    request_params = {'format': message_format}
+    if message_format == constants.MESSAGE_FORMAT_METADATA:
+        request_params['metadataHeaders'] = constants.METADATA_HEADERS
+    fetcher = BatchFetcher(service, user_id, rate_limiter=rate_limiter, request_params=request_params)
+    yield from fetcher.fetch(message_ids)
+
+
+def hydrate_email_bodies(
     service: Any,
     message_ids: List[str],
     user_id: Optional[str]=constants.DEFAULT_GMAIL_USER_ID
 ) -> None:
     """
-    Get email messages in batches.
+    Fetch the full messages of emails stored from metadata only and store their bodies and attachment metadata.
     Parameters:
         service: googleapiclient.discovery.Resource - Gmail API service object
-        message_ids: List[str] - list of email message IDs
+        message_ids: List[str] - IDs of emails stored without a body
         user_id: str - user's email address
     """
-    for i in range(0, len(message_ids), 50):
-        batch = service.new_batch_http_request(callback=callback)
-        for message_id in message_ids[i:i+50]:
-            batch.add(service.users().messages().get(
-                userId=user_id, id=message_id))
-        try:
-            batch.execute()
-        except HttpError as error:
-            logging.error(
-                f'Error occured while requesting email messages in batches: {error}')
-            raise error
-
-
-def callback(request_id, response, exception):
-    if exception is not None:
-        logging.error(f'Error occured while processing batch request: {exception}')
-    else:
-        emails.append(response)
-
-
-def get_service() -> Any:
+    if not message_ids:
+        return
+    logging.info(f"Fetching bodies of {len(message_ids)} emails")
+    for messages in get_messages(service, message_ids, user_id, message_format=constants.MESSAGE_FORMAT_FULL):
+        upsert_emails([
+            {
+                'message_id': message['id'],
+                'body': process_email_body(message),
+                'attachments': extract_attachments(message)
+            }
+            for message in messages
+        ])
+
+
+def get_service(token_path: Optional[str]=constants.TOKEN_PATH) -> Any:
     """
     Shows basic usage of the Gmail API
     Returns authenticated Gmail API service
+    Parameters:
+        token_path: str - path of the file storing the user's access and refresh tokens
     """
     creds = None
-    # The file token.pickle stores the user's access and refresh tokens, and is
+    # The token file stores the user's access and refresh tokens, and is
     # created automatically when the authorization flow completes for the first
     # time.
-    if os.path.exists('token.pickle'):
-        with open('token.pickle', 'rb') as token:
+    if os.path.exists(token_path):
+        with open(token_path, 'rb') as token:
             creds = pickle.load(token)
 
     # If there are no (valid) credentials available, let the user log in.
@@ -71,133 +95,290 @@ def get_service() -> Any:
             creds = flow.run_local_server(port=0)
 
         # Save the credentials for the next run
-        with open('token.pickle', 'wb') as token:
+        with open(token_path, 'wb') as token:
             pickle.dump(creds, token)
 
     service = build('gmail', 'v1', credentials=creds)
     return service
 
 
-def get_user_email(service: Any, user_id: Optional[str]=constants.DEFAULT_GMAIL_USER_ID) -> str:
+def get_user_profile(service: Any, user_id: Optional[str]=constants.DEFAULT_GMAIL_USER_ID) -> Dict[str, Any]:
     """
-    Get user's email address.
+    Get user's mailbox profile, holding the email address and current history ID.
     Parameters:
         service: googleapiclient.discovery.Resource - Gmail API service object
         user_id: str - user's email address
     """
     try:
-        user_info = service.users().getProfile(userId=user_id).execute()
-        return user_info['emailAddress']
+        get_rate_limiter(service).acquire(constants.GMAIL_QUOTA_UNITS['users.getProfile'])
+        return execute_request(service.users().getProfile(userId=user_id), 'users.getProfile')
     except HttpError as error:
-        logging.error(f"Error occured fetching user's email address: {error}")
+        logging.error(f"Error occured fetching user's profile: {error}")
         raise error
 
 
-def list_messages(service: Any, user_id: Optional[str]=constants.DEFAULT_GMAIL_USER_ID) -> List[str]:
+def get_user_email(service: Any, user_id: Optional[str]=constants.DEFAULT_GMAIL_USER_ID) -> str:
     """
-    List all Messages of the user's mailbox, handling pagination.
+    Get user's email address.
     Parameters:
         service: googleapiclient.discovery.Resource - Gmail API service object
         user_id: str - user's email address
     """
+    return get_user_profile(service, user_id)['emailAddress']
+
+
+def list_messages(
+    service: Any,
+    user_id: Optional[str]=constants.DEFAULT_GMAIL_USER_ID,
+    query: Optional[str]=constants.LIST_EMAILS_QUERY
+) -> Iterator[List[str]]:
+    """
+    List Messages of the user's mailbox, handling pagination.
+    Yields each page of message IDs as soon as it is listed, so fetching can start
+    while the next pages are still being listed.
+    Parameters:
+        service: googleapiclient.discovery.Resource - Gmail API service object
+        user_id: str - user's email address
+        query: str - Gmail search query filtering the messages, e.g. 'after:2024/03/08'
+    """
     try:
-        next_page_token, messages = None, []
+        next_page_token, total_messages = None, 0
+        rate_limiter = get_rate_limiter(service)
 
-        while len(messages) < constants.MAX_EMAILS_TO_FETCH:
+        while total_messages < constants.MAX_EMAILS_TO_FETCH:
 
-            maxResultSize = constants.MAX_EMAILS_TO_FETCH
-            if constants.MAX_EMAILS_TO_FETCH > constants.LIST_EMAILS_PAGINATION_MAX_SIZE:
-                maxResultSize = constants.LIST_EMAILS_PAGINATION_MAX_SIZE
+            maxResultSize = min(
+                constants.MAX_EMAILS_TO_FETCH - total_messages,
+                constants.LIST_EMAILS_PAGINATION_MAX_SIZE
+            )
 
-            response = service.users().messages().list(
+            rate_limiter.acquire(constants.GMAIL_QUOTA_UNITS['messages.list'])
+            response = execute_request(service.users().messages().list(
                 userId=user_id,
                 pageToken=next_page_token,
                 maxResults=maxResultSize,
-                includeSpamTrash=constants.LIST_EMAILS_INCLUDE_SPAM_TRASH_EMAILS
-            ).execute()
-            messages.extend(response.get('messages', []))
+                includeSpamTrash=constants.LIST_EMAILS_INCLUDE_SPAM_TRASH_EMAILS,
+                q=query
+            ), 'messages.list')
+            messages = [message['id'] for message in response.get('messages', [])]
+            if messages:
+                total_messages += len(messages)
+                yield messages
 
             next_page_token = response.get('nextPageToken')
             if next_page_token is None:
                 break
 
-        if not messages:
+        if not total_messages:
             logging.info("No messages found.")
         else:
-            logging.info(f"Total messages fetched: {len(messages)}")
-
-        messages = [message['id'] for message in messages]
-        return messages
+            logging.info(f"Total messages fetched: {total_messages}")
 
     except HttpError as error:
         logging.error(f'An error occurred while fetching emails: {error}')
         raise error
 
 
+def is_spam_or_trash(message: Dict[str, Any]) -> bool:
+    """
+    Check whether a message of the mailbox history is left out of syncs for being in spam or trash.
+    Parameters:
+        message: Dict[str, Any] - message of a history record, with its label IDs
+    """
+    label_ids = message.get('labelIds', [])
+    return not constants.LIST_EMAILS_INCLUDE_SPAM_TRASH_EMAILS and ('SPAM' in label_ids or 'TRASH' in label_ids)
+
+
+def list_history(
+    service: Any,
+    start_history_id: str,
+    user_id: Optional[str]=constants.DEFAULT_GMAIL_USER_ID
+) -> Tuple[List[str], str]:
+    """
+    List IDs of messages added since the given history ID, handling pagination.
+    Label changes are applied to the stored emails page by page, without fetching the messages again,
+    except for messages taken out of spam or trash, fetched like new ones.
+    Returns the message IDs and the latest history ID of the mailbox.
+    Raises HttpError with status 404 when the start history ID has expired.
+    Parameters:
+        service: googleapiclient.discovery.Resource - Gmail API service object
+        start_history_id: str - history ID saved by the last sync
+        user_id: str - user's email address
+    """
+    try:
+        next_page_token, history_id = None, start_history_id
+        rate_limiter = get_rate_limiter(service)
+        # Dict keeps the first-seen order while dropping duplicate message IDs
+        message_ids = {}
+
+        while True:
+            rate_limiter.acquire(constants.GMAIL_QUOTA_UNITS['history.list'])
+            response = execute_request(service.users().history().list(
+                userId=user_id,
+                startHistoryId=start_history_id,
+                pageToken=next_page_token,
+                maxResults=constants.LIST_HISTORY_PAGINATION_MAX_SIZE,
+                historyTypes=constants.HISTORY_TYPES
+            ), 'history.list')
+
+            # Label IDs added and removed by message, in history order
+            label_changes = {}
+            for history in response.get('history', []):
+                for change in history.get('messagesAdded', []):
+                    if not is_spam_or_trash(change['message']):
+                        message_ids[change['message']['id']] = None
+                for change in history.get('labelsAdded', []):
+                    if not is_spam_or_trash(change['message']):
+                        add_label_ids, remove_label_ids = label_changes.setdefault(
+                            change['message']['id'], (set(), set()))
+                        add_label_ids.update(change['labelIds'])
+                        remove_label_ids.difference_update(change['labelIds'])
+                for change in history.get('labelsRemoved', []):
+                    if is_spam_or_trash(change['message']):
+                        continue
+                    if not constants.LIST_EMAILS_INCLUDE_SPAM_TRASH_EMAILS and (
+                            'SPAM' in change['labelIds'] or 'TRASH' in change['labelIds']):
+                        # Restored messages were never stored
+                        message_ids[change['message']['id']] = None
+                        continue
+                    add_label_ids, remove_label_ids = label_changes.setdefault(
+                        change['message']['id'], (set(), set()))
+                    remove_label_ids.update(change['labelIds'])
+                    add_label_ids.difference_update(change['labelIds'])
+                for change in history.get('messagesDeleted', []):
+                    message_ids.pop(change['message']['id'], None)
+                    label_changes.pop(change['message']['id'], None)
+            # Messages fetched again get their current labels anyway
+            apply_email_label_changes({
+                message_id: changes for message_id, changes in label_changes.items() if message_id not in message_ids})
+
+            history_id = response.get('historyId', history_id)
+            next_page_token = response.get('nextPageToken')
+            if next_page_token is None:
+                break
+
+        logging.info(f"Total messages changed since history ID {start_history_id}: {len(message_ids)}")
+        return list(message_ids), history_id
+
+    except HttpError as error:
+        logging.error(f'An error occurred while fetching mailbox history: {error}')
+        raise error
+
+
+def get_changed_message_ids(
+    service: Any,
+    user_email: str,
+    current_history_id: str,
+    user_id: Optional[str]=constants.DEFAULT_GMAIL_USER_ID
+) -> Tuple[Iterable[str], str]:
+    """
+    Get IDs of messages to fetch along with the history ID to save for the next sync.
+    Syncs incrementally from the saved history ID when available,
+    falling back to a full listing when there is none or it has expired.
+    Parameters:
+        service: googleapiclient.discovery.Resource - Gmail API service object
+        user_email: str - email address of the mailbox owner
+        current_history_id: str - history ID of the mailbox before listing
+        user_id: str - user's email address
+    """
+    start_history_id = get_history_id(user_email) if constants.INCREMENTAL_SYNC_ENABLED else None
+    if start_history_id is not None:
+        try:
+            return list_history(service, start_history_id, user_id)
+        except HttpError as error:
+            if error.resp.status != 404:
+                raise error
+            logging.warning(
+                f"History ID {start_history_id} has expired, falling back to full sync")
+
+    return itertools.chain.from_iterable(list_messages(service, user_id)), current_history_id
+
+
 def process_email_body(message: Dict[str, Any]) -> str:
     """
     Process email body.
-    If multiple parts present, process text parts only.
-    Else process the snippet.
+    Text parts are collected at any depth of the message, else the snippet is used.
     Parameters:
-        message: Dict[str, Any] - list of email body parts
+        message: Dict[str, Any] - email message fetched in full format
     """
-    if 'parts' in message['payload']:
-        message_body = []
-        for part in message['payload']['parts']:
-            if part['mimeType'] == 'text/plain':
-                decoded_body = base64.urlsafe_b64decode(
-                    part['body']['data'] + '===').decode('utf-8', errors='ignore')
-                message_body.append(re.sub(r'\s+', ' ', decoded_body))
-        return ", ".join(message_body)
-    else:
-        return message['snippet']
+    return extract_body(message)
 
 
-def insert_emails(to_email: str) -> None:
+def parse_emails(
+    messages: List[Dict[str, Any]],
+    to_email: str,
+    include_body: Optional[bool]=True
+) -> List[Dict[str, Any]]:
     """
-    Insert email messages into the database.
+    Parse email messages into rows of the emails table.
     Parameters:
+        messages: List[Dict[str, Any]] - email messages returned by the Gmail API
         to_email: str - email address of the recipient
+        include_body: bool - False for messages fetched in metadata format, whose body and attachments
+            are fetched on demand
+    """
+    email_messages = []
+    for message in messages:
+        headers = parse_headers(message['payload'].get('headers', []))
+        email_message = {
+            'message_id': message['id'],
+            'from_address': headers.get('From', ''),
+            'to_address': to_email,
+            'subject': headers.get('Subject', ''),
+            'received_date': parse_date(headers.get('Date')),
+            'label_ids': serialize_label_ids(message.get('labelIds', []))
+        }
+        if include_body:
+            email_message['body'] = process_email_body(message)
+            email_message['attachments'] = extract_attachments(message)
+        email_messages.append(email_message)
+
+    return email_messages
+
+
+def fetch_emails(
+    service: Optional[Any]=None,
+    user_id: Optional[str]=constants.DEFAULT_GMAIL_USER_ID,
+    on_emails_parsed: Optional[Callable[[List[Dict[str, Any]]], None]]=None,
+    on_emails_stored: Optional[Callable[[List[Dict[str, Any]]], None]]=None
+) -> int:
+    """
+    Fetch emails from Gmail and insert them into the database.
+    Returns the number of emails fetched, their IDs are not kept so memory stays flat whatever the mailbox size.
+    Parameters:
+        service: googleapiclient.discovery.Resource - Gmail API service object, built when not given
+        user_id: str - user's email address
+        on_emails_parsed: Callable - called with each batch of parsed emails before it is stored
+        on_emails_stored: Callable - called with each batch of emails once it is stored, in fetch order
     """
-    for message in emails:
-        message_id = message['id']
-        to_address = to_email
-        body = process_email_body(message)
-
-        from_address = ", ".join(
-            [header['value'] for header in message['payload']
-                ['headers'] if header['name'] == 'From']
-        )
-
-        subject = ", ".join(
-            [header['value'] for header in message['payload']
-                ['headers'] if header['name'] == 'Subject']
-        )
-
-        received_date = email.utils.parsedate_to_datetime(
-            [header['value'] for header in message['payload']
-                ['headers'] if header['name'] == 'Date'][0]
-        )
-
-        insert_email(
-            message_id=message_id,
-            from_address=from_address,
-            to_address=to_address,
-            subject=subject,
-            received_date=received_date,
-            body=body
-        )
-
-
-def fetch_emails() -> None:
-    """Fetch emails from Gmail and insert them into the database."""
-    service = get_service()
-    user_email = get_user_email(service)
-    message_ids = list_messages(service)
-    get_messages(service, message_ids)
-    insert_emails(user_email)
+    service = service or get_service()
+    profile = get_user_profile(service, user_id)
+    user_email = profile['emailAddress']
+    message_ids, history_id = get_changed_message_ids(service, user_email, profile['historyId'], user_id)
+    fetched_count = 0
+
+    def parse(messages: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        return parse_emails(
+            messages, user_email, include_body=constants.MESSAGE_FETCH_FORMAT == constants.MESSAGE_FORMAT_FULL)
+
+    def handle(email_messages: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        on_emails_parsed(email_messages)
+        return email_messages
+
+    def store(email_messages: List[Dict[str, Any]]) -> None:
+        nonlocal fetched_count
+        upsert_emails(email_messages)
+        fetched_count += len(email_messages)
+        if on_emails_stored is not None:
+            on_emails_stored(email_messages)
+
+    # Fetch, parse and store each batch as it arrives, keeping memory bounded
+    stages = [parse, handle, store] if on_emails_parsed is not None else [parse, store]
+    run_pipeline(get_messages(service, message_ids, user_id), stages)
+    save_history_id(user_email, history_id)
+    return fetched_count
 
 
 if __name__ == '__main__':
-    fetch_emails()
+    with instrumented_run('fetch-emails'):
+        fetch_emails()
@@ -0,0 +1,100 @@
+import logging
+import threading
+import time
+import weakref
+from typing import Any, Dict, Optional
+from email_processor.models.emails import get_cached_labels, save_labels
+from email_processor.service.batch_requests import execute_request, get_rate_limiter
+import email_processor.service.constants as constants
+
+
+class LabelDirectory:
+    """
+    Class to resolve Gmail label names to label IDs.
+    The name to ID map is loaded from the local DB cache while it is fresh, else from the Gmail API,
+    and loaded again once it is older than ttl_seconds. A lookup missing a name reloads it from the API,
+    at most once every miss_reload_interval_seconds.
+    """
+    def __init__(
+        self,
+        service: Any,
+        user_id: Optional[str]=constants.DEFAULT_GMAIL_USER_ID,
+        create_missing: Optional[bool]=constants.LABELS_CREATE_MISSING,
+        ttl_seconds: Optional[int]=constants.LABELS_CACHE_TTL_SECONDS,
+        miss_reload_interval_seconds: Optional[float]=constants.LABELS_MISS_RELOAD_INTERVAL_SECONDS
+    ):
+        """Initialize the label directory."""
+        self.service = service
+        self.user_id = user_id
+        self.create_missing = create_missing
+        self.ttl_seconds = ttl_seconds
+        self.miss_reload_interval_seconds = miss_reload_interval_seconds
+        self.labels = None
+        self.loaded_at = None
+        self.fetched_at = None
+        self.lock = threading.Lock()
+
+    def _fetch_labels(self) -> Dict[str, str]:
+        get_rate_limiter(self.service).acquire(constants.GMAIL_QUOTA_UNITS['labels.list'])
+        response = execute_request(self.service.users().labels().list(userId=self.user_id), 'labels.list')
+        labels = {label['name']: label['id'] for label in response.get('labels', [])}
+        self.fetched_at = time.monotonic()
+        save_labels(labels)
+        return labels
+
+    def _load_labels(self) -> None:
+        self.labels = get_cached_labels(self.ttl_seconds)
+        if self.labels is None:
+            self.labels = self._fetch_labels()
+        self.loaded_at = time.monotonic()
+
+    def _can_reload_on_miss(self) -> bool:
+        return self.fetched_at is None or time.monotonic() - self.fetched_at >= self.miss_reload_interval_seconds
+
+    def _create_label(self, name: str) -> str:
+        label = execute_request(self.service.users().labels().create(userId=self.user_id, body={
+            'name': name,
+            'labelListVisibility': 'labelShow',
+            'messageListVisibility': 'show'
+        }), 'labels.create')
+        logging.info(f"Created label '{name}' with ID {label['id']}")
+        self.labels[name] = label['id']
+        save_labels(self.labels)
+        return label['id']
+
+    def get_label_id(self, name: str) -> Optional[str]:
+        """
+        Get the label ID for the given label name.
+        Parameters:
+            name: str - name of the label
+        """
+        with self.lock:
+            if self.labels is None or time.monotonic() - self.loaded_at >= self.ttl_seconds:
+                self._load_labels()
+            if name not in self.labels and self._can_reload_on_miss():
+                # Labels may have been created or renamed since they were loaded
+                self.labels = self._fetch_labels()
+                self.loaded_at = self.fetched_at
+            if name in self.labels:
+                return self.labels[name]
+            if self.create_missing:
+                return self._create_label(name)
+            return None
+
+
+# Label directories of the services in use, dropped with their service
+_LABEL_DIRECTORIES = weakref.WeakKeyDictionary()
+_LABEL_DIRECTORIES_LOCK = threading.Lock()
+
+
+def get_label_directory(service: Any, user_id: Optional[str]=constants.DEFAULT_GMAIL_USER_ID) -> LabelDirectory:
+    """
+    Get the label directory of the service, created on first use.
+    Parameters:
+        service: googleapiclient.discovery.Resource - Gmail API service object
+        user_id: str - user's email address
+    """
+    with _LABEL_DIRECTORIES_LOCK:
+        if service not in _LABEL_DIRECTORIES:
+            _LABEL_DIRECTORIES[service] = LabelDirectory(service, user_id)
+        return _LABEL_DIRECTORIES[service]
@@ -0,0 +1,255 @@
+import base64
+import codecs
+import email.utils
+import logging
+import re
+from datetime import datetime
+from html.parser import HTMLParser
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
+import email_processor.service.constants as constants
+
+CHARSET_PATTERN = re.compile(r'charset\s*=\s*"?([\w.:-]+)"?', re.IGNORECASE)
+MIME_TYPE_TEXT_PLAIN = 'text/plain'
+MIME_TYPE_TEXT_HTML = 'text/html'
+DEFAULT_CHARSET = 'utf-8'
+BODY_PARTS_SEPARATOR = ', '
+RULE_HEADERS = ['From', 'Subject', 'Date']
+# Base64 characters decoded at once, a multiple of 4 so chunks decode independently
+_DECODE_CHUNK_SIZE = 64 * 1024
+
+
+class HTMLTextExtractor(HTMLParser):
+    """Class to extract the text of an HTML document, skipping scripts and styles."""
+    SKIPPED_TAGS = {'script', 'style', 'head', 'title'}
+
+    def __init__(self):
+        """Initialize the extractor."""
+        super().__init__(convert_charrefs=True)
+        self.pieces = []
+        self.skipped_depth = 0
+
+    def handle_starttag(self, tag: str, attrs: List[Tuple[str, Optional[str]]]) -> None:
+        if tag in self.SKIPPED_TAGS:
+            self.skipped_depth += 1
+
+    def handle_endtag(self, tag: str) -> None:
+        if tag in self.SKIPPED_TAGS and self.skipped_depth:
+            self.skipped_depth -= 1
+
+    def handle_data(self, data: str) -> None:
+        if not self.skipped_depth:
+            self.pieces.append(data)
+
+
+def collapse_whitespace(text: str) -> str:
+    r"""
+    Replace each run of whitespace in the text with a single space, like re.sub(r'\s+', ' ', text).
+    str.split matches the same whitespace characters as \s and is several times faster.
+    Parameters:
+        text: str - text to collapse
+    """
+    words = text.split()
+    if not words:
+        return ' ' if text else ''
+    collapsed = ' '.join(words)
+    if text[0].isspace():
+        collapsed = ' ' + collapsed
+    if text[-1].isspace():
+        collapsed += ' '
+    return collapsed
+
+
+def html_to_text(html: str) -> str:
+    """
+    Convert an HTML document to its text, with whitespace collapsed.
+    Parameters:
+        html: str - HTML document
+    """
+    extractor = HTMLTextExtractor()
+    extractor.feed(html)
+    extractor.close()
+    return collapse_whitespace(' '.join(extractor.pieces)).strip()
+
+
+def parse_headers(headers: Iterable[Dict[str, str]], names: Optional[List[str]]=RULE_HEADERS) -> Dict[str, str]:
+    """
+    Collect the values of the given headers in a single pass, matching names case-insensitively.
+    Values of a header present several times are joined, headers missing are left out.
+    Parameters:
+        headers: Iterable[Dict[str, str]] - headers of a Gmail message payload
+        names: List[str] - names of the headers to collect
+    """
+    wanted = {name.lower(): name for name in names}
+    values = {}
+    for header in headers:
+        name = wanted.get(header['name'].lower())
+        if name is not None:
+            values.setdefault(name, []).append(header['value'])
+    return {name: ', '.join(header_values) for name, header_values in values.items()}
+
+
+def parse_date(value: Optional[str]) -> Optional[datetime]:
+    """
+    Parse the Date header of a message, None when it is missing or invalid.
+    Parameters:
+        value: str - Date header value
+    """
+    if not value:
+        return None
+    try:
+        return email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError) as e:
+        logging.warning(f"Invalid Date header '{value}': {e}")
+        return None
+
+
+def iter_leaf_parts(payload: Dict[str, Any]) -> Iterator[Dict[str, Any]]:
+    """
+    Iterate over the parts of a message payload without children, at any depth, in document order.
+    The payload tree is walked iteratively, so deeply nested messages don't hit the recursion limit.
+    Parameters:
+        payload: Dict[str, Any] - Gmail message payload
+    """
+    stack = [payload]
+    while stack:
+        part = stack.pop()
+        children = part.get('parts')
+        if children:
+            stack.extend(reversed(children))
+        else:
+            yield part
+
+
+def is_attachment(part: Dict[str, Any]) -> bool:
+    """
+    Check whether a message part is an attachment: it has a filename, an attachment ID
+    or an attachment Content-Disposition header.
+    Parameters:
+        part: Dict[str, Any] - Gmail message part
+    """
+    if part.get('filename') or part.get('body', {}).get('attachmentId'):
+        return True
+    return any(
+        header['name'].lower() == 'content-disposition'
+        and header['value'].strip().lower().startswith('attachment')
+        for header in part.get('headers', []))
+
+
+def iter_text_parts(payload: Dict[str, Any]) -> Iterator[Dict[str, Any]]:
+    """
+    Iterate over the text parts holding data in a message payload, at any depth, in document order.
+    Attachments are left out, even text ones, so attached files aren't read as the body.
+    Parameters:
+        payload: Dict[str, Any] - Gmail message payload
+    """
+    for part in iter_leaf_parts(payload):
+        if (part.get('mimeType', '').startswith('text/') and part.get('body', {}).get('data')
+                and not is_attachment(part)):
+            yield part
+
+
+def extract_attachments(message: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """
+    Extract the filename, MIME type and size of the attachments of a message, from its payload part tree.
+    Attachment contents are never downloaded, the attachmentId of their parts is left aside.
+    Parameters:
+        message: Dict[str, Any] - Gmail message fetched in full format
+    """
+    attachments = []
+    for part in iter_leaf_parts(message.get('payload', {})):
+        body = part.get('body', {})
+        if is_attachment(part):
+            attachments.append({
+                'filename': part.get('filename') or None,
+                # MIME types are case-insensitive, stored lowercase so equality conditions use the index
+                'mime_type': part.get('mimeType', '').lower() or None,
+                'size': body.get('size', 0),
+            })
+    return attachments
+
+
+def get_part_charset(part: Dict[str, Any]) -> str:
+    """
+    Get the charset of a text part from its Content-Type header, utf-8 when unknown.
+    Parameters:
+        part: Dict[str, Any] - Gmail message part
+    """
+    for header in part.get('headers', []):
+        if header['name'].lower() == 'content-type':
+            match = CHARSET_PATTERN.search(header['value'])
+            if match:
+                try:
+                    return codecs.lookup(match.group(1)).name
+                except LookupError:
+                    break
+    return DEFAULT_CHARSET
+
+
+def decode_part(data: str, charset: Optional[str]=DEFAULT_CHARSET, max_length: Optional[int]=None) -> str:
+    """
+    Decode the base64url data of a text part, with whitespace collapsed.
+    Data longer than max_length is decoded in chunks, stopping as soon as max_length
+    characters are collected, so only the start of a large part is ever decoded.
+    Parameters:
+        data: str - base64url encoded data of the part
+        charset: str - charset of the part
+        max_length: int - maximum number of characters to return, None for no limit
+    """
+    if max_length is None or len(data) * 3 // 4 <= max_length:
+        # Every character is needed, decode at once
+        return collapse_whitespace(
+            base64.urlsafe_b64decode(data + '===').decode(charset, errors='ignore'))
+
+    decoder = codecs.getincrementaldecoder(charset)(errors='ignore')
+    pieces, length = [], 0
+    for start in range(0, len(data), _DECODE_CHUNK_SIZE):
+        chunk = data[start:start + _DECODE_CHUNK_SIZE]
+        final = start + _DECODE_CHUNK_SIZE >= len(data)
+        text = collapse_whitespace(decoder.decode(
+            base64.urlsafe_b64decode(chunk + '===' if final else chunk), final=final))
+        # Whitespace runs spanning two chunks collapse into a single space
+        if pieces and pieces[-1].endswith(' ') and text.startswith(' '):
+            text = text[1:]
+        pieces.append(text)
+        length += len(text)
+        if length >= max_length:
+            break
+    return ''.join(pieces)[:max_length]
+
+
+def extract_body(
+    message: Dict[str, Any],
+    max_length: Optional[int]=constants.MAX_BODY_LENGTH,
+    convert_html: Optional[bool]=constants.BODY_HTML_TO_TEXT
+) -> str:
+    """
+    Extract the text body of a message.
+    The text/plain parts found at any depth, other than attachments, are decoded once each and joined.
+    When there is none, the text/html parts are converted to text if convert_html is set,
+    and the snippet is used otherwise.
+    Parameters:
+        message: Dict[str, Any] - Gmail message fetched in full format
+        max_length: int - maximum number of characters of the body, None for no limit
+        convert_html: bool - whether to fall back to the text of HTML parts
+    """
+    html_parts, pieces, length = [], [], 0
+    for part in iter_text_parts(message.get('payload', {})):
+        if part['mimeType'] == MIME_TYPE_TEXT_HTML:
+            html_parts.append(part)
+            continue
+        if part['mimeType'] != MIME_TYPE_TEXT_PLAIN:
+            continue
+        remaining = None if max_length is None else max_length - length
+        if remaining is not None and remaining <= 0:
+            break
+        text = decode_part(part['body']['data'], get_part_charset(part), remaining)
+        pieces.append(text)
+        length += len(text) + len(BODY_PARTS_SEPARATOR)
+    if pieces:
+        body = BODY_PARTS_SEPARATOR.join(pieces)
+    elif html_parts and convert_html:
+        body = BODY_PARTS_SEPARATOR.join(
+            html_to_text(decode_part(part['body']['data'], get_part_charset(part))) for part in html_parts)
+    else:
+        body = message.get('snippet', '')
+    return body if max_length is None else body[:max_length]
@@ -0,0 +1,97 @@
+import contextvars
+import logging
+import queue
+import threading
+from typing import Any, Callable, Iterable, List, Optional
+from email_processor.metrics import METRICS
+import email_processor.service.constants as constants
+
+# Marks the end of the stream flowing through the pipeline queues
+_END_OF_STREAM = object()
+_QUEUE_POLL_INTERVAL_SECONDS = 0.1
+
+
+def run_pipeline(
+    source: Iterable[Any],
+    stages: List[Callable[[Any], Any]],
+    queue_size: Optional[int]=constants.PIPELINE_QUEUE_SIZE
+) -> None:
+    """
+    Stream items from the source through the stages, each stage running in its own thread.
+    Stages are connected by bounded queues, so a slow stage applies backpressure upstream
+    and at most queue_size items are held between two stages.
+    The output of a stage is the input of the next one, the output of the last stage is dropped.
+    Raises the first error raised by the source or any stage, after stopping all threads.
+    Parameters:
+        source: Iterable[Any] - items to stream, consumed lazily
+        stages: List[Callable[[Any], Any]] - functions applied to each item in order
+        queue_size: int - maximum number of items waiting between two stages
+    """
+    queues = [queue.Queue(maxsize=queue_size) for _ in stages]
+    stop, errors = threading.Event(), []
+
+    def put(item_queue: queue.Queue, item: Any) -> bool:
+        while not stop.is_set():
+            try:
+                item_queue.put(item, timeout=_QUEUE_POLL_INTERVAL_SECONDS)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def get(item_queue: queue.Queue) -> Any:
+        while not stop.is_set():
+            try:
+                return item_queue.get(timeout=_QUEUE_POLL_INTERVAL_SECONDS)
+            except queue.Empty:
+                continue
+        return _END_OF_STREAM
+
+    def fail(error: Exception) -> None:
+        logging.error(f"Error occured in the email pipeline: {error}")
+        errors.append(error)
+        stop.set()
+
+    def produce() -> None:
+        try:
+            for item in source:
+                if not put(queues[0], item):
+                    return
+            put(queues[0], _END_OF_STREAM)
+        except Exception as e:
+            fail(e)
+
+    def consume(index: int) -> None:
+        stage = stages[index]
+        stage_name = getattr(stage, '__name__', str(index))
+        output_queue = queues[index + 1] if index + 1 < len(queues) else None
+        try:
+            while True:
+                item = get(queues[index])
+                if item is _END_OF_STREAM:
+                    break
+                with METRICS.timer('pipeline_stage_seconds', stage=stage_name):
+                    result = stage(item)
+                if output_queue is not None and not put(output_queue, result):
+                    return
+            if output_queue is not None:
+                put(output_queue, _END_OF_STREAM)
+        except Exception as e:
+            fail(e)
+
+    # Threads run in a copy of the caller's context, to use the same account database
+    threads = [threading.Thread(
+        target=contextvars.copy_context().run, args=(produce,), name='pipeline-source', daemon=True)]
+    threads.extend(
+        threading.Thread(
+            target=contextvars.copy_context().run, args=(consume, index),
+            name=f'pipeline-stage-{index}', daemon=True)
+        for index in range(len(stages))
+    )
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    if errors:
+        raise errors[0]
@@ -1,17 +1,54 @@
+import itertools
 import json
 import logging
-import requests
-from typing import Any, List, Optional
-from email_processor.models.constants import RULE_ACTION_MARK_AS_READ, RULE_ACTION_MOVE_TO_FOLDER
-from email_processor.models.emails import get_email_ids_for_rules
+import queue
+from typing import Any, Dict, FrozenSet, Iterable, Iterator, List, Optional, Set, Tuple
+from googleapiclient.errors import HttpError
+from email_processor.models.constants import (
+    IN_PROCESS_EVALUATION_DIALECTS,
+    QUERY_MESSAGE_IDS_CHUNK_SIZE,
+    RULE_ACTION_MARK_AS_READ,
+    RULE_ACTION_MOVE_TO_FOLDER,
+)
+from email_processor.models.emails import (
+    get_dialect_name,
+    get_rule_watermarks,
+    get_unhydrated_email_ids,
+    iter_cached_rule_matches,
+    iter_rule_matches,
+    parse_label_ids,
+    prune_label_actions,
+    refresh_rule_matches,
+    update_email_labels,
+)
+from email_processor.metrics import METRICS, instrumented_run
+from email_processor.models.evaluator import match_rules
+from email_processor.service.actions import (
+    apply_label_actions,
+    batch_label_changes,
+    drain_label_actions,
+    journal_label_actions,
+)
+from email_processor.service.batch_requests import execute_request
 from email_processor.models.rules import Rule
-from email_processor.service.constants import DEFAULT_GMAIL_USER_ID, RULE_FILE_PATH, MODIFY_EMAILS_BATCH_SIZE
-from email_processor.service.fetch_emails import get_service
+from email_processor.service.constants import (
+    DEFAULT_GMAIL_USER_ID,
+    MODIFY_EMAILS_BATCH_SIZE,
+    RULE_FILE_PATH,
+    RULE_MATCH_CACHE_ENABLED,
+)
+from email_processor.service.fetch_emails import fetch_emails, get_service, hydrate_email_bodies
+from email_processor.service.labels import get_label_directory
+from email_processor.service.rule_cache import RuleCache
 
+# Rules of the rules file, compiled once and shared by every sync of the process
+RULE_CACHE = RuleCache()
 
-def read_rules_from_json(file_path: Optional[str] = RULE_FILE_PATH) -> Rule:
+
+def read_rules_from_json(file_path: Optional[str] = RULE_FILE_PATH) -> List[Rule]:
     """
-    Read rules from a JSON file.
+    Read rules from a JSON file, holding either a single rule or a list of rules.
+    Rules are returned in evaluation order.
     Parameters:
         file_path: str - path to the JSON file containing rules
     """
@@ -19,52 +56,46 @@ def read_rules_from_json(file_path: Optional[str] = RULE_FILE_PATH) -> Rule:
         rules_data = json.load(file)
 
     try:
-        rules = Rule.from_dict(rules_data)
+        rules = Rule.list_from_json(rules_data)
         return rules
     except ValueError as e:
         logging.error(f"Error processing rules: {str(e)}")
         raise e
 
 
+def get_rules() -> List[Rule]:
+    """Get the rules of the rules file from the rule cache, reloaded when the file changes."""
+    try:
+        return RULE_CACHE.get_rules()
+    except ValueError as e:
+        logging.error(f"Error processing rules: {str(e)}")
+        raise e
+
+
 def get_label_id(service: Any, folder_name: str) -> Optional[str]:
     """
-    Get label ID for the given folder name.
+    Get label ID for the given folder name, from the label directory cached for the service.
     Parameters:
         service: googleapiclient.discovery.Resource - Gmail API service object
         folder_name: str - name of the folder
     """
     try:
-        labels = service.users().labels().list(userId='me').execute()
-        for label in labels['labels']:
-            if label['name'] == folder_name:
-                return label['id']
-        return None
+        return get_label_directory(service).get_label_id(folder_name)
     except Exception as e:
         logging.error(f"Error getting label ID for folder: {str(e)}")
         return None
 
 
-def perform_rule_actions(
-    service: Any,
-    email_ids: List[str],
-    rules: Rule,
-    user_id: Optional[str] = DEFAULT_GMAIL_USER_ID
-) -> None:
+def get_label_changes(service: Any, rule: Rule) -> Tuple[List[str], List[str]]:
     """
-    Perform rule actions on emails using Gmail service for batch modification.
+    Get the label IDs to add and to remove for the rule actions.
     Parameters:
         service: googleapiclient.discovery.Resource - Gmail API service object
-        email_ids: list - list of email IDs
-        rules: Rule - rule object
-        user_id: str - user ID
+        rule: Rule - rule object
     """
-    # Split email ids into batches
-    batches = [email_ids[i:i + MODIFY_EMAILS_BATCH_SIZE]
-               for i in range(0, len(email_ids), MODIFY_EMAILS_BATCH_SIZE)]
-
     addLabelIds, removeLabelIds = [], []
 
-    for action, value in rules.actions.items():
+    for action, value in rule.actions.items():
         if action == RULE_ACTION_MOVE_TO_FOLDER:
             folder_name = get_label_id(service, value)
             if folder_name:
@@ -77,6 +108,29 @@ def perform_rule_actions(
             else:
                 addLabelIds.append("UNREAD")
 
+    return addLabelIds, removeLabelIds
+
+
+def apply_label_changes(
+    service: Any,
+    email_ids: Iterable[str],
+    addLabelIds: List[str],
+    removeLabelIds: List[str],
+    user_id: Optional[str] = DEFAULT_GMAIL_USER_ID
+) -> None:
+    """
+    Add and remove labels on emails using Gmail service for batch modification.
+    Parameters:
+        service: googleapiclient.discovery.Resource - Gmail API service object
+        email_ids: Iterable[str] - email IDs, consumed lazily
+        addLabelIds: list - label IDs to add
+        removeLabelIds: list - label IDs to remove
+        user_id: str - user ID
+    """
+    # Split email ids into batches as they come, each one sent before the next is read
+    email_ids = iter(email_ids)
+    batches = iter(lambda: list(itertools.islice(email_ids, MODIFY_EMAILS_BATCH_SIZE)), [])
+
     logging.info(
         f"Performing rule actions: addLabelIds={addLabelIds}, removeLabelIds={removeLabelIds}")
 
@@ -88,22 +142,245 @@ def perform_rule_actions(
             "removeLabelIds": removeLabelIds
         }
         try:
-            service.users().messages().batchModify(
-                userId=user_id, body=batch_request).execute()
+            execute_request(service.users().messages().batchModify(
+                userId=user_id, body=batch_request), 'messages.batchModify')
             logging.info(f"Rule actions performed successfully for batch: {batch}")
-        except requests.HTTPError as error:
+            update_email_labels(batch, addLabelIds, removeLabelIds)
+        except HttpError as error:
             logging.error(
                 f'Error occured while performing email actions in batches: {error}')
             raise error
 
 
-def process_emails_for_rule_actions() -> None:
-    """Process emails for the given rule actions."""
-    service, rules = get_service(), read_rules_from_json()
-    email_ids = get_email_ids_for_rules(rules)
+def perform_rule_actions(
+    service: Any,
+    email_ids: List[str],
+    rules: Rule,
+    user_id: Optional[str] = DEFAULT_GMAIL_USER_ID
+) -> None:
+    """
+    Perform rule actions on emails using Gmail service for batch modification.
+    Parameters:
+        service: googleapiclient.discovery.Resource - Gmail API service object
+        email_ids: list - list of email IDs
+        rules: Rule - rule object
+        user_id: str - user ID
+    """
+    addLabelIds, removeLabelIds = get_label_changes(service, rules)
+    apply_label_changes(service, email_ids, addLabelIds, removeLabelIds, user_id)
+
+
+def merge_label_changes(
+    rules: List[Rule],
+    label_changes: List[Tuple[List[str], List[str]]],
+    stored_label_ids: Optional[str],
+    rule_indexes: List[int]
+) -> Tuple[Set[str], Set[str]]:
+    """
+    Merge the label changes of the rules matched by an email into the label IDs to add and to remove.
+    Rules are applied in evaluation order: the first rule deciding to add or remove a label wins,
+    and a matched rule with the stop processing flag set ends the evaluation.
+    Changes already reflected in the stored labels of the email are skipped.
+    Parameters:
+        rules: List[Rule] - rule objects, in evaluation order
+        label_changes: List[Tuple[List[str], List[str]]] - label IDs to add and remove for each rule
+        stored_label_ids: str - serialized label IDs stored for the email
+        rule_indexes: List[int] - indexes of the rules the email matches
+    """
+    addLabelIds, removeLabelIds = set(), set()
+    for index in sorted(rule_indexes):
+        rule_add_label_ids, rule_remove_label_ids = label_changes[index]
+        addLabelIds.update(set(rule_add_label_ids) - removeLabelIds)
+        removeLabelIds.update(set(rule_remove_label_ids) - addLabelIds)
+        if rules[index].stop_processing:
+            break
+    current_label_ids = parse_label_ids(stored_label_ids)
+    if current_label_ids is not None:
+        addLabelIds -= current_label_ids
+        removeLabelIds &= current_label_ids
+    return addLabelIds, removeLabelIds
+
+
+def hydrate_rule_bodies(
+    service: Any,
+    rules: List[Rule],
+    message_ids: Optional[List[str]] = None,
+    user_id: Optional[str] = DEFAULT_GMAIL_USER_ID,
+    watermarks: Optional[Dict[str, int]] = None
+) -> None:
+    """
+    Fetch the bodies and attachments of the stored emails that conditions of the rules need to be evaluated.
+    Parameters:
+        service: googleapiclient.discovery.Resource - Gmail API service object
+        rules: List[Rule] - rule objects
+        message_ids: list - IDs of the emails to consider, all emails when not given
+        user_id: str - user ID
+        watermarks: Dict[str, int] - watermarks of the rule match cache by rule hash, only the emails
+            the cache evaluates next are considered when given
+    """
+    full_message_rules = [rule for rule in rules if rule.needs_full_message()]
+    if full_message_rules:
+        unhydrated_email_ids = dict.fromkeys(
+            email_id
+            for rule in full_message_rules
+            for email_id in get_unhydrated_email_ids(
+                rule,
+                message_ids,
+                None if watermarks is None else watermarks.get(rule.get_definition_hash(), 0)
+            )
+        )
+        hydrate_email_bodies(service, list(unhydrated_email_ids), user_id)
+
+
+def get_stored_rule_matches(
+    service: Any,
+    rules: List[Rule],
+    message_ids: Optional[List[str]] = None,
+    user_id: Optional[str] = DEFAULT_GMAIL_USER_ID
+) -> Iterator[Tuple[str, Optional[str], List[int]]]:
+    """
+    Evaluate the rules on the stored emails, fetching the bodies and attachments their conditions need first.
+    The matches are streamed from the database as they are consumed.
+    Parameters:
+        service: googleapiclient.discovery.Resource - Gmail API service object
+        rules: List[Rule] - rule objects, in evaluation order
+        message_ids: list - IDs of the emails to evaluate, all emails when not given
+        user_id: str - user ID
+    """
+    hydrate_rule_bodies(service, rules, message_ids, user_id)
+    return iter_rule_matches(rules, message_ids)
+
+
+def get_cached_rule_matches(
+    service: Any,
+    rules: List[Rule],
+    user_id: Optional[str] = DEFAULT_GMAIL_USER_ID
+) -> Iterator[Tuple[str, Optional[str], List[int]]]:
+    """
+    Get the matches of the rules on all the stored emails through the rule match cache.
+    Each rule is only evaluated on the emails stored since its last run and the emails changed since,
+    so the cost of a run follows the new mail, not the size of the mailbox.
+    The matches are streamed from the database as they are consumed.
+    Parameters:
+        service: googleapiclient.discovery.Resource - Gmail API service object
+        rules: List[Rule] - rule objects, in evaluation order
+        user_id: str - user ID
+    """
+    hydrate_rule_bodies(service, rules, user_id=user_id, watermarks=get_rule_watermarks(rules))
+    refresh_rule_matches(rules)
+    return iter_cached_rule_matches(rules)
+
+
+def apply_rule_matches(
+    service: Any,
+    rules: List[Rule],
+    matches: Iterable[Tuple[str, Optional[str], List[int]]],
+    user_id: Optional[str] = DEFAULT_GMAIL_USER_ID
+) -> None:
+    """
+    Plan the label changes of the matched rules, journal them and apply them, as the matches are read.
+    Each batch modification is journaled, then sent as soon as MODIFY_EMAILS_BATCH_SIZE emails share it,
+    so memory stays flat however many emails match.
+    Parameters:
+        service: googleapiclient.discovery.Resource - Gmail API service object
+        rules: List[Rule] - rule objects, in evaluation order
+        matches: Iterable - email IDs with their label IDs and the indexes of the rules they match, consumed lazily
+        user_id: str - user ID
+    """
+    label_changes = [get_label_changes(service, rule) for rule in rules]
+    counts = {'matched': 0, 'changed': 0}
+
+    def get_email_label_changes() -> Iterator[Tuple[str, FrozenSet[str], FrozenSet[str]]]:
+        for email_id, stored_label_ids, rule_indexes in matches:
+            counts['matched'] += 1
+            addLabelIds, removeLabelIds = merge_label_changes(rules, label_changes, stored_label_ids, rule_indexes)
+            if addLabelIds or removeLabelIds:
+                counts['changed'] += 1
+                yield email_id, frozenset(addLabelIds), frozenset(removeLabelIds)
+
+    apply_label_actions(service, journal_label_actions(batch_label_changes(get_email_label_changes())), user_id)
+    logging.info(
+        f"{counts['matched']} emails matched {len(rules)} rules, {counts['changed']} needed label changes")
+
+
+def process_emails_for_rule_actions(
+    service: Optional[Any] = None,
+    message_ids: Optional[List[str]] = None,
+    user_id: Optional[str] = DEFAULT_GMAIL_USER_ID
+) -> None:
+    """
+    Process stored emails for the actions of all the rules, evaluated in a single pass.
+    Parameters:
+        service: googleapiclient.discovery.Resource - Gmail API service object, built when not given
+        message_ids: list - IDs of the emails to process, all emails when not given
+        user_id: str - user ID
+    """
+    service, rules = service or get_service(), get_rules()
+
+    # Resume the label actions left pending by an interrupted run before planning new ones
+    drain_label_actions(service, user_id)
+    prune_label_actions()
+
+    if message_ids is None and RULE_MATCH_CACHE_ENABLED:
+        matches = get_cached_rule_matches(service, rules, user_id)
+    else:
+        matches = get_stored_rule_matches(service, rules, message_ids, user_id)
+    apply_rule_matches(service, rules, matches, user_id)
+
+
+def fetch_and_process_emails(
+    service: Optional[Any] = None,
+    user_id: Optional[str] = DEFAULT_GMAIL_USER_ID
+) -> int:
+    """
+    Fetch new emails and process them for the rule actions, batch by batch as they are fetched.
+    On SQLite, rules are evaluated on each batch of emails before it is stored, and emails whose rules depend
+    on a body not fetched yet are evaluated on the database once stored, QUERY_MESSAGE_IDS_CHUNK_SIZE at a time.
+    On other databases, whose case folding the in-process evaluator doesn't reproduce, every email is.
+    Matches are applied every MODIFY_EMAILS_BATCH_SIZE emails, so memory stays flat whatever the size of the fetch.
+    Returns the number of emails fetched.
+    Parameters:
+        service: googleapiclient.discovery.Resource - Gmail API service object, built when not given
+        user_id: str - user ID
+    """
+    service, rules = service or get_service(), get_rules()
+
+    # Resume the label actions left pending by an interrupted run before planning new ones
+    drain_label_actions(service, user_id)
+    prune_label_actions()
+
+    # Results of the evaluated batches, read back in the same order once each batch is stored
+    evaluated_batches = queue.SimpleQueue()
+    matches, undecided_ids = [], []
+    evaluate_in_process = get_dialect_name() in IN_PROCESS_EVALUATION_DIALECTS
+
+    def evaluate(email_messages: List[Dict[str, Any]]) -> None:
+        with METRICS.timer('rule_evaluation_seconds'):
+            evaluated_batches.put(match_rules(email_messages, rules))
+
+    def apply(flush: bool = False) -> None:
+        if undecided_ids and (flush or len(undecided_ids) >= QUERY_MESSAGE_IDS_CHUNK_SIZE):
+            matches.extend(get_stored_rule_matches(service, rules, list(undecided_ids), user_id))
+            undecided_ids.clear()
+        if matches and (flush or len(matches) >= MODIFY_EMAILS_BATCH_SIZE):
+            apply_rule_matches(service, rules, matches, user_id)
+            matches.clear()
+
+    def on_emails_stored(email_messages: List[Dict[str, Any]]) -> None:
+        if evaluate_in_process:
+            batch_matches, batch_undecided_ids = evaluated_batches.get()
+        else:
+            batch_matches, batch_undecided_ids = [], [email_message['message_id'] for email_message in email_messages]
+        matches.extend(batch_matches)
+        undecided_ids.extend(batch_undecided_ids)
+        apply()
 
-    perform_rule_actions(service, email_ids, rules)
+    fetched_count = fetch_emails(
+        service, user_id, on_emails_parsed=evaluate if evaluate_in_process else None, on_emails_stored=on_emails_stored)
+    apply(flush=True)
+    return fetched_count
 
 
 if __name__ == "__main__":
-    process_emails_for_rule_actions()
+    with instrumented_run('process-emails'):
+        process_emails_for_rule_actions()
@@ -0,0 +1,54 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+from typing import List, Optional, Tuple
+import email_processor.service.constants as constants
+from email_processor.models.rules import Rule
+
+
+class RuleCache:
+    """
+    Class to keep the rules of a rules file compiled in memory, reloaded when the file changes.
+    The file is read again only when its modification time or size changes, and its rules are
+    compiled again only when its content hash changes.
+    """
+    def __init__(self, file_path: Optional[str]=constants.RULE_FILE_PATH):
+        """Initialize the cache, the rules are loaded on first use."""
+        self.file_path = file_path
+        self.file_stat: Optional[Tuple[int, int]] = None
+        self.content_hash: Optional[str] = None
+        self.rules: Optional[List[Rule]] = None
+        self.lock = threading.Lock()
+
+    def get_rules(self) -> List[Rule]:
+        """
+        Get the rules of the file, reloaded if it changed since the last call.
+        A rules file changed into invalid rules keeps the rules loaded before in use, and is logged.
+        """
+        stat = os.stat(self.file_path)
+        file_stat = (stat.st_mtime_ns, stat.st_size)
+        with self.lock:
+            if file_stat != self.file_stat:
+                try:
+                    self.reload()
+                except Exception as e:
+                    # Nothing to fall back to on the first load
+                    if self.rules is None:
+                        raise e
+                    logging.error(
+                        f"Invalid rules in {self.file_path}, keeping the {len(self.rules)} rules loaded before: {e!r}")
+                self.file_stat = file_stat
+            return self.rules
+
+    def reload(self) -> None:
+        """Read the rules file, compiling its rules unless its content is unchanged."""
+        with open(self.file_path, 'rb') as file:
+            content = file.read()
+        content_hash = hashlib.sha256(content).hexdigest()
+        if content_hash == self.content_hash:
+            return
+        rules = Rule.list_from_json(json.loads(content))
+        logging.info(f"Loaded {len(rules)} rules from {self.file_path}")
+        self.rules, self.content_hash = rules, content_hash
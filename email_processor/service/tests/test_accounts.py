@@ -0,0 +1,141 @@
+import json
+import os
+import tempfile
+import threading
+import unittest
+from datetime import datetime
+from unittest.mock import MagicMock, patch
+from email_processor.models import emails
+from email_processor.service.accounts import Account, AccountPool, read_accounts_from_json, sync_account
+from email_processor.service.batch_requests import get_fetch_executor, get_modify_executor
+
+
+class TestAccounts(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def write_accounts(self, accounts_data):
+        file_path = os.path.join(self.directory.name, 'accounts.json')
+        with open(file_path, 'w') as file:
+            json.dump(accounts_data, file)
+        return file_path
+
+    def test_read_accounts_from_json(self):
+        file_path = self.write_accounts([
+            {'name': 'alice', 'token_path': 'alice.pickle', 'database_url': 'sqlite:///alice.db'},
+            {'name': 'bob', 'token_path': 'bob.pickle', 'database_url': 'sqlite:///bob.db'},
+        ])
+
+        # Call the function
+        accounts = read_accounts_from_json(file_path)
+
+        # Assert that every account was read with the default user ID
+        self.assertEqual([account.name for account in accounts], ['alice', 'bob'])
+        self.assertEqual(accounts[1].token_path, 'bob.pickle')
+        self.assertEqual(accounts[1].user_id, 'me')
+
+    def test_read_accounts_from_json_when_accounts_are_invalid(self):
+        with self.assertRaises(ValueError):
+            read_accounts_from_json(self.write_accounts([{'name': 'alice', 'token_path': 'alice.pickle'}]))
+        with self.assertRaises(ValueError):
+            read_accounts_from_json(self.write_accounts([
+                {'name': 'alice', 'token_path': 'alice.pickle', 'database_url': 'sqlite:///alice.db'},
+                {'name': 'alice', 'token_path': 'bob.pickle', 'database_url': 'sqlite:///bob.db'},
+            ]))
+
+    @patch('email_processor.service.accounts.fetch_and_process_emails')
+    def test_sync_account_when_accounts_have_their_own_database(self, mock_fetch_and_process_emails):
+        accounts = [
+            Account(name, f'{name}.pickle', f'sqlite:///{self.directory.name}/{name}.db')
+            for name in ['alice', 'bob']
+        ]
+        for account in accounts:
+            account.service = MagicMock()
+
+        def fetch_and_process_emails(service, user_id):
+            emails.upsert_emails([{
+                'message_id': str(id(service)), 'from_address': 'sender@example.com',
+                'received_date': datetime(2024, 3, 8)
+            }])
+            return 1
+        mock_fetch_and_process_emails.side_effect = fetch_and_process_emails
+
+        # Sync both accounts concurrently
+        pool = AccountPool(sync_account, workers=2)
+        for account in accounts:
+            pool.schedule(account)
+        pool.join()
+        pool.close()
+
+        # Assert that each account's emails were stored in its own database only
+        for account in accounts:
+            with emails.use_database(account.database_url):
+                session = emails.get_session()
+                message_ids = [email.message_id for email in session.query(emails.EmailMessage).all()]
+                session.close()
+            self.assertEqual(message_ids, [str(id(account.service))])
+
+    def test_account_pool_when_accounts_are_rescheduled(self):
+        runs, running, release = [], set(), threading.Event()
+        lock = threading.Lock()
+
+        def process(account):
+            with lock:
+                # Assert that an account is never processed twice at once
+                self.assertNotIn(account.name, running)
+                running.add(account.name)
+                runs.append(account.name)
+            if account.name == 'large':
+                release.wait()
+            with lock:
+                running.discard(account.name)
+
+        large, small = Account('large', '', ''), Account('small', '', '')
+        pool = AccountPool(process, workers=2)
+        pool.schedule(large)
+        while 'large' not in runs:
+            release.wait(0.01)
+
+        # Schedule the large account while it is being processed, and a small one
+        for _ in range(3):
+            pool.schedule(large)
+        pool.schedule(small)
+        while 'small' not in runs:
+            release.wait(0.01)
+        release.set()
+        pool.join()
+        pool.close()
+
+        # Assert that the small account didn't wait, and the large one ran once more
+        self.assertEqual(runs, ['large', 'small', 'large'])
+
+    def test_account_pool_when_accounts_share_executors(self):
+        executors, lock = {}, threading.Lock()
+
+        def process(account):
+            with get_fetch_executor(4) as fetch_executor, get_modify_executor(4) as modify_executor:
+                # Submit a task, as the pipeline threads of the account would
+                fetch_executor.submit(lambda: None).result()
+                with lock:
+                    executors[account.name] = (fetch_executor, modify_executor)
+
+        accounts = [Account(f'account-{index}', '', '') for index in range(4)]
+        pool = AccountPool(process, workers=4, fetch_workers=2, modify_workers=2)
+        for account in accounts:
+            pool.schedule(account)
+        pool.join()
+        pool.close()
+
+        # Assert that every account used the pool's executors instead of starting its own
+        self.assertEqual(set(executors.values()), {(pool.fetch_executor, pool.modify_executor)})
+        self.assertEqual(len(executors), 4)
+        # Assert that the accounts' own pools are used again outside of the account pool
+        with get_fetch_executor(1) as fetch_executor:
+            self.assertIsNot(fetch_executor, pool.fetch_executor)
+
+
+if __name__ == '__main__':
+    unittest.main()
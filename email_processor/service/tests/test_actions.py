@@ -0,0 +1,120 @@
+import tempfile
+import unittest
+from unittest.mock import MagicMock, Mock, patch
+from googleapiclient.errors import HttpError
+from sqlalchemy.orm import sessionmaker
+from email_processor.models import emails
+from email_processor.models.rules import Rule
+from email_processor.service.actions import batch_label_changes, drain_label_actions
+from email_processor.service.process_rules import apply_rule_matches
+from email_processor.service.batch_requests import TokenBucket
+
+
+class TestActions(unittest.TestCase):
+    def setUp(self):
+        # Use a temporary database file for each test, each worker thread gets its own connection
+        self.directory = tempfile.TemporaryDirectory()
+        engine = emails.create_database_engine(f'sqlite:///{self.directory.name}/email.db')
+        emails.BASE.metadata.create_all(engine)
+        self.session_patcher = patch.object(emails, 'DB_SESSION', sessionmaker(bind=engine))
+        self.session_patcher.start()
+        self.rate_limiter = TokenBucket(rate=10000, capacity=10000)
+
+    def tearDown(self):
+        self.session_patcher.stop()
+        self.directory.cleanup()
+
+    def get_actions(self):
+        session = emails.DB_SESSION()
+        actions = {
+            action.message_ids: (action.status, action.attempts)
+            for action in session.query(emails.LabelAction)
+        }
+        session.close()
+        return actions
+
+    @patch('email_processor.service.actions.constants.MODIFY_EMAILS_BATCH_SIZE', 2)
+    def test_batch_label_changes_when_changes_are_streamed(self):
+        read_email_ids = []
+
+        def get_changes():
+            for email_id in ['1', '2', '3', '4', '5']:
+                read_email_ids.append(email_id)
+                yield email_id, frozenset(['Label_1']) if email_id != '3' else frozenset(), frozenset(['UNREAD'])
+
+        # Call the function
+        actions = batch_label_changes(get_changes())
+
+        # Assert that a full batch is yielded before the next changes are read
+        self.assertEqual(next(actions), (['1', '2'], ['Label_1'], ['UNREAD']))
+        self.assertEqual(read_email_ids, ['1', '2'])
+        self.assertEqual(list(actions), [
+            (['4', '5'], ['Label_1'], ['UNREAD']),
+            (['3'], [], ['UNREAD']),
+        ])
+
+    @patch('email_processor.service.actions.constants.MODIFY_EMAILS_BATCH_SIZE', 2)
+    @patch('email_processor.service.process_rules.get_label_changes', return_value=([], ['UNREAD']))
+    def test_apply_rule_matches_when_matches_are_streamed(self, mock_get_label_changes):
+        emails.upsert_emails([
+            {'message_id': str(index), 'subject': 'Invoice', 'label_ids': 'INBOX,UNREAD'} for index in range(5)
+        ])
+        rules = [Rule('All', [{'field': 'subject', 'predicate': 'contains', 'value': 'invoice'}], {'mark_as_read': True})]
+        service = MagicMock()
+
+        # Call the function with the matches streamed from the database, while actions update it
+        apply_rule_matches(service, rules, emails.iter_rule_matches(rules))
+
+        # Assert that every batch was journaled and applied, and the stored labels updated
+        self.assertEqual(service.users().messages().batchModify.call_count, 3)
+        self.assertEqual(sorted(self.get_actions().values()), [('done', 1)] * 3)
+        session = emails.DB_SESSION()
+        self.assertEqual({row.label_ids for row in session.query(emails.EmailMessage.label_ids)}, {'INBOX'})
+        session.close()
+
+    @patch('email_processor.service.actions.time.sleep')
+    def test_drain_label_actions_when_batches_fail(self, mock_sleep):
+        email_message = {'message_id': '1', 'label_ids': emails.serialize_label_ids(['INBOX', 'UNREAD'])}
+        emails.upsert_emails([email_message])
+        emails.enqueue_label_actions([
+            (['1'], [], ['UNREAD']),
+            (['2'], ['Label_1'], []),
+            (['3'], ['Label_2'], []),
+        ])
+
+        # Message 1 succeeds after a transient error, 2 fails for good, 3 keeps being rate limited
+        responses = {
+            '1': [HttpError(Mock(status=503), b'Unavailable'), {}],
+            '2': [HttpError(Mock(status=400), b'Invalid label')],
+            '3': [HttpError(Mock(status=429), b'Too Many Requests')] * 10,
+        }
+        service = MagicMock()
+
+        def batch_modify(userId, body):
+            request = MagicMock()
+            response = responses[body['ids'][0]].pop(0)
+            request.execute.side_effect = response if isinstance(response, Exception) else None
+            return request
+
+        service.users().messages().batchModify.side_effect = batch_modify
+
+        # Call the function
+        with self.assertRaises(HttpError):
+            drain_label_actions(service, rate_limiter=self.rate_limiter)
+
+        # Assert that each action was journaled with its outcome
+        self.assertEqual(self.get_actions(), {'1': ('done', 1), '2': ('failed', 1), '3': ('pending', 1)})
+        session = emails.DB_SESSION()
+        self.assertEqual(session.query(emails.EmailMessage.label_ids).scalar(), 'INBOX')
+        session.close()
+
+        # Assert that the next run resumes with the pending action only
+        responses['3'] = [{}]
+        drain_label_actions(service, rate_limiter=self.rate_limiter)
+        self.assertEqual(self.get_actions()['3'], ('done', 2))
+        emails.prune_label_actions()
+        self.assertEqual(list(self.get_actions()), ['2'])
+
+
+if __name__ == '__main__':
+    unittest.main()
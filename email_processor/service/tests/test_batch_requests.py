@@ -0,0 +1,126 @@
+import time
+import unittest
+import httplib2
+from unittest.mock import MagicMock, Mock, patch
+from googleapiclient.errors import HttpError
+from email_processor.metrics import METRICS
+from email_processor.service.batch_requests import BatchFetcher, TokenBucket, execute_request, is_retryable_error
+
+
+class TestBatchRequests(unittest.TestCase):
+    def build_service(self, responses):
+        """Mock a service whose batch requests answer with the given status per message ID."""
+        service = MagicMock()
+        batches = []
+
+        def new_batch_http_request(callback):
+            batch = MagicMock()
+
+            def execute(http=None):
+                for call in batch.add.call_args_list:
+                    request_id = call.kwargs['request_id']
+                    status = responses[request_id].pop(0)
+                    if status == 200:
+                        callback(request_id, {'id': request_id}, None)
+                    else:
+                        callback(request_id, None, HttpError(Mock(status=status), b'Error'))
+
+            batch.execute.side_effect = execute
+            batches.append(batch)
+            return batch
+
+        service.new_batch_http_request.side_effect = new_batch_http_request
+        return service, batches
+
+    def test_is_retryable_error(self):
+        self.assertTrue(is_retryable_error(HttpError(Mock(status=429), b'Too Many Requests')))
+        self.assertTrue(is_retryable_error(HttpError(Mock(status=503), b'Unavailable')))
+        self.assertTrue(is_retryable_error(HttpError(Mock(status=403), b'{"reason": "userRateLimitExceeded"}')))
+        self.assertFalse(is_retryable_error(HttpError(Mock(status=403), b'Forbidden')))
+        self.assertFalse(is_retryable_error(HttpError(Mock(status=404), b'Not Found')))
+        self.assertTrue(is_retryable_error(ConnectionResetError('Connection reset by peer')))
+        self.assertTrue(is_retryable_error(TimeoutError('timed out')))
+        self.assertTrue(is_retryable_error(httplib2.ServerNotFoundError('Unable to find the server')))
+        self.assertFalse(is_retryable_error(ValueError('Invalid')))
+
+    def test_execute_request_counts_requests_by_status(self):
+        METRICS.reset()
+        request = MagicMock()
+        request.execute.side_effect = [{'messages': []}, HttpError(Mock(status=503), b'Unavailable')]
+
+        # Call the function once successfully, then with an error
+        self.assertEqual(execute_request(request, 'messages.list'), {'messages': []})
+        with self.assertRaises(HttpError):
+            execute_request(request, 'messages.list')
+
+        # Assert that both requests are counted by status and timed
+        summary = METRICS.summary()
+        self.assertEqual(
+            {tuple(sorted(series['labels'].items())): series['value']
+             for series in summary['counters']['gmail_api_requests_total']},
+            {(('method', 'messages.list'), ('status', '503')): 1, (('method', 'messages.list'), ('status', 'ok')): 1})
+        self.assertEqual(summary['histograms']['gmail_api_request_seconds'][0]['count'], 2)
+        METRICS.reset()
+
+    @patch('email_processor.service.batch_requests.time.sleep')
+    def test_fetch_batch_when_requests_fail_transiently(self, mock_sleep):
+        # Message 2 is rate limited once, message 3 was deleted
+        service, batches = self.build_service({'1': [200], '2': [429, 200], '3': [404]})
+        rate_limiter = TokenBucket(rate=1000, capacity=1000)
+
+        # Call the function
+        messages = BatchFetcher(service, rate_limiter=rate_limiter).fetch_batch(['1', '2', '3'])
+
+        # Assert that only the rate limited message was retried, after a backoff
+        self.assertEqual(sorted(message['id'] for message in messages), ['1', '2'])
+        self.assertEqual(len(batches), 2)
+        self.assertEqual(batches[1].add.call_count, 1)
+        mock_sleep.assert_called_once()
+        self.assertLess(rate_limiter.rate, rate_limiter.max_rate)
+
+    @patch('email_processor.service.batch_requests.time.sleep')
+    def test_fetch_batch_when_connection_fails(self, mock_sleep):
+        service, batches = self.build_service({'1': [], '2': [200]})
+        new_batch_http_request = service.new_batch_http_request.side_effect
+
+        def new_failing_batch_http_request(callback):
+            batch = new_batch_http_request(callback)
+            if len(batches) == 1:
+                def execute(http=None):
+                    # The connection is reset once the first message is received
+                    callback('1', {'id': '1'}, None)
+                    raise ConnectionResetError('Connection reset by peer')
+                batch.execute.side_effect = execute
+            return batch
+        service.new_batch_http_request.side_effect = new_failing_batch_http_request
+
+        # Call the function
+        messages = BatchFetcher(service, rate_limiter=TokenBucket(rate=1000, capacity=1000)).fetch_batch(['1', '2'])
+
+        # Assert that the messages not received were retried after a backoff
+        self.assertEqual([message['id'] for message in messages], ['1', '2'])
+        self.assertEqual([call.kwargs['request_id'] for call in batches[1].add.call_args_list], ['2'])
+        mock_sleep.assert_called_once()
+
+    @patch('email_processor.service.batch_requests.time.sleep')
+    def test_fetch_batch_when_retries_are_exhausted(self, mock_sleep):
+        service, _ = self.build_service({'1': [500] * 10})
+
+        # Call the function
+        with self.assertRaises(HttpError):
+            BatchFetcher(service, rate_limiter=TokenBucket(rate=1000, capacity=1000)).fetch_batch(['1'])
+
+    def test_token_bucket_when_tokens_are_exhausted(self):
+        rate_limiter = TokenBucket(rate=100, capacity=10)
+
+        # Drain the bucket, the next acquire has to wait for the refill
+        rate_limiter.acquire(10)
+        started_at = time.monotonic()
+        rate_limiter.acquire(5)
+
+        # Assert that 5 tokens took about 50ms to refill
+        self.assertGreaterEqual(time.monotonic() - started_at, 0.04)
+
+
+if __name__ == '__main__':
+    unittest.main()
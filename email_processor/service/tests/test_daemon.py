@@ -0,0 +1,115 @@
+import json
+import os
+import tempfile
+import threading
+import time
+import unittest
+from unittest.mock import MagicMock, patch
+from email_processor.service.daemon import EmailProcessorDaemon, FileNotificationSource, PubSubNotificationSource
+import email_processor.service.constants as constants
+
+
+class TestDaemon(unittest.TestCase):
+    def setUp(self):
+        file_descriptor, self.file_path = tempfile.mkstemp(suffix='.jsonl')
+        os.close(file_descriptor)
+
+    def tearDown(self):
+        os.remove(self.file_path)
+
+    def notify(self, *history_ids):
+        with open(self.file_path, 'a') as notification_file:
+            for history_id in history_ids:
+                notification_file.write(json.dumps({'emailAddress': 'test@example.com', 'historyId': history_id}) + '\n')
+
+    def test_file_notification_source_when_notifications_are_appended(self):
+        self.notify(1)
+        source = FileNotificationSource(self.file_path)
+        source.start(MagicMock(), 'me')
+
+        # Assert that notifications written before start are skipped
+        self.assertIsNone(source.get(timeout=0))
+
+        # Assert that complete lines only are read
+        self.notify(2)
+        with open(self.file_path, 'a') as notification_file:
+            notification_file.write('{"historyId": ')
+        self.assertEqual(source.get(timeout=0)['historyId'], 2)
+        self.assertIsNone(source.get(timeout=0))
+        with open(self.file_path, 'a') as notification_file:
+            notification_file.write('3}\n')
+        self.assertEqual(source.get(timeout=0)['historyId'], 3)
+        source.close()
+
+    def test_file_notification_source_when_line_is_malformed(self):
+        source = FileNotificationSource(self.file_path)
+        source.start(MagicMock(), 'me')
+        with open(self.file_path, 'a') as notification_file:
+            notification_file.write('{"historyId": 1\n')
+        self.notify(2)
+
+        # Assert that the malformed line is skipped
+        with self.assertLogs(level='ERROR'):
+            self.assertEqual(source.get(timeout=0)['historyId'], 2)
+        source.close()
+
+    def test_pubsub_notification_source_when_message_is_malformed(self):
+        source = PubSubNotificationSource('topic', 'subscription')
+        message = MagicMock(data=b'not json')
+
+        # Call the function
+        with self.assertLogs(level='ERROR'):
+            source._on_message(message)
+
+        # Assert that the message is acked without queuing a notification
+        message.ack.assert_called_once()
+        self.assertTrue(source.notifications.empty())
+
+    def test_pubsub_notification_source_when_watch_calls_fail(self):
+        source = PubSubNotificationSource('topic', 'subscription')
+        source.service, source.user_id = MagicMock(), 'me'
+        source.service.users().watch().execute.side_effect = [OSError('Connection reset'), {
+            'historyId': '2', 'expiration': '1700000000000'}]
+        source.service.users().stop().execute.side_effect = OSError('Connection reset')
+        source.notifications.put({'historyId': 1})
+        watched_at = source.watched_at = time.monotonic() - constants.GMAIL_WATCH_RENEW_INTERVAL_SECONDS - 1
+
+        # Assert that a failed renewal is logged, notifications are still returned and the next call renews
+        with self.assertLogs(level='ERROR'):
+            self.assertEqual(source.get(timeout=0)['historyId'], 1)
+        self.assertEqual(source.watched_at, watched_at)
+        self.assertIsNone(source.get(timeout=0))
+        self.assertGreater(source.watched_at, watched_at)
+
+        # Assert that a failed stop is logged instead of raised on close
+        with self.assertLogs(level='ERROR'):
+            source.close()
+
+    @patch('email_processor.service.daemon.fetch_and_process_emails')
+    @patch('email_processor.service.daemon.create_database')
+    def test_run_when_notifications_arrive(self, mock_create_database, mock_fetch_emails):
+        service = MagicMock()
+        mock_fetch_emails.side_effect = [0, 2]
+        daemon = EmailProcessorDaemon(FileNotificationSource(self.file_path), service)
+
+        # Run the daemon, it catches up once on start
+        thread = threading.Thread(target=daemon.run)
+        thread.start()
+        while mock_fetch_emails.call_count < 1:
+            time.sleep(0.01)
+
+        # Notify several changes at once
+        self.notify(10, 11, 12)
+        while mock_fetch_emails.call_count < 2:
+            time.sleep(0.01)
+        daemon.stop()
+        thread.join()
+
+        # Assert that the waiting notifications were covered by a single sync
+        self.assertEqual(mock_fetch_emails.call_count, 2)
+        mock_fetch_emails.assert_called_with(service, 'me')
+        mock_create_database.assert_called_once()
+
+
+if __name__ == '__main__':
+    unittest.main()
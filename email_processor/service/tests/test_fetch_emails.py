@@ -1,6 +1,7 @@
 import unittest
-from unittest.mock import MagicMock, Mock, patch
+from unittest.mock import MagicMock, Mock, call, patch
 from email_processor.service import fetch_emails
+from email_processor.service.batch_requests import TokenBucket
 from googleapiclient.errors import HttpError
 
 class TestFetchEmails(unittest.TestCase):
@@ -39,20 +40,44 @@ class TestFetchEmails(unittest.TestCase):
         ]
 
         # Call the function
-        messages = fetch_emails.list_messages(service)
+        with patch.object(fetch_emails.constants, 'MAX_EMAILS_TO_FETCH', 10):
+            pages = list(fetch_emails.list_messages(service))
 
         # Assert that the service.users().messages().list().execute() method was called twice
         self.assertEqual(service.users().messages().list().execute.call_count, 2)
 
-        # Assert that the returned messages are correct
-        self.assertEqual(messages, ['1', '2', '3', '4'])
+        # Assert that the returned pages of messages are correct
+        self.assertEqual(pages, [['1', '2'], ['3', '4']])
+
+    def test_list_messages_when_max_emails_are_listed(self):
+        # Mock the service object
+        service = MagicMock()
+        service.users().messages().list().execute.side_effect = [
+            {'messages': [{'id': '1'}, {'id': '2'}, {'id': '3'}], 'nextPageToken': 'token'},
+            {'messages': [{'id': '4'}, {'id': '5'}], 'nextPageToken': 'token'},
+        ]
+        service.users().messages().list.reset_mock()
+
+        # Call the function
+        with patch.object(fetch_emails.constants, 'MAX_EMAILS_TO_FETCH', 5):
+            pages = fetch_emails.list_messages(service, query='after:2024/03/08')
+
+            # Assert that nothing is listed before the first page is consumed
+            service.users().messages().list().execute.assert_not_called()
+            pages = list(pages)
+
+        # Assert that listing stopped at the maximum and requested only the remaining messages
+        self.assertEqual(pages, [['1', '2', '3'], ['4', '5']])
+        list_calls = [call for call in service.users().messages().list.call_args_list if call.kwargs]
+        self.assertEqual([call.kwargs['maxResults'] for call in list_calls], [5, 2])
+        self.assertEqual(list_calls[0].kwargs['q'], 'after:2024/03/08')
     
     def test_list_messages_when_messages_call_fails(self):
         # Mock the service object
         service = MagicMock()
         service.users().messages().list().execute.side_effect = HttpError(Mock(status=500), b'Internal Server Error')
         with self.assertRaises(HttpError):
-            fetch_emails.list_messages(service)
+            list(fetch_emails.list_messages(service))
         
         # Assert that the service.users().getProfile().execute() method was called
         service.users().messages().list().execute.assert_called_once()
@@ -63,36 +88,202 @@ class TestFetchEmails(unittest.TestCase):
         service.users().messages().list().execute.return_value = {}
 
         # Call the function
-        messages = fetch_emails.list_messages(service)
+        pages = list(fetch_emails.list_messages(service))
 
         # Assert that the service.users().messages().list().execute() method was called
         service.users().messages().list().execute.assert_called_once()
 
         # Assert that the returned messages are correct
-        self.assertEqual(messages, [])
+        self.assertEqual(pages, [])
+
+    @patch('email_processor.service.fetch_emails.apply_email_label_changes')
+    def test_list_calls_when_quota_is_shared(self, mock_apply_email_label_changes):
+        # Mock the service object
+        service = MagicMock()
+        service.users().getProfile().execute.return_value = {'emailAddress': 'test@example.com'}
+        service.users().messages().list().execute.side_effect = [
+            {'messages': [{'id': '1'}], 'nextPageToken': 'token'},
+            {'messages': [{'id': '2'}]}
+        ]
+        service.users().history().list().execute.return_value = {'history': [], 'historyId': '2'}
+        rate_limiter = MagicMock()
+
+        # Call the functions with the service's rate limiter
+        with patch('email_processor.service.fetch_emails.get_rate_limiter', return_value=rate_limiter) as mock_get:
+            fetch_emails.get_user_email(service)
+            with patch.object(fetch_emails.constants, 'MAX_EMAILS_TO_FETCH', 10):
+                list(fetch_emails.list_messages(service))
+            fetch_emails.list_history(service, '1')
+
+        # Assert that every call took its quota units from the rate limiter of the service
+        mock_get.assert_called_with(service)
+        quota_units = fetch_emails.constants.GMAIL_QUOTA_UNITS
+        self.assertEqual(rate_limiter.acquire.call_args_list, [
+            call(quota_units['users.getProfile']),
+            call(quota_units['messages.list']),
+            call(quota_units['messages.list']),
+            call(quota_units['history.list']),
+        ])
+
+    @patch('email_processor.service.fetch_emails.apply_email_label_changes')
+    def test_list_history_when_messages_are_changed(self, mock_apply_email_label_changes):
+        # Mock the service object
+        service = MagicMock()
+        service.users().history().list().execute.side_effect = [
+            {
+                'history': [
+                    {'messagesAdded': [{'message': {'id': '1', 'labelIds': ['INBOX']}}]},
+                    {'messagesAdded': [{'message': {'id': '2', 'labelIds': ['SPAM']}}]},
+                    {'labelsAdded': [{'message': {'id': '3', 'labelIds': ['STARRED']}, 'labelIds': ['STARRED']}]},
+                    {'labelsAdded': [{'message': {'id': '4', 'labelIds': ['INBOX', 'Label_1']}, 'labelIds': ['Label_1']}]},
+                    {'labelsRemoved': [{'message': {'id': '4', 'labelIds': ['INBOX', 'Label_1']}, 'labelIds': ['UNREAD']}]},
+                    {'labelsAdded': [{'message': {'id': '5', 'labelIds': ['TRASH']}, 'labelIds': ['TRASH']}]},
+                ],
+                'historyId': '105',
+                'nextPageToken': 'token'
+            },
+            {
+                'history': [
+                    {'labelsRemoved': [{'message': {'id': '1', 'labelIds': []}, 'labelIds': ['INBOX']}]},
+                    {'labelsRemoved': [{'message': {'id': '6', 'labelIds': ['INBOX']}, 'labelIds': ['SPAM']}]},
+                    {'messagesDeleted': [{'message': {'id': '3'}}]},
+                ],
+                'historyId': '110'
+            }
+        ]
+
+        # Call the function
+        message_ids, history_id = fetch_emails.list_history(service, '100')
+
+        # Assert that the history was paginated
+        self.assertEqual(service.users().history().list().execute.call_count, 2)
+
+        # Assert that only added and restored messages are fetched, spam, deleted and duplicate ones dropped
+        self.assertEqual(message_ids, ['1', '6'])
+        self.assertEqual(history_id, '110')
+
+        # Assert that label changes were applied without fetching, leaving out trashed and fetched messages
+        self.assertEqual(mock_apply_email_label_changes.call_args_list, [
+            call({'3': ({'STARRED'}, set()), '4': ({'Label_1'}, {'UNREAD'})}),
+            call({}),
+        ])
+
+    @patch('email_processor.service.fetch_emails.list_messages')
+    @patch('email_processor.service.fetch_emails.get_history_id')
+    def test_get_changed_message_ids_when_history_has_expired(self, mock_get_history_id, mock_list_messages):
+        # Mock the service object
+        service = MagicMock()
+        mock_get_history_id.return_value = '100'
+        mock_list_messages.return_value = iter([['1'], ['2']])
+        service.users().history().list().execute.side_effect = HttpError(Mock(status=404), b'Not Found')
+
+        # Call the function
+        message_ids, history_id = fetch_emails.get_changed_message_ids(service, 'test@example.com', '200')
+
+        # Assert that a full sync was performed from the current history ID
+        mock_list_messages.assert_called_once()
+        self.assertEqual(list(message_ids), ['1', '2'])
+        self.assertEqual(history_id, '200')
+
+    @patch('email_processor.service.fetch_emails.list_messages')
+    @patch('email_processor.service.fetch_emails.get_history_id')
+    def test_get_changed_message_ids_when_history_is_saved(self, mock_get_history_id, mock_list_messages):
+        # Mock the service object
+        service = MagicMock()
+        mock_get_history_id.return_value = '100'
+        service.users().history().list().execute.return_value = {
+            'history': [{'messagesAdded': [{'message': {'id': '7', 'labelIds': ['INBOX']}}]}],
+            'historyId': '120'
+        }
+
+        # Call the function
+        message_ids, history_id = fetch_emails.get_changed_message_ids(service, 'test@example.com', '200')
+
+        # Assert that messages were not listed again
+        mock_list_messages.assert_not_called()
+        self.assertEqual(message_ids, ['7'])
+        self.assertEqual(history_id, '120')
+
+    def test_get_messages_when_batches_are_fetched(self):
+        # Mock the service object, answering each batch request through its callback
+        service = MagicMock()
+        batches = []
+
+        def new_batch_http_request(callback):
+            batch = MagicMock()
+            batch.execute.side_effect = lambda http=None: [
+                callback(call.kwargs['request_id'], {'id': call.kwargs['request_id']}, None)
+                for call in batch.add.call_args_list
+            ]
+            batches.append(batch)
+            return batch
+
+        service.new_batch_http_request.side_effect = new_batch_http_request
+
+        # Call the function
+        message_ids = [str(i) for i in range(120)]
+        fetched = fetch_emails.get_messages(
+            service, message_ids, rate_limiter=TokenBucket(rate=10000, capacity=10000))
+
+        # Assert that nothing is requested before the first batch is consumed
+        self.assertEqual(len(batches), 0)
+
+        # Assert that one batch is yielded per 50 messages
+        self.assertEqual(sorted(len(messages) for messages in fetched), [20, 50, 50])
+
+    @patch('email_processor.service.fetch_emails.upsert_emails')
+    @patch('email_processor.service.fetch_emails.get_messages')
+    def test_hydrate_email_bodies_when_bodies_are_missing(self, mock_get_messages, mock_upsert_emails):
+        mock_get_messages.return_value = iter([[{'id': '1', 'snippet': 'Hello', 'payload': {'headers': [], 'parts': [
+            {'mimeType': 'Application/PDF', 'filename': 'invoice.pdf', 'body': {'attachmentId': 'a1', 'size': 2048}},
+        ]}}]])
+
+        # Call the function
+        fetch_emails.hydrate_email_bodies(MagicMock(), ['1'])
+
+        # Assert that full messages were fetched and only the bodies and attachment metadata were stored
+        self.assertEqual(mock_get_messages.call_args.kwargs['message_format'], 'full')
+        mock_upsert_emails.assert_called_once_with([{
+            'message_id': '1',
+            'body': 'Hello',
+            'attachments': [{'filename': 'invoice.pdf', 'mime_type': 'application/pdf', 'size': 2048}]
+        }])
+
+    def test_parse_emails_when_fetched_as_metadata(self):
+        messages = [{'id': '1', 'snippet': 'Hello', 'payload': {'headers': [
+            {'name': 'From', 'value': 'Sender <sender@example.com>'},
+            {'name': 'Subject', 'value': 'Invoice'},
+            {'name': 'Date', 'value': 'Fri, 08 Mar 2024 10:00:00 +0000'},
+        ]}}]
+
+        # Call the function
+        email_messages = fetch_emails.parse_emails(messages, 'test@example.com', include_body=False)
+
+        # Assert that the body is left to be fetched on demand
+        self.assertEqual(email_messages[0]['subject'], 'Invoice')
+        self.assertNotIn('body', email_messages[0])
     
     def test_process_email_body_when_body_is_fetched(self):
-        # Mock the message_body_parts
-        message_body_parts = [
+        # Mock the message with its body parts
+        message = {'snippet': 'This is a test', 'payload': {'mimeType': 'multipart/mixed', 'parts': [
             {'mimeType': 'text/plain', 'body': {'data': 'VGhpcyBpcyBhIHRlc3QgYm9keSB0byBkYXRhCg=='}}
-        ]
+        ]}}
 
         # Call the function
-        body = fetch_emails.process_email_body(message_body_parts)
+        body = fetch_emails.process_email_body(message)
 
         # Assert that the returned body is correct
         self.assertEqual(body, 'This is a test body to data ')
 
     def test_process_email_body_when_body_is_not_fetched(self):
-        # Mock the message_body_parts
-        message_body_parts = []
+        # Mock the message without text parts
+        message = {'snippet': '', 'payload': {'mimeType': 'multipart/mixed', 'parts': []}}
 
         # Call the function
-        body = fetch_emails.process_email_body(message_body_parts)
+        body = fetch_emails.process_email_body(message)
 
         # Assert that the returned body is correct
         self.assertEqual(body, '')
 
-
 if __name__ == '__main__':
     unittest.main()
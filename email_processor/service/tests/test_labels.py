@@ -0,0 +1,90 @@
+import unittest
+from unittest.mock import MagicMock, patch
+from email_processor.service.labels import LabelDirectory, get_label_directory
+
+
+@patch('email_processor.service.labels.save_labels')
+@patch('email_processor.service.labels.get_cached_labels')
+class TestLabels(unittest.TestCase):
+    def build_service(self, labels):
+        service = MagicMock()
+        service.users().labels().list().execute.return_value = {
+            'labels': [{'id': label_id, 'name': name} for name, label_id in labels.items()]
+        }
+        service.users().labels().list.reset_mock()
+        return service
+
+    def test_get_label_id_when_labels_are_cached(self, mock_get_cached_labels, mock_save_labels):
+        service = self.build_service({})
+        mock_get_cached_labels.return_value = {'Invoices': 'Label_1'}
+
+        # Call the function
+        label_id = LabelDirectory(service).get_label_id('Invoices')
+
+        # Assert that the label was resolved without any API call
+        self.assertEqual(label_id, 'Label_1')
+        service.users().labels().list.assert_not_called()
+
+    def test_get_label_id_when_cached_labels_miss(self, mock_get_cached_labels, mock_save_labels):
+        service = self.build_service({'Invoices': 'Label_1', 'Receipts': 'Label_2'})
+        mock_get_cached_labels.return_value = {'Invoices': 'Label_1'}
+        directory = LabelDirectory(service)
+
+        # Call the function for a new label, then for an unknown one
+        self.assertEqual(directory.get_label_id('Receipts'), 'Label_2')
+        self.assertIsNone(directory.get_label_id('Unknown'))
+
+        # Assert that the labels were reloaded and saved only once
+        service.users().labels().list.assert_called_once()
+        mock_save_labels.assert_called_once_with({'Invoices': 'Label_1', 'Receipts': 'Label_2'})
+
+    @patch('email_processor.service.labels.time.monotonic')
+    def test_get_label_id_when_labels_expire(self, mock_monotonic, mock_get_cached_labels, mock_save_labels):
+        service = self.build_service({'Invoices': 'Label_1'})
+        mock_get_cached_labels.side_effect = [{'Invoices': 'Label_1'}, None]
+        directory = LabelDirectory(service, ttl_seconds=3600, miss_reload_interval_seconds=60)
+        list_labels = service.users().labels().list
+
+        # Miss a label twice within the reload interval
+        mock_monotonic.return_value = 0
+        self.assertIsNone(directory.get_label_id('Archive'))
+        mock_monotonic.return_value = 30
+        self.assertIsNone(directory.get_label_id('Archive'))
+        self.assertEqual(list_labels.call_count, 1)
+
+        # Assert that a label created later is found once the interval has passed
+        list_labels().execute.return_value = {
+            'labels': [{'id': 'Label_1', 'name': 'Invoices'}, {'id': 'Label_3', 'name': 'Archive'}]}
+        mock_monotonic.return_value = 90
+        self.assertEqual(directory.get_label_id('Archive'), 'Label_3')
+
+        # Assert that the labels are loaded again once expired, even without a miss
+        list_labels().execute.return_value = {'labels': [{'id': 'Label_4', 'name': 'Invoices'}]}
+        mock_monotonic.return_value = 90 + 3600
+        self.assertEqual(directory.get_label_id('Invoices'), 'Label_4')
+
+    def test_get_label_id_when_label_is_missing(self, mock_get_cached_labels, mock_save_labels):
+        service = self.build_service({'Invoices': 'Label_1'})
+        service.users().labels().create().execute.return_value = {'id': 'Label_3', 'name': 'Archive'}
+        mock_get_cached_labels.return_value = None
+
+        # Call the function
+        label_id = LabelDirectory(service, create_missing=True).get_label_id('Archive')
+
+        # Assert that the missing label was created
+        self.assertEqual(label_id, 'Label_3')
+
+    def test_get_label_directory_when_service_is_reused(self, mock_get_cached_labels, mock_save_labels):
+        service = self.build_service({'Invoices': 'Label_1'})
+        mock_get_cached_labels.return_value = None
+
+        # Resolve labels for many rules with the same service
+        for _ in range(200):
+            get_label_directory(service).get_label_id('Invoices')
+
+        # Assert that a single API call was made
+        service.users().labels().list.assert_called_once()
+
+
+if __name__ == '__main__':
+    unittest.main()
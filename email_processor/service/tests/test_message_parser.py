@@ -0,0 +1,129 @@
+import base64
+import re
+import unittest
+from datetime import datetime, timedelta, timezone
+from unittest.mock import patch
+from email_processor.service import message_parser
+
+
+def encode(text, charset='utf-8'):
+    return base64.urlsafe_b64encode(text.encode(charset)).decode('ascii').rstrip('=')
+
+
+def text_part(mime_type, text, charset=None):
+    part = {'mimeType': mime_type, 'body': {'data': encode(text, charset or 'utf-8')}}
+    if charset:
+        part['headers'] = [{'name': 'Content-Type', 'value': f'{mime_type}; charset="{charset}"'}]
+    return part
+
+
+class TestMessageParser(unittest.TestCase):
+    def test_parse_headers(self):
+        headers = [
+            {'name': 'From', 'value': 'Sender <sender@example.com>'},
+            {'name': 'Received', 'value': 'by mx.example.com'},
+            {'name': 'SUBJECT', 'value': 'Invoice'},
+            {'name': 'From', 'value': 'Other <other@example.com>'},
+        ]
+
+        # Call the function
+        values = message_parser.parse_headers(headers)
+
+        # Assert that the wanted headers were collected, missing ones left out
+        self.assertEqual(values, {
+            'From': 'Sender <sender@example.com>, Other <other@example.com>',
+            'Subject': 'Invoice',
+        })
+
+    def test_parse_date(self):
+        self.assertEqual(
+            message_parser.parse_date('Fri, 08 Mar 2024 10:00:00 +0100'),
+            datetime(2024, 3, 8, 10, tzinfo=timezone(timedelta(hours=1))))
+
+        # Assert that missing and invalid dates don't raise
+        self.assertIsNone(message_parser.parse_date(None))
+        self.assertIsNone(message_parser.parse_date('not a date'))
+
+    def test_extract_body_when_parts_are_nested(self):
+        message = {'snippet': 'Snippet', 'payload': {'mimeType': 'multipart/mixed', 'parts': [
+            {'mimeType': 'multipart/alternative', 'parts': [
+                text_part('text/plain', 'Hello\r\n\r\n  world'),
+                text_part('text/html', '<p>Hello world</p>'),
+            ]},
+            {'mimeType': 'multipart/related', 'parts': [text_part('text/plain', 'Café', charset='iso-8859-1')]},
+            {'mimeType': 'application/pdf', 'filename': 'invoice.pdf', 'body': {'attachmentId': 'A1'}},
+        ]}}
+
+        # Call the function
+        body = message_parser.extract_body(message)
+
+        # Assert that the text parts were found at any depth, in order, with their charset
+        self.assertEqual(body, 'Hello world, Café')
+
+    def test_extract_attachments(self):
+        message = {'payload': {'mimeType': 'multipart/mixed', 'parts': [
+            text_part('text/plain', 'See attached'),
+            {'mimeType': 'multipart/related', 'parts': [
+                {'mimeType': 'IMAGE/PNG', 'filename': '', 'body': {'attachmentId': 'A1', 'size': 2048}},
+            ]},
+            {'mimeType': 'application/pdf', 'filename': 'invoice.pdf', 'body': {'attachmentId': 'A2', 'size': 120000}},
+        ]}}
+
+        # Call the function
+        attachments = message_parser.extract_attachments(message)
+
+        # Assert that the attachments were found at any depth, text parts left out
+        self.assertEqual(attachments, [
+            {'filename': None, 'mime_type': 'image/png', 'size': 2048},
+            {'filename': 'invoice.pdf', 'mime_type': 'application/pdf', 'size': 120000},
+        ])
+
+    def test_extract_body_when_text_files_are_attached(self):
+        attached_file = dict(text_part('text/plain', 'Attached notes'), filename='notes.txt')
+        attached_inline = dict(text_part('text/plain', 'Attached log'), headers=[
+            {'name': 'Content-Disposition', 'value': 'Attachment; filename="log"'}])
+        message = {'snippet': 'Snippet', 'payload': {'mimeType': 'multipart/mixed', 'parts': [
+            text_part('text/plain', 'See attached'), attached_file, attached_inline]}}
+
+        # Call the functions
+        body = message_parser.extract_body(message)
+        attachments = message_parser.extract_attachments(message)
+
+        # Assert that attached text files are attachments only, left out of the body
+        self.assertEqual(body, 'See attached')
+        self.assertEqual([attachment['filename'] for attachment in attachments], ['notes.txt', None])
+
+    def test_extract_body_when_message_is_single_part(self):
+        message = {'snippet': 'Snippet', 'payload': text_part('text/plain', 'Whole body')}
+        self.assertEqual(message_parser.extract_body(message), 'Whole body')
+
+    def test_extract_body_when_there_is_only_html(self):
+        message = {'snippet': 'Snippet', 'payload': {'mimeType': 'multipart/alternative', 'parts': [
+            text_part('text/html', '<html><head><style>p {}</style></head><body><p>Hi&amp;\n bye</p></body></html>'),
+        ]}}
+
+        # Assert that HTML is converted to text when enabled, else the snippet is used
+        self.assertEqual(message_parser.extract_body(message, convert_html=True), 'Hi& bye')
+        self.assertEqual(message_parser.extract_body(message, convert_html=False), 'Snippet')
+
+    @patch('email_processor.service.message_parser._DECODE_CHUNK_SIZE', 8)
+    def test_decode_part_when_data_spans_several_chunks(self):
+        text = 'Ünïcode   text \n\n spanning   several chunks ' * 3
+
+        # Assert that chunked decoding gives the same text as decoding at once
+        expected = re.sub(r'\s+', ' ', text)
+        self.assertEqual(message_parser.decode_part(encode(text), max_length=len(text)), expected)
+        self.assertEqual(message_parser.decode_part(encode(text), max_length=20), expected[:20])
+
+    def test_extract_body_when_body_is_large(self):
+        message = {'snippet': 'Snippet', 'payload': {'mimeType': 'multipart/mixed', 'parts': [
+            text_part('text/plain', 'a' * 1000), text_part('text/plain', 'b' * 1000),
+        ]}}
+
+        # Assert that the body is capped
+        self.assertEqual(message_parser.extract_body(message, max_length=1500), 'a' * 1000 + ', ' + 'b' * 498)
+        self.assertEqual(message_parser.extract_body(message, max_length=10), 'a' * 10)
+
+
+if __name__ == '__main__':
+    unittest.main()
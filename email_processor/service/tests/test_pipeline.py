@@ -0,0 +1,62 @@
+import contextvars
+import threading
+import unittest
+from email_processor.service.pipeline import run_pipeline
+
+
+class TestPipeline(unittest.TestCase):
+    def test_run_pipeline_when_all_stages_succeed(self):
+        stored = []
+
+        # Call the function
+        run_pipeline(range(10), [lambda item: item * 2, stored.append], queue_size=2)
+
+        # Assert that every item went through every stage in order
+        self.assertEqual(stored, [item * 2 for item in range(10)])
+
+    def test_run_pipeline_when_context_is_set(self):
+        account = contextvars.ContextVar('account')
+        account.set('alice')
+        stored = []
+
+        # Call the function
+        run_pipeline(range(2), [lambda item: (item, account.get()), stored.append])
+
+        # Assert that the stages run in the caller's context
+        self.assertEqual(stored, [(0, 'alice'), (1, 'alice')])
+
+    def test_run_pipeline_when_a_stage_fails(self):
+        def failing_stage(item):
+            if item == 3:
+                raise ValueError('Cannot parse item')
+            return item
+
+        # Call the function
+        with self.assertRaises(ValueError):
+            run_pipeline(range(10), [failing_stage, lambda item: item])
+
+    def test_run_pipeline_when_sink_is_slow(self):
+        produced, release = [], threading.Event()
+
+        def source():
+            for item in range(100):
+                produced.append(item)
+                yield item
+
+        def slow_sink(item):
+            release.wait()
+
+        # Run the pipeline while the sink is blocked
+        thread = threading.Thread(target=run_pipeline, args=(source(), [slow_sink]), kwargs={'queue_size': 2})
+        thread.start()
+        thread.join(timeout=0.5)
+
+        # Assert that the source was not read ahead of the bounded queue
+        self.assertLessEqual(len(produced), 4)
+        release.set()
+        thread.join()
+        self.assertEqual(len(produced), 100)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,18 +1,25 @@
+import json
+import tempfile
 import unittest
 from unittest.mock import MagicMock, Mock, patch
 
 from googleapiclient.errors import HttpError
 from email_processor.models.rules import Rule
 from email_processor.service.process_rules import (
+    apply_rule_matches,
+    fetch_and_process_emails,
     get_label_id,
     perform_rule_actions,
     process_emails_for_rule_actions,
+    read_rules_from_json,
 )
 
 
 class TestProcessRules(unittest.TestCase):
 
-    def test_get_label_id(self):
+    @patch('email_processor.service.labels.save_labels')
+    @patch('email_processor.service.labels.get_cached_labels', return_value=None)
+    def test_get_label_id(self, mock_get_cached_labels, mock_save_labels):
         # Mock the service object
         service = MagicMock()
         service.users().labels().list().execute.return_value = {
@@ -31,8 +38,9 @@ class TestProcessRules(unittest.TestCase):
         # Assert that the returned label_id is correct
         self.assertEqual(label_id, 'label2')
 
+    @patch('email_processor.service.process_rules.update_email_labels')
     @patch('email_processor.service.process_rules.get_label_id')
-    def test_perform_rule_actions_on_success(self, mock_get_label_id):
+    def test_perform_rule_actions_on_success(self, mock_get_label_id, mock_update_email_labels):
         # Mock the service object
         service = MagicMock()
         mock_get_label_id.return_value = 'label2'
@@ -61,7 +69,220 @@ class TestProcessRules(unittest.TestCase):
         }
         rule = Rule.from_dict(rule)
         perform_rule_actions(service, ['1', '2'], rule, 'me')
-    
+
+        # Assert that the stored labels follow the modification
+        mock_update_email_labels.assert_called_once_with(['1', '2'], ['UNREAD', 'label2'], [])
+
+    def build_rule(self, actions, priority=0, stop_processing=False):
+        return Rule.from_dict({
+            "collection_predicate": "All",
+            "conditions": [{"field": "subject", "predicate": "contains", "value": "Invoice"}],
+            "actions": actions,
+            "priority": priority,
+            "stop_processing": stop_processing
+        })
+
+    def test_read_rules_from_json_when_rule_set_is_a_list(self):
+        rules_data = [
+            {"collection_predicate": "All", "conditions": [], "actions": {"mark_as_read": True}, "priority": 2},
+            {"collection_predicate": "Any", "conditions": [], "actions": {"mark_as_read": False}, "priority": 1},
+        ]
+        with tempfile.NamedTemporaryFile('w', suffix='.json') as rules_file:
+            json.dump(rules_data, rules_file)
+            rules_file.flush()
+
+            # Call the function
+            rules = read_rules_from_json(rules_file.name)
+
+        # Assert that the rules are sorted by priority
+        self.assertEqual([rule.priority for rule in rules], [1, 2])
+
+    def apply_matches(self, rules, label_changes, matches):
+        """Apply the matches of the rules, returning the batch modifications journaled and applied."""
+        applied_actions = []
+        with patch('email_processor.service.process_rules.get_label_changes', side_effect=label_changes), \
+                patch('email_processor.service.actions.enqueue_label_actions', return_value=[1]), \
+                patch('email_processor.service.process_rules.apply_label_actions', side_effect=(
+                    lambda service, actions, user_id: applied_actions.extend(actions))):
+            apply_rule_matches(MagicMock(), rules, iter(matches))
+        return [(email_ids, add_label_ids, remove_label_ids) for _, email_ids, add_label_ids, remove_label_ids in applied_actions]
+
+    def test_apply_rule_matches_when_rules_overlap(self):
+        rules = [
+            self.build_rule({"mark_as_read": True}, priority=1),
+            self.build_rule({"move_to_folder": "Invoices"}, priority=2, stop_processing=True),
+            self.build_rule({"mark_as_read": False}, priority=3),
+        ]
+        label_changes = [([], ['UNREAD']), (['Label_1'], []), (['UNREAD'], [])]
+        matches = [('1', None, [0, 1, 2]), ('2', None, [2]), ('3', None, [0, 1]), ('4', None, [1, 2])]
+
+        # Call the function
+        actions = self.apply_matches(rules, label_changes, matches)
+
+        # Assert that emails with the same merged changes share a batch modification
+        self.assertEqual(actions, [
+            (['1', '3'], ['Label_1'], ['UNREAD']),
+            (['2'], ['UNREAD'], []),
+            (['4'], ['Label_1'], []),
+        ])
+
+    def test_apply_rule_matches_when_labels_are_already_applied(self):
+        rules = [self.build_rule({"mark_as_read": True, "move_to_folder": "Invoices"})]
+        label_changes = [(['Label_1'], ['UNREAD'])]
+        matches = [('1', 'INBOX,Label_1', [0]), ('2', 'INBOX,UNREAD', [0]), ('3', 'INBOX,Label_1,UNREAD', [0])]
+
+        # Call the function
+        actions = self.apply_matches(rules, label_changes, matches)
+
+        # Assert that only the missing changes are applied
+        self.assertEqual(actions, [
+            (['2'], ['Label_1'], ['UNREAD']),
+            (['3'], [], ['UNREAD']),
+        ])
+
+    @patch('email_processor.service.process_rules.get_dialect_name', return_value='sqlite')
+    @patch('email_processor.service.actions.enqueue_label_actions', return_value=[7])
+    @patch('email_processor.service.process_rules.apply_label_actions')
+    @patch('email_processor.service.process_rules.drain_label_actions')
+    @patch('email_processor.service.process_rules.prune_label_actions')
+    @patch('email_processor.service.process_rules.get_stored_rule_matches', return_value=[('3', 'INBOX', [0])])
+    @patch('email_processor.service.process_rules.get_label_changes', return_value=([], ['UNREAD']))
+    @patch('email_processor.service.process_rules.fetch_emails')
+    @patch('email_processor.service.process_rules.get_rules')
+    def test_fetch_and_process_emails_when_emails_are_fetched(
+        self, mock_get_rules, mock_fetch_emails, mock_get_label_changes, mock_get_stored_rule_matches,
+        mock_prune_label_actions, mock_drain_label_actions, mock_apply_label_actions, mock_enqueue_label_actions,
+        mock_get_dialect_name
+    ):
+        service = MagicMock()
+        mock_get_rules.return_value = [Rule('Any', [
+            {'field': 'subject', 'predicate': 'contains', 'value': 'invoice'},
+            {'field': 'body', 'predicate': 'contains', 'value': 'due'},
+        ], {'mark_as_read': True})]
+
+        def fetch_emails(service, user_id, on_emails_parsed, on_emails_stored):
+            # Emails are fetched in metadata format, without bodies, and stored batch by batch
+            for batch in [
+                [
+                    {'message_id': '1', 'subject': 'Invoice', 'label_ids': 'INBOX,UNREAD'},
+                    {'message_id': '2', 'subject': 'Invoice', 'label_ids': 'INBOX'},
+                ],
+                [{'message_id': '3', 'subject': 'Digest', 'label_ids': 'INBOX,UNREAD'}],
+            ]:
+                on_emails_parsed(batch)
+                on_emails_stored(batch)
+            return 3
+        mock_fetch_emails.side_effect = fetch_emails
+        applied_actions = []
+        mock_apply_label_actions.side_effect = lambda service, actions, user_id: applied_actions.extend(actions)
+
+        # Call the function
+        fetched_count = fetch_and_process_emails(service)
+
+        # Assert that only the email the fetched fields can't decide is evaluated on the database
+        self.assertEqual(fetched_count, 3)
+        mock_get_stored_rule_matches.assert_called_once_with(service, mock_get_rules.return_value, ['3'], 'me')
+
+        # Assert that the actions are planned from the fetched labels, and journaled before they are applied
+        mock_enqueue_label_actions.assert_called_once_with([(['1'], [], ['UNREAD'])])
+        self.assertEqual(applied_actions, [(7, ['1'], [], ['UNREAD'])])
+        mock_drain_label_actions.assert_called_once()
+
+    @patch('email_processor.service.process_rules.get_dialect_name', return_value='postgresql')
+    @patch('email_processor.service.process_rules.apply_rule_matches')
+    @patch('email_processor.service.process_rules.drain_label_actions')
+    @patch('email_processor.service.process_rules.prune_label_actions')
+    @patch('email_processor.service.process_rules.get_stored_rule_matches', return_value=[('1', 'INBOX', [0])])
+    @patch('email_processor.service.process_rules.fetch_emails')
+    @patch('email_processor.service.process_rules.get_rules')
+    def test_fetch_and_process_emails_when_database_is_postgresql(
+        self, mock_get_rules, mock_fetch_emails, mock_get_stored_rule_matches, mock_prune_label_actions,
+        mock_drain_label_actions, mock_apply_rule_matches, mock_get_dialect_name
+    ):
+        service = MagicMock()
+        mock_get_rules.return_value = [Rule('All', [
+            {'field': 'subject', 'predicate': 'contains', 'value': 'résumé'}], {'mark_as_read': True})]
+        applied_matches = []
+        mock_apply_rule_matches.side_effect = lambda service, rules, matches, user_id: applied_matches.extend(matches)
+
+        def fetch_emails(service, user_id, on_emails_parsed, on_emails_stored):
+            # Assert that the emails are not evaluated in process
+            self.assertIsNone(on_emails_parsed)
+            on_emails_stored([
+                {'message_id': '1', 'subject': 'RÉSUMÉ', 'label_ids': 'INBOX'},
+                {'message_id': '2', 'subject': 'Digest', 'label_ids': 'INBOX'},
+            ])
+            return 2
+        mock_fetch_emails.side_effect = fetch_emails
+
+        # Call the function
+        self.assertEqual(fetch_and_process_emails(service), 2)
+
+        # Assert that every stored email was evaluated on the database, which folds Unicode case
+        mock_get_stored_rule_matches.assert_called_once_with(service, mock_get_rules.return_value, ['1', '2'], 'me')
+        self.assertEqual(applied_matches, [('1', 'INBOX', [0])])
+
+    @patch('email_processor.service.process_rules.get_dialect_name', return_value='sqlite')
+    @patch('email_processor.service.process_rules.MODIFY_EMAILS_BATCH_SIZE', 1)
+    @patch('email_processor.service.process_rules.apply_rule_matches')
+    @patch('email_processor.service.process_rules.drain_label_actions')
+    @patch('email_processor.service.process_rules.prune_label_actions')
+    @patch('email_processor.service.process_rules.fetch_emails')
+    @patch('email_processor.service.process_rules.get_rules')
+    def test_fetch_and_process_emails_when_batches_are_stored(
+        self, mock_get_rules, mock_fetch_emails, mock_prune_label_actions, mock_drain_label_actions,
+        mock_apply_rule_matches, mock_get_dialect_name
+    ):
+        service, events = MagicMock(), []
+        mock_get_rules.return_value = [Rule('All', [
+            {'field': 'subject', 'predicate': 'contains', 'value': 'invoice'}], {'mark_as_read': True})]
+        mock_apply_rule_matches.side_effect = lambda service, rules, matches, user_id: events.append(
+            ('applied', [email_id for email_id, _, _ in matches]))
+
+        def fetch_emails(service, user_id, on_emails_parsed, on_emails_stored):
+            for message_id in ['1', '2']:
+                batch = [{'message_id': message_id, 'subject': 'Invoice', 'label_ids': 'INBOX,UNREAD'}]
+                on_emails_parsed(batch)
+                events.append(('stored', message_id))
+                on_emails_stored(batch)
+            return 2
+        mock_fetch_emails.side_effect = fetch_emails
+
+        # Call the function
+        self.assertEqual(fetch_and_process_emails(service), 2)
+
+        # Assert that the matches of each batch were applied once stored, before the next batch
+        self.assertEqual(events, [('stored', '1'), ('applied', ['1']), ('stored', '2'), ('applied', ['2'])])
+
+    @patch('email_processor.service.process_rules.apply_rule_matches')
+    @patch('email_processor.service.process_rules.drain_label_actions')
+    @patch('email_processor.service.process_rules.prune_label_actions')
+    @patch('email_processor.service.process_rules.get_stored_rule_matches')
+    @patch('email_processor.service.process_rules.iter_cached_rule_matches', return_value=iter([('1', 'INBOX', [0])]))
+    @patch('email_processor.service.process_rules.refresh_rule_matches')
+    @patch('email_processor.service.process_rules.get_unhydrated_email_ids', return_value=[])
+    @patch('email_processor.service.process_rules.get_rule_watermarks')
+    @patch('email_processor.service.process_rules.get_rules')
+    def test_process_emails_for_rule_actions_when_all_emails_are_processed(
+        self, mock_get_rules, mock_get_rule_watermarks, mock_get_unhydrated_email_ids, mock_refresh_rule_matches,
+        mock_iter_cached_rule_matches, mock_get_stored_rule_matches, mock_prune_label_actions,
+        mock_drain_label_actions, mock_apply_rule_matches
+    ):
+        service = MagicMock()
+        rule = Rule('All', [{'field': 'body', 'predicate': 'contains', 'value': 'due'}], {'mark_as_read': True})
+        mock_get_rules.return_value = [rule]
+        mock_get_rule_watermarks.return_value = {rule.get_definition_hash(): 120}
+
+        # Call the function
+        process_emails_for_rule_actions(service)
+
+        # Assert that only the emails after the watermark are hydrated, and the matches come from the cache
+        mock_get_unhydrated_email_ids.assert_called_once_with(rule, None, 120)
+        mock_refresh_rule_matches.assert_called_once_with([rule])
+        mock_get_stored_rule_matches.assert_not_called()
+        mock_apply_rule_matches.assert_called_once_with(
+            service, [rule], mock_iter_cached_rule_matches.return_value, 'me')
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,78 @@
+import json
+import os
+import tempfile
+import unittest
+from unittest.mock import patch
+from email_processor.service.rule_cache import RuleCache
+
+
+class TestRuleCache(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.file_path = os.path.join(self.directory.name, 'rules.json')
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def write_rules(self, subject, mtime_ns):
+        with open(self.file_path, 'w') as rules_file:
+            json.dump([{
+                'collection_predicate': 'All',
+                'conditions': [
+                    {'field': 'subject', 'predicate': 'contains', 'value': subject},
+                    {'field': 'received_date', 'predicate': 'gt', 'value': '08-03-2024'},
+                ],
+                'actions': {'mark_as_read': True}
+            }], rules_file)
+        os.utime(self.file_path, ns=(mtime_ns, mtime_ns))
+
+    def test_get_rules_when_file_is_unchanged(self):
+        self.write_rules('Invoice', 1_000_000_000)
+        rule_cache = RuleCache(self.file_path)
+
+        # Call the function twice
+        rules = rule_cache.get_rules()
+        with patch.object(rule_cache, 'reload') as mock_reload:
+            self.assertIs(rule_cache.get_rules(), rules)
+
+        # Assert that the file was not read again, and the dates were parsed once
+        mock_reload.assert_not_called()
+        self.assertEqual(rules[0].condition_values[1].year, 2024)
+
+    def test_get_rules_when_file_changes(self):
+        self.write_rules('Invoice', 1_000_000_000)
+        rule_cache = RuleCache(self.file_path)
+        self.assertEqual(rule_cache.get_rules()[0].conditions[0]['value'], 'Invoice')
+
+        # Assert that the new rules are loaded without a restart
+        self.write_rules('Receipt', 2_000_000_000)
+        self.assertEqual(rule_cache.get_rules()[0].conditions[0]['value'], 'Receipt')
+
+        # Assert that invalid rules keep the rules loaded before in use
+        with open(self.file_path, 'w') as rules_file:
+            rules_file.write('[{"collection_predicate": "Some"')
+        self.assertEqual(rule_cache.get_rules()[0].conditions[0]['value'], 'Receipt')
+
+    def test_get_rules_when_rules_are_malformed(self):
+        self.write_rules('Invoice', 1_000_000_000)
+        rule_cache = RuleCache(self.file_path)
+        rule_cache.get_rules()
+
+        # Write rules of the wrong shape, raising TypeError when compiled
+        for rules_data in [{'collection_predicate': 'All', 'conditions': 5, 'actions': {}}, [5]]:
+            with open(self.file_path, 'w') as rules_file:
+                json.dump(rules_data, rules_file)
+
+            # Assert that the rules loaded before stay in use
+            with self.assertLogs(level='ERROR'):
+                self.assertEqual(rule_cache.get_rules()[0].conditions[0]['value'], 'Invoice')
+
+        # Assert that any other error raised while loading them keeps them in use too
+        self.write_rules('Receipt', 2_000_000_000)
+        with patch('email_processor.service.rule_cache.Rule.list_from_json', side_effect=AttributeError('get')):
+            with self.assertLogs(level='ERROR'):
+                self.assertEqual(rule_cache.get_rules()[0].conditions[0]['value'], 'Invoice')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,103 @@
+import json
+import os
+import pstats
+import tempfile
+import threading
+import unittest
+from email_processor.metrics import (
+    PROFILE_EACH_THREAD, SIZE_BUCKETS, MetricsRegistry, Profiler, instrumented_run, METRICS
+)
+
+
+def busy_worker():
+    return sum(range(1000))
+
+
+class TestMetrics(unittest.TestCase):
+    def test_to_prometheus(self):
+        metrics = MetricsRegistry()
+        metrics.increment('gmail_api_requests_total', method='messages.get', status='ok')
+        metrics.increment('gmail_api_requests_total', 2, status='ok', method='messages.get')
+        metrics.observe('gmail_batch_size', 50, SIZE_BUCKETS, method='messages.get')
+
+        text = metrics.to_prometheus()
+
+        # Assert that series with the same labels are merged, and histograms have cumulative buckets
+        self.assertIn('# TYPE email_processor_gmail_api_requests_total counter', text)
+        self.assertIn('email_processor_gmail_api_requests_total{method="messages.get",status="ok"} 3', text)
+        self.assertIn('email_processor_gmail_batch_size_bucket{method="messages.get",le="25"} 0', text)
+        self.assertIn('email_processor_gmail_batch_size_bucket{method="messages.get",le="50"} 1', text)
+        self.assertIn('email_processor_gmail_batch_size_bucket{method="messages.get",le="+Inf"} 1', text)
+        self.assertIn('email_processor_gmail_batch_size_sum{method="messages.get"} 50', text)
+        self.assertIn('email_processor_gmail_batch_size_count{method="messages.get"} 1', text)
+
+    def test_summary(self):
+        metrics = MetricsRegistry()
+        for value in [0.002] * 98 + [4, 6]:
+            metrics.observe('db_commit_seconds', value)
+
+        histogram = metrics.summary()['histograms']['db_commit_seconds'][0]
+
+        # Assert that quantiles are estimated within the bucket of the observed values
+        self.assertEqual(histogram['count'], 100)
+        self.assertEqual(histogram['max'], 6)
+        self.assertTrue(0.001 <= histogram['p50'] <= 0.0025)
+        self.assertTrue(2.5 <= histogram['p99'] <= 5)
+
+    def test_timer_when_block_raises(self):
+        metrics = MetricsRegistry()
+        with self.assertRaises(ValueError):
+            with metrics.timer('rule_query_seconds', rule='Newsletters'):
+                raise ValueError('Invalid rule')
+
+        # Assert that the duration of the failed block is observed
+        self.assertEqual(metrics.summary()['histograms']['rule_query_seconds'][0]['count'], 1)
+
+    def test_instrumented_run(self):
+        METRICS.reset()
+        with tempfile.TemporaryDirectory() as directory:
+            summary_path = os.path.join(directory, 'metrics.json')
+            prometheus_path = os.path.join(directory, 'metrics.prom')
+            profile_path = os.path.join(directory, 'run.prof')
+
+            with instrumented_run('fetch-emails', summary_path, prometheus_path, profile_path):
+                METRICS.increment('gmail_api_requests_total', method='messages.list', status='ok')
+                thread = threading.Thread(target=busy_worker)
+                thread.start()
+                thread.join()
+
+            # Assert that the reports are written, and the profile covers the threads started by the run
+            with open(summary_path) as file:
+                summary = json.load(file)
+            self.assertEqual(summary['run'], 'fetch-emails')
+            self.assertEqual(summary['counters']['gmail_api_requests_total'][0]['value'], 1)
+            with open(prometheus_path) as file:
+                self.assertIn('email_processor_gmail_api_requests_total', file.read())
+            functions = {function for _, _, function in pstats.Stats(profile_path).stats}
+            self.assertEqual('busy_worker' in functions, PROFILE_EACH_THREAD)
+        METRICS.reset()
+
+    def test_profiler_when_only_one_profiler_can_be_active(self):
+        profiler, run = Profiler(profile_each_thread=False), threading.Thread.run
+
+        # Profile a block starting threads, as on Python 3.12 and later
+        with profiler.profile():
+            threads = [threading.Thread(target=busy_worker) for _ in range(2)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            busy_worker()
+
+        # Assert that only the calling thread was profiled, and Thread.run was left alone
+        with tempfile.TemporaryDirectory() as directory:
+            profile_path = os.path.join(directory, 'run.prof')
+            profiler.dump_stats(profile_path)
+            calls = {function: stat[0] for (_, _, function), stat in pstats.Stats(profile_path).stats.items()}
+        self.assertEqual(calls['busy_worker'], 1)
+        self.assertEqual(len(profiler.profiles), 1)
+        self.assertIs(threading.Thread.run, run)
+
+
+if __name__ == '__main__':
+    unittest.main()